@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+""" Benchmarks for pipeline-trigger
+
+    python bench_trigger.py startup [--runs 10] [--output results.json]
+    python bench_trigger.py e2e [--runs 3] [--latency 0.05] [--duration 2] [--jobs 20] ...
+
+Results are printed (or written to --output) as json so they can be compared
+between revisions. All benchmarks run against `FakeGitLab`, a local stand-in
+for the parts of the GitLab API used by trigger.
+"""
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import tracemalloc
+import urllib.parse
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from time import perf_counter, sleep, time
+from typing import Dict, List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TRIGGER = os.path.join(HERE, 'trigger.py')
+
+
+def summarize(samples: List[float]) -> Dict:
+    return dict(
+        runs=len(samples),
+        min=min(samples),
+        median=statistics.median(samples),
+        max=max(samples),
+    )
+
+
+def time_command(cmd: List[str], runs: int) -> List[float]:
+    samples = []
+    for _ in range(runs):
+        started = perf_counter()
+        subprocess.run(cmd, cwd=HERE, check=True, stdout=subprocess.DEVNULL)
+        samples.append(perf_counter() - started)
+    return samples
+
+
+def imported_modules(code: str) -> List[str]:
+    out = subprocess.check_output(
+        [sys.executable, '-c', f'{code}; import sys; print("\\n".join(sorted(sys.modules)))'], cwd=HERE)
+    return out.decode('utf-8').split()
+
+
+def isoformat(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+class FakeGitLab:
+    """ Local stand-in for the parts of the GitLab API used by trigger
+
+    Pipelines run for `duration` seconds with `jobs` jobs, each producing a
+    trace of `trace_bytes`, and then succeed (or fail, for a `fail_rate` share
+    of them). Every response is delayed by `latency` seconds and an
+    `error_rate` share of the requests is answered with a `500`.
+    """
+
+    def __init__(self, latency=0.0, duration=2.0, jobs=5, trace_bytes=1024, error_rate=0.0, fail_rate=0.0, seed=0):
+        self.latency = latency
+        self.duration = duration
+        self.jobs = jobs
+        self.trace_bytes = trace_bytes
+        self.error_rate = error_rate
+        self.fail_rate = fail_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.pipelines = {}
+        self.reset()
+        gitlab = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                gitlab.dispatch(self, 'GET')
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                gitlab.dispatch(self, 'POST', body)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.httpd = Server(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.httpd.server_address[1]
+
+    def reset(self):
+        """ Reset the request statistics
+        """
+        with self.lock:
+            self.requests = 0
+            self.bytes_sent = 0
+            self.endpoints = {}
+            self.first_request_at = None
+            self.detected = {}
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def pipeline(self, pid, now=None) -> Dict:
+        p = self.pipelines[pid]
+        now = time() if now is None else now
+        finished_at = p['created_at'] + p['duration']
+        finished = now >= finished_at
+        status = ('failed' if p['fail'] else 'success') if finished else 'running'
+        return dict(
+            id=pid,
+            project_id=p['project'],
+            ref=p['ref'],
+            sha='deadbeef',
+            status=status,
+            created_at=isoformat(p['created_at']),
+            updated_at=isoformat(finished_at if finished else p['created_at']),
+            finished_at=isoformat(finished_at) if finished else None,
+            web_url=f"{self.url}/project{p['project']}/pipelines/{pid}",
+        )
+
+    def job_list(self, pid) -> List[Dict]:
+        pipeline = self.pipeline(pid)
+        return [
+            dict(id=pid * 10000 + i, name=f'job {i}', stage='test', status=pipeline['status'], pipeline=dict(id=pid))
+            for i in range(self.jobs)
+        ]
+
+    def create(self, project, ref) -> Dict:
+        with self.lock:
+            pid = next(self.ids)
+            self.pipelines[pid] = dict(project=project, ref=ref, created_at=time(), duration=self.duration,
+                                       fail=self.random.random() < self.fail_rate)
+        return self.pipeline(pid)
+
+    def observe(self, pipeline):
+        """ Remember when a finished status was first served, to measure the detection lag
+        """
+        if pipeline['finished_at'] is not None:
+            with self.lock:
+                self.detected.setdefault(pipeline['id'], time())
+
+    def detection_lags(self) -> List[float]:
+        with self.lock:
+            return [seen - (self.pipelines[pid]['created_at'] + self.pipelines[pid]['duration'])
+                    for pid, seen in self.detected.items()]
+
+    def route(self, method, path, query):
+        """ Returns `(endpoint, status, body, headers)` for a request
+        """
+        m = re.match(r'^/api/v4/projects/([^/]+)(/.*)?$', path)
+        if not m:
+            return 'unknown', 404, {'message': '404 Not Found'}, {}
+        project, rest = urllib.parse.unquote(m.group(1)), m.group(2) or ''
+        if method == 'POST' and rest == '/trigger/pipeline':
+            return 'create_pipeline', 201, self.create(project, query.get('ref', 'master')), {}
+        if method == 'GET' and rest == '':
+            return 'get_project', 200, dict(id=project, path_with_namespace=f'group/{project}', web_url=f'{self.url}/{project}'), {}
+        if method == 'GET' and rest == '/pipelines':
+            pipelines = [self.pipeline(pid) for pid in sorted(self.pipelines, reverse=True) if self.pipelines[pid]['project'] == project]
+            if query.get('updated_after'):
+                pipelines = [p for p in pipelines if p['updated_at'] > query['updated_after']]
+            if query.get('ref'):
+                pipelines = [p for p in pipelines if p['ref'] == query['ref']]
+            for p in pipelines:
+                self.observe(p)
+            return ('list_pipelines',) + self.page(pipelines, query)
+        m = re.match(r'^/pipelines/(\d+)(/.*)?$', rest)
+        if m and int(m.group(1)) in self.pipelines:
+            pid, action = int(m.group(1)), m.group(2) or ''
+            if method == 'GET' and action == '':
+                pipeline = self.pipeline(pid)
+                self.observe(pipeline)
+                return 'get_pipeline', 200, pipeline, {}
+            if method == 'GET' and action == '/jobs':
+                return ('get_pipeline_jobs',) + self.page(self.job_list(pid), query)
+            if method == 'POST' and action == '/retry':
+                return 'retry_pipeline', 201, self.pipeline(pid), {}
+        m = re.match(r'^/jobs/(\d+)/(trace|play)$', rest)
+        if m:
+            if method == 'GET' and m.group(2) == 'trace':
+                line = b'x' * 79 + b'\n'
+                return 'get_job_trace', 200, (line * (self.trace_bytes // len(line) + 1))[:self.trace_bytes], {}
+            if method == 'POST' and m.group(2) == 'play':
+                return 'play_job', 200, dict(id=int(m.group(1)), status='pending'), {}
+        if method == 'GET' and rest.startswith('/repository/commits/'):
+            return 'get_sha', 200, dict(id='deadbeef'), {}
+        return 'unknown', 404, {'message': '404 Not Found'}, {}
+
+    @staticmethod
+    def page(items, query):
+        per_page = int(query.get('per_page', 20))
+        page = int(query.get('page', 1))
+        next_page = str(page + 1) if page * per_page < len(items) else ''
+        return 200, items[(page - 1) * per_page:page * per_page], {'X-Next-Page': next_page}
+
+    def dispatch(self, handler, method, body=b''):
+        with self.lock:
+            if self.first_request_at is None:
+                self.first_request_at = perf_counter()
+        url = urllib.parse.urlsplit(handler.path)
+        query = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+        query.update({k: v[-1] for k, v in urllib.parse.parse_qs(body.decode('utf-8')).items()})
+        if self.latency:
+            sleep(self.latency)
+        with self.lock:
+            failing = self.random.random() < self.error_rate
+        if failing:
+            endpoint, status, content, headers = 'injected_error', 500, {'message': '500 Internal Server Error'}, {}
+        else:
+            endpoint, status, content, headers = self.route(method, url.path, query)
+        data = content if isinstance(content, bytes) else json.dumps(content).encode('utf-8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'text/plain' if isinstance(content, bytes) else 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(data)
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += len(data)
+            self.endpoints[endpoint] = self.endpoints.get(endpoint, 0) + 1
+
+
+def time_to_first_request(runs: int) -> List[float]:
+    """ Time from process start until a detached trigger's create request arrives
+    """
+    samples = []
+    gitlab = FakeGitLab()
+    try:
+        for _ in range(runs):
+            gitlab.reset()
+            started = perf_counter()
+            subprocess.run(
+                [sys.executable, TRIGGER, '-h', gitlab.url, '-p', 'token', '-t', 'master', '--detached', '123'],
+                cwd=HERE, check=True, stdout=subprocess.DEVNULL)
+            assert gitlab.first_request_at is not None, 'trigger did not create a pipeline'
+            samples.append(gitlab.first_request_at - started)
+    finally:
+        gitlab.close()
+    return samples
+
+
+def detached_run_modules() -> List[str]:
+    """ Modules loaded by a complete detached trigger run
+    """
+    gitlab = FakeGitLab()
+    try:
+        argv = ['-h', gitlab.url, '-p', 'token', '-t', 'master', '--detached', '123']
+        return imported_modules(
+            f'import os, sys, trigger; sys.stdout = open(os.devnull, "w"); trigger.trigger({argv!r}); sys.stdout = sys.__stdout__')
+    finally:
+        gitlab.close()
+
+
+def bench_startup(args) -> Dict:
+    runs = args.runs
+    baseline = time_command([sys.executable, '-c', 'pass'], runs)
+    import_trigger = time_command([sys.executable, '-c', 'import trigger'], runs)
+    first_request = time_to_first_request(runs)
+    modules = imported_modules('import trigger')
+    detached_modules = detached_run_modules()
+    return dict(
+        interpreter=summarize(baseline),
+        import_trigger=summarize(import_trigger),
+        import_overhead=statistics.median(import_trigger) - statistics.median(baseline),
+        detached_first_request=summarize(first_request),
+        modules_after_import=len(modules),
+        heavy_modules_after_import=[m for m in ('requests', 'urllib3') if m in modules],
+        heavy_modules_after_detached_run=[m for m in ('asyncio', 'concurrent.futures', 'gitlab') if m in detached_modules],
+    )
+
+
+def run_trigger(argv: List[str]) -> Dict:
+    """ Run `trigger()` in this process, returns its wall time, return code and peak memory
+    """
+    import trigger
+
+    tracemalloc.start()
+    started = perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            trigger.trigger(argv)
+            return_code = 0
+        except trigger.PipelineFailure as e:
+            return_code = e.return_code
+        except Exception:
+            # e.g. an injected error while creating the pipeline, like an uncaught error on the command line
+            return_code = 1
+    wall = perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return dict(wall=wall, return_code=return_code, peak_memory=peak)
+
+
+def e2e_scenarios(args, gitlab, output_dir) -> Dict[str, List[str]]:
+    common = ['-h', gitlab.url, '-a', 'api_token', '-p', 'token', '-t', 'master', '--sleep', str(args.sleep)]
+    return {
+        'single': common + ['1'],
+        'targets': common + [arg for i in range(2, args.targets + 1) for arg in ('--target', str(i))] + ['1'],
+        'traces': common + ['--output-dir', output_dir, '1'],
+    }
+
+
+def bench_e2e(args) -> Dict:
+    results = {}
+    gitlab = FakeGitLab(latency=args.latency, duration=args.duration, jobs=args.jobs, trace_bytes=args.trace_bytes,
+                        error_rate=args.error_rate, fail_rate=args.fail_rate)
+    try:
+        with tempfile.TemporaryDirectory() as output_dir:
+            for name, argv in e2e_scenarios(args, gitlab, output_dir).items():
+                runs = []
+                for _ in range(args.runs):
+                    gitlab.reset()
+                    run = run_trigger(argv)
+                    run.update(
+                        api_calls=gitlab.requests,
+                        bytes_sent=gitlab.bytes_sent,
+                        endpoints=dict(gitlab.endpoints),
+                        detection_lag=max(gitlab.detection_lags(), default=None),
+                    )
+                    runs.append(run)
+                results[name] = dict(
+                    wall=summarize([r['wall'] for r in runs]),
+                    detection_lag=summarize([r['detection_lag'] for r in runs if r['detection_lag'] is not None] or [0.0]),
+                    api_calls=summarize([r['api_calls'] for r in runs]),
+                    bytes_sent=summarize([r['bytes_sent'] for r in runs]),
+                    peak_memory=summarize([r['peak_memory'] for r in runs]),
+                    return_codes=sorted(set(r['return_code'] for r in runs)),
+                    endpoints=runs[-1]['endpoints'],
+                )
+    finally:
+        gitlab.close()
+    results['config'] = {k: getattr(args, k) for k in (
+        'latency', 'duration', 'jobs', 'trace_bytes', 'error_rate', 'fail_rate', 'targets', 'sleep')}
+    return results
+
+
+BENCHMARKS = dict(
+    startup=bench_startup,
+    e2e=bench_e2e,
+)
+
+
+def parse_args(args: List[str]):
+    parser = argparse.ArgumentParser(description='Benchmarks for pipeline-trigger')
+    parser.add_argument('benchmark', choices=list(BENCHMARKS))
+    parser.add_argument('--runs', type=int, default=None, help='runs per measurement (default: 10 for startup, 3 for e2e)')
+    parser.add_argument('--output', help='write the json results to this file instead of stdout')
+    e2e = parser.add_argument_group('e2e', 'settings of the fake GitLab and the triggered runs')
+    e2e.add_argument('--latency', type=float, default=0.02, help='seconds every API response is delayed')
+    e2e.add_argument('--duration', type=float, default=2.0, help='seconds each pipeline runs')
+    e2e.add_argument('--jobs', type=int, default=20, help='jobs per pipeline')
+    e2e.add_argument('--trace-bytes', type=int, default=64 * 1024, help='size of each job trace')
+    e2e.add_argument('--error-rate', type=float, default=0.0, help='share of API requests answered with a 500')
+    e2e.add_argument('--fail-rate', type=float, default=0.0, help='share of pipelines that fail')
+    e2e.add_argument('--targets', type=int, default=5, help='number of projects triggered in the targets scenario')
+    e2e.add_argument('--sleep', type=int, default=1, help='--sleep passed to trigger')
+    args = parser.parse_args(args)
+    if args.runs is None:
+        args.runs = 10 if args.benchmark == 'startup' else 3
+    return args
+
+
+def main(args: List[str]):
+    args = parse_args(args)
+    results = dict(
+        benchmark=args.benchmark,
+        python=sys.version.split()[0],
+        results=BENCHMARKS[args.benchmark](args),
+    )
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':  # pragma: nocover
+    main(sys.argv[1:])
@@ -1,10 +1,20 @@
+import collections
 import contextlib
+import gzip
 import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
+import urllib.error
+import urllib.request
 from inspect import cleandoc
 from io import StringIO
+from time import monotonic, sleep, time
 from unittest import mock
-from unittest.mock import MagicMock, Mock, PropertyMock
 
 import pytest
 import requests_mock
@@ -14,93 +24,87 @@ import trigger
 GITLAB_HOST = 'example.com'
 
 
-def some_gitlab(url, api_token, verifyssl, pipeline_behavior):
-    gitlab = Mock(url=url, private_token=api_token, ssl_verify=verifyssl)
-    project = Mock(web_url=f"{url}/project1")
-    project.pipelines.get = pipeline_behavior
-    gitlab.projects.get = MagicMock(return_value=project)
-    return gitlab
+def some_manual_jobs():
+    return [
+        dict(id=10, name='build', status=trigger.STATUS_SKIPPED, stage='stage0'),
+        dict(id=11, name='manual1', status=trigger.STATUS_MANUAL, stage='stage1'),
+        dict(id=12, name='manual2', status=trigger.STATUS_MANUAL, stage='stage2'),
+    ]
 
 
-def some_manual_jobs(manual_pipeline):
-    prop_name_1 = PropertyMock(return_value='manual1')
-    job_1 = Mock(status=trigger.STATUS_MANUAL, stage='stage1')
-    type(job_1).name = prop_name_1
+def some_manual_pipeline_behavior(final_status):
+    return dict(
+        statuses=[trigger.STATUS_SKIPPED, 'running', final_status],
+        jobs=some_manual_jobs(),
+    )
 
-    prop_name_2 = PropertyMock(return_value='manual2')
-    job_2 = Mock(status=trigger.STATUS_MANUAL, stage='stage2')
-    type(job_2).name = prop_name_2
-    manual_pipeline.jobs.list = MagicMock(return_value=[
-        Mock(status=trigger.STATUS_SKIPPED),
-        job_1,
-        job_2
-    ])
-    return manual_pipeline
 
+def some_auto_pipeline_behavior(final_status, initial_statuses=('running',)):
+    return dict(statuses=[*initial_statuses, final_status])
 
-def some_manual_pipeline_behavior(final_status):
-    pipeline_behavior = Mock()
-    pipeline_behavior.side_effect = [
-        some_manual_jobs(Mock(status=trigger.STATUS_SKIPPED)),
-        Mock(status='running'),
-        Mock(status=final_status),
-    ]
-    return pipeline_behavior
 
+def some_invalid_manual_pipeline_behavior():
+    return dict(
+        statuses=[trigger.STATUS_SKIPPED],
+        jobs=[
+            dict(id=10, name='build', status=trigger.STATUS_SKIPPED, stage='stage0'),
+            dict(id=11, name='test', status=trigger.STATUS_CANCELED, stage='stage1'),
+            dict(id=12, name='deploy', status=trigger.STATUS_FAILED, stage='stage2'),
+        ],
+    )
 
-def some_auto_pipeline_behavior(final_status):
-    pipeline_behavior = Mock()
-    pipeline_behavior.side_effect = [
-        Mock(status='running'),
-        Mock(status=final_status),
-    ]
-    return pipeline_behavior
 
+def mock_create_pipeline(mock_request, project_id=123, pipeline_id=1):
+    mock_request.post(
+        f"https://{GITLAB_HOST}/api/v4/projects/{project_id}/trigger/pipeline",
+        text=json.dumps(dict(id=str(pipeline_id), web_url=f"https://{GITLAB_HOST}/project1/pipelines/{pipeline_id}")),
+        status_code=201
+    )
 
-def some_invalid_manual_pipeline_behavior():
-    pipeline_behavior = Mock()
-    pipeline = Mock(status=trigger.STATUS_SKIPPED, web_url=f"https://{GITLAB_HOST}/project1")
-    pipeline.jobs.list = MagicMock(return_value=[
-        Mock(status=trigger.STATUS_SKIPPED),
-        Mock(status=trigger.STATUS_CANCELED),
-        Mock(status=trigger.STATUS_FAILED)
-    ])
-    pipeline_behavior.side_effect = [
-        pipeline,
-        Mock(status=trigger.STATUS_SKIPPED),
-        Mock(status=trigger.STATUS_SKIPPED),
-    ]
-    return pipeline_behavior
+
+def mock_pipeline_statuses(mock_request, behavior, project_id=123, pipeline_id=1):
+    mock_request.get(
+        f"https://{GITLAB_HOST}/api/v4/projects/{project_id}/pipelines/{pipeline_id}",
+        [
+            dict(json=dict(id=pipeline_id, status=status, sha='deadbeef', web_url=f"https://{GITLAB_HOST}/project1"))
+            for status in behavior['statuses']
+        ]
+    )
+
+
+def mock_pipeline_jobs(mock_request, behavior, project_id=123, pipeline_id=1):
+    jobs = behavior.get('jobs', [])
+    mock_request.get(f"https://{GITLAB_HOST}/api/v4/projects/{project_id}/pipelines/{pipeline_id}/jobs", json=jobs)
+    for job in jobs:
+        mock_request.post(f"https://{GITLAB_HOST}/api/v4/projects/{project_id}/jobs/{job['id']}/play", json=dict(job, status='pending'))
 
 
 class TriggerTest(unittest.TestCase):
     COMMON_ARGS = f"-h {GITLAB_HOST} -a api_token -p trigger_token --sleep 1 -t master"
 
-    def run_trigger(self, cmd_args, mock_get_gitlab, behavior, add_extra_mocks=[]):
-        gitlab = some_gitlab(f"https://{GITLAB_HOST}", 'api_token', True, behavior)
-        mock_get_gitlab.return_value = gitlab
+    def run_trigger(self, cmd_args, behavior, add_extra_mocks=[]):
         temp_stdout = StringIO()
         with contextlib.redirect_stdout(temp_stdout), requests_mock.Mocker() as m:
-            m.post(f"https://{GITLAB_HOST}/api/v4/projects/123/trigger/pipeline", text='{"id": "1"}', status_code=201)
+            mock_create_pipeline(m)
+            mock_pipeline_statuses(m, behavior)
+            mock_pipeline_jobs(m, behavior)
             for extra_mock in add_extra_mocks:
-                extra_mock(gitlab, m)
-            trigger.get_gitlab.cache_clear()
-            trigger.get_project.cache_clear()
+                extra_mock(m)
             pid = trigger.trigger(cmd_args.split(' '))
             assert str(pid) == '1'
+        self.request_history = m.request_history
         return temp_stdout
 
-    def run_trigger_with_error(self, cmd_args, mock_get_gitlab, behavior):
-        gitlab = some_gitlab(f"https://{GITLAB_HOST}", 'api_token', True, behavior)
-        mock_get_gitlab.return_value = gitlab
+    def run_trigger_with_error(self, cmd_args, behavior):
         temp_stdout = StringIO()
         with contextlib.redirect_stdout(temp_stdout), self.assertRaises(trigger.PipelineFailure) as context, requests_mock.Mocker() as m:
-            m.post(f"https://{GITLAB_HOST}/api/v4/projects/123/trigger/pipeline", text='{"id": "1"}', status_code=201)
-            trigger.get_gitlab.cache_clear()
-            trigger.get_project.cache_clear()
+            mock_create_pipeline(m)
+            mock_pipeline_statuses(m, behavior)
+            mock_pipeline_jobs(m, behavior)
             pid = trigger.trigger(cmd_args.split(' '))
             assert m.called_once
             assert pid == '1'
+        self.request_history = m.request_history
         return context, temp_stdout
 
     def test_isint(self):
@@ -192,14 +196,18 @@ class TriggerTest(unittest.TestCase):
         # happy path
         m.get(
             f"https://xxx/pipelines/123/jobs",
-            text=json.dumps(dict(foo='bar'))
+            [
+                dict(json=[dict(id=2)], headers={'X-Next-Page': '2'}),
+                dict(json=[dict(id=1)], headers={'X-Next-Page': ''}),
+            ]
         )
         res = trigger.get_pipeline_jobs(
             f'https://xxx',
             api_token='ignored',
             pipeline='123',
             verifyssl=True)
-        assert res == dict(foo='bar')
+        assert res == [dict(id=2), dict(id=1)]
+        assert [r.qs['page'] for r in m.request_history] == [['1'], ['2']]
         # error path
         m.get(
             f"https://xxx/pipelines/123/jobs",
@@ -212,6 +220,50 @@ class TriggerTest(unittest.TestCase):
                 verifyssl=True)
             assert str(e) == 'AssertionError: expected status code 200, was 404'
 
+    @requests_mock.mock()
+    def test_manual_job_player(self, m):
+        def job(id, name, status):
+            return dict(id=id, name=name, status=status, stage='deploy')
+
+        m.get("https://xxx/pipelines/1/jobs", [
+            # the first page is not enough to find all jobs
+            dict(json=[job(1, 'migrate', 'manual'), job(2, 'deploy-eu', 'manual')], headers={'X-Next-Page': '2'}),
+            dict(json=[job(3, 'deploy-us', 'manual'), job(4, 'notify', 'manual')]),
+            # migrate was played but has not been picked up yet
+            dict(json=[job(1, 'migrate', 'created'), job(2, 'deploy-eu', 'manual'), job(3, 'deploy-us', 'manual'), job(4, 'notify', 'manual')]),
+            dict(json=[job(1, 'migrate', 'success'), job(2, 'deploy-eu', 'manual'), job(3, 'deploy-us', 'manual'), job(4, 'notify', 'manual')]),
+            dict(json=[job(1, 'migrate', 'success'), job(2, 'deploy-eu', 'running'), job(3, 'deploy-us', 'success'), job(4, 'notify', 'manual')]),
+        ])
+        m.post("https://xxx/jobs/1/play", json=job(1, 'migrate', 'created'))
+        m.post("https://xxx/jobs/2/play", json=job(2, 'deploy-eu', 'pending'))
+        m.post("https://xxx/jobs/3/play", json=job(3, 'deploy-us', 'pending'))
+        args = trigger.parse_args('-a api_token -p tok -t master --on-manual play --jobs migrate,deploy-eu+deploy-us 123'.split())
+        player = trigger.ManualJobPlayer(args, 'https://xxx', 1)
+
+        def played():
+            return [r.path for r in m.request_history if r.method == 'POST']
+
+        with contextlib.redirect_stdout(StringIO()):
+            # migrate has not started yet, so the next step waits
+            assert player.play() == 1
+            assert played() == ['/jobs/1/play']
+            assert player.waiting()
+            assert player.play() == 0
+            # once it has started, both jobs of the next step are played together
+            assert player.play() == 2
+            assert sorted(played()[1:]) == ['/jobs/2/play', '/jobs/3/play']
+            # notify is not part of --jobs and nothing is played twice
+            assert player.play() == 0
+            assert not player.waiting()
+        assert len(played()) == 3
+
+        # a skipped job does not block the later steps
+        m.get("https://yyy/pipelines/1/jobs", json=[job(5, 'check', 'skipped'), job(6, 'release', 'manual')])
+        m.post("https://yyy/jobs/6/play", json=job(6, 'release', 'pending'))
+        args = trigger.parse_args('-a api_token -p tok -t master --on-manual play --jobs check,release 123'.split())
+        with contextlib.redirect_stdout(StringIO()):
+            assert trigger.ManualJobPlayer(args, 'https://yyy', 1).play() == 1
+
     @requests_mock.mock()
     def test_get_job_trace(self, m):
         # happy path
@@ -237,6 +289,293 @@ class TriggerTest(unittest.TestCase):
                 verifyssl=True)
             assert str(e) == 'AssertionError: expected status code 200, was 404'
 
+    def test_lazy_imports(self):
+        code = "import sys, trigger; print(' '.join(m for m in ('requests', 'urllib3') if m in sys.modules))"
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)))
+        assert output.strip() == b''
+
+    def test_get_session(self):
+        trigger.get_session.cache_clear()
+        session = trigger.get_session('api_token', False)
+        assert trigger.get_session('api_token', False) is session
+        assert trigger.get_session('other_token', False) is not session
+        assert session.headers['PRIVATE-TOKEN'] == 'api_token'
+        assert session.headers['Accept-Encoding'] == 'gzip'
+        assert session.verify is False
+        assert 'PRIVATE-TOKEN' not in trigger.get_session(None, True).headers
+
+    def test_configure_http(self):
+        trigger.get_session.cache_clear()
+        try:
+            trigger.configure_http(pool_size=3)
+            adapter = trigger.get_session('api_token', True).get_adapter('https://example.com')
+            assert adapter._pool_maxsize == 3
+        finally:
+            trigger.configure_http()
+        adapter = trigger.get_session('api_token', True).get_adapter('https://example.com')
+        assert adapter._pool_maxsize == trigger.DEFAULT_POOL_SIZE
+
+    @requests_mock.mock()
+    def test_rate_limited_request(self, m):
+        m.get("https://xxx/pipelines/1", [
+            dict(status_code=429, headers={'Retry-After': '3'}),
+            dict(json=dict(id=1), headers={'RateLimit-Remaining': '9', 'RateLimit-Reset': str(int(time()) + 20)}),
+        ])
+        trigger.get_rate_limiter.cache_clear()
+        with mock.patch('trigger.sleep') as sleep_mock:
+            assert trigger.get_pipeline('https://xxx', 'api_token', 1, True) == dict(id=1)
+        assert m.call_count == 2
+        # the retry waited for Retry-After
+        assert sleep_mock.call_count == 1 and 2 < sleep_mock.call_args[0][0] <= 3
+        # the remaining requests are spread until the reset
+        limiter = trigger.get_rate_limiter('xxx', 'api_token')
+        assert 0.35 < limiter.rate < 0.45
+        trigger.get_rate_limiter.cache_clear()
+
+    @requests_mock.mock()
+    def test_request_deadline(self, m):
+        m.get("https://xxx/pipelines/1", status_code=429, headers={'Retry-After': '30'})
+        trigger.get_rate_limiter.cache_clear()
+        started = monotonic()
+        with self.assertRaisesRegex(AssertionError, 'time budget'):
+            trigger.get_pipeline('https://xxx', 'api_token', 1, True, deadline=started + 0.5)
+        # the retry waited only until the deadline instead of for Retry-After, and was not sent
+        assert 0.5 <= monotonic() - started < 1.5
+        assert m.call_count == 1 and all(0 < t <= 0.5 for t in m.request_history[0].timeout)
+        trigger.get_rate_limiter.cache_clear()
+
+    def test_rate_limiter(self):
+        limiter = trigger.RateLimiter(rate=2)
+        with mock.patch('trigger.sleep') as sleep_mock:
+            # the burst is the rate, the third request waits for a refill
+            limiter.acquire()
+            limiter.acquire()
+            assert sleep_mock.call_count == 0
+            limiter.acquire()
+            assert sleep_mock.call_count == 1 and 0.4 < sleep_mock.call_args[0][0] <= 0.5
+        limiter = trigger.RateLimiter(rate=0)
+        with mock.patch('trigger.sleep') as sleep_mock:
+            for _ in range(100):
+                limiter.acquire()
+            assert sleep_mock.call_count == 0
+        assert trigger.parse_retry_after('5') == 5
+        assert trigger.parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+        assert trigger.parse_retry_after('soon') is None
+
+    @requests_mock.mock()
+    def test_helpers_share_session(self, m):
+        m.get("https://xxx/pipelines/123", text=json.dumps(dict(sha='deadbeef')))
+        m.get("https://xxx/repository/commits/master", text=json.dumps(dict(id='deadbeef')))
+        trigger.get_pipeline('https://xxx', 'api_token', '123', True)
+        trigger.get_sha('https://xxx', 'api_token', 'master', True)
+        assert [r.headers['PRIVATE-TOKEN'] for r in m.request_history] == ['api_token', 'api_token']
+
+    @requests_mock.mock()
+    def test_poll_pipeline_conditional(self, m):
+        m.get("https://xxx/pipelines/123", [
+            dict(json=dict(id=123, status='running'), headers={'ETag': 'W/"abc"'}),
+            dict(status_code=304),
+            dict(json=dict(id=123, status='success')),
+        ])
+        trigger.conditional_cache.clear()
+        first, modified = trigger.poll_pipeline('https://xxx', 'api_token', '123', True)
+        assert modified and first == dict(id=123, status='running')
+        assert 'If-None-Match' not in m.request_history[0].headers
+
+        second, modified = trigger.poll_pipeline('https://xxx', 'api_token', '123', True)
+        assert not modified and second is first
+        assert m.request_history[1].headers['If-None-Match'] == 'W/"abc"'
+
+        third, modified = trigger.poll_pipeline('https://xxx', 'api_token', '123', True)
+        assert modified and third == dict(id=123, status='success')
+        # no ETag in the last response, nothing left to revalidate
+        assert trigger.conditional_cache == {}
+
+    @requests_mock.mock()
+    def test_trace_tailer(self, m):
+        m.get("https://xxx/pipelines/1/jobs", [
+            dict(json=[dict(id=7, name='build', status='running'), dict(id=8, name='test', status='created')]),
+            dict(json=[dict(id=7, name='build', status='success'), dict(id=8, name='test', status='running')]),
+        ])
+        m.get("https://xxx/jobs/7/trace", [
+            dict(content=b'line 1\nline'),
+            dict(content=b' 2\nline 3', status_code=206),
+        ])
+        # a server ignoring Range sends the full trace again
+        m.get("https://xxx/jobs/8/trace", content=b'test line\n')
+
+        temp_stdout = StringIO()
+        with contextlib.redirect_stdout(temp_stdout):
+            tailer = trigger.TraceTailer('https://xxx', 'api_token', 1, True)
+            tailer.poll()
+            tailer.poll()
+        self.assertEqual(temp_stdout.getvalue().strip(), cleandoc("""
+            [build] line 1
+            [build] line 2
+            [build] line 3
+            [test] test line
+        """))
+        build_requests = [r for r in m.request_history if r.path == '/jobs/7/trace']
+        assert build_requests[0].headers['Range'] == 'bytes=0-'
+        assert build_requests[1].headers['Range'] == 'bytes=11-'
+        assert tailer.completed == {7}
+        assert tailer.offsets == {7: 20, 8: 10}
+
+        # a failed trace request neither aborts the poll nor completes the job
+        m.get("https://yyy/pipelines/1/jobs", json=[dict(id=9, name='lint', status='success')])
+        m.get("https://yyy/jobs/9/trace", [dict(status_code=500), dict(content=b'lint line\n')])
+        temp_stdout = StringIO()
+        with contextlib.redirect_stdout(temp_stdout):
+            tailer = trigger.TraceTailer('https://yyy', 'api_token', 1, True)
+            tailer.poll()
+            assert tailer.completed == set()
+            tailer.poll()
+        assert 'Fetching output of job lint failed' in temp_stdout.getvalue()
+        assert temp_stdout.getvalue().endswith('[lint] lint line\n')
+        assert tailer.completed == {9}
+
+    @requests_mock.mock()
+    def test_download_job_trace(self, m):
+        m.get("https://xxx/jobs/123/trace", content=b'0123456789' * 10000)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'trace.log')
+            assert trigger.download_job_trace('https://xxx', 'api_token', 123, path, True) == 100000
+            assert os.path.getsize(path) == 100000
+
+            assert trigger.download_job_trace('https://xxx', 'api_token', 123, path, True, max_bytes=15) == 15
+            with open(path, 'rb') as f:
+                assert f.read() == b'012345678901234'
+
+            # server ignoring Range: the tail is cut client side
+            assert trigger.download_job_trace('https://xxx', 'api_token', 123, path, True, compress=True, tail_bytes=4) == 4
+            with gzip.open(path, 'rb') as f:
+                assert f.read() == b'6789'
+        assert m.request_history[-1].headers['Range'] == 'bytes=-4'
+
+    @requests_mock.mock()
+    def test_save_pipeline_traces(self, m):
+        m.get("https://xxx/pipelines/1/jobs", json=[dict(id=7, name='build linux'), dict(id=8, name='test')])
+        m.get("https://xxx/jobs/7/trace", content=b'build output')
+        m.get("https://xxx/jobs/8/trace", status_code=404)
+        with tempfile.TemporaryDirectory() as tmp:
+            args = trigger.parse_args(f'-a api_token -p tok -t ref --output-dir {tmp}/out --trace-workers 2 123'.split())
+            temp_stdout = StringIO()
+            with contextlib.redirect_stdout(temp_stdout):
+                paths = trigger.save_pipeline_traces(args, 'https://xxx', 1)
+            assert paths == [os.path.join(tmp, 'out', '7-build_linux.log')]
+            with open(paths[0], 'rb') as f:
+                assert f.read() == b'build output'
+        output = temp_stdout.getvalue()
+        assert 'Failed to download output of job test: expected status code 200 or 206, was 404' in output
+        assert f'Pipeline 1 job output written to {tmp}/out (1 of 2 jobs)' in output
+
+    @requests_mock.mock()
+    def test_batch_poller(self, m):
+        def pipeline(pid, status, updated_at):
+            return dict(id=pid, status=status, updated_at=updated_at)
+
+        m.get("https://xxx/pipelines/1", json=pipeline(1, 'running', '2020-01-01T10:00:00.000Z'))
+        m.get("https://xxx/pipelines/2", json=pipeline(2, 'pending', '2020-01-01T10:00:05.000Z'))
+        m.get("https://xxx/pipelines", [
+            dict(json=[pipeline(3, 'running', '2020-01-01T10:00:09.000Z'), pipeline(2, 'running', '2020-01-01T10:00:08.000Z')],
+                 headers={'X-Next-Page': '2'}),
+            dict(json=[pipeline(1, 'running', '2020-01-01T10:00:00.000Z')]),
+            dict(json=[pipeline(1, 'success', '2020-01-01T10:01:00.000Z')]),
+        ])
+        poller = trigger.BatchPoller()
+        key = poller.track('https://xxx', 'api_token', True, 1)
+        assert poller.track('https://xxx', 'api_token', True, '2') == key
+
+        # newly tracked pipelines are fetched one by one once
+        changed, failed = poller.poll()
+        assert set(changed) == {('https://xxx', '1'), ('https://xxx', '2')} and failed == {}
+
+        # then all of them are refreshed from the list of updated pipelines
+        changed, failed = poller.poll()
+        assert changed == {('https://xxx', '2'): pipeline(2, 'running', '2020-01-01T10:00:08.000Z')}
+        list_requests = [r for r in m.request_history if r.path == '/pipelines']
+        assert list_requests[0].qs == dict(
+            updated_after=['2020-01-01t10:00:05.000z'], order_by=['updated_at'], sort=['desc'], per_page=['100'], page=['1'])
+        assert list_requests[1].qs['page'] == ['2']
+
+        poller.untrack('https://xxx', 'api_token', True, 2)
+        changed, failed = poller.poll([key])
+        assert changed == {('https://xxx', '1'): pipeline(1, 'success', '2020-01-01T10:01:00.000Z')}
+        list_requests = [r for r in m.request_history if r.path == '/pipelines']
+        assert list_requests[-1].qs['updated_after'] == ['2020-01-01t10:00:09.000z']
+        poller.untrack('https://xxx', 'api_token', True, 1)
+        assert poller.groups == {}
+
+    @requests_mock.mock()
+    def test_batch_poller_refetch(self, m):
+        # the cursor moved past the final update of pipeline 1, the list never returns it
+        m.get("https://xxx/pipelines", json=[dict(id=2, status='running', updated_at='2020-01-01T10:00:09.000Z')])
+        m.get("https://xxx/pipelines/1", [
+            dict(json=dict(id=1, status='running', updated_at='2020-01-01T10:00:00.000Z')),
+            dict(json=dict(id=1, status='success', updated_at='2020-01-01T10:00:05.000Z')),
+        ])
+        poller = trigger.BatchPoller()
+        poller.refetch_after = 2
+        poller.track('https://xxx', 'api_token', True, 1)
+        assert set(poller.poll()[0]) == {('https://xxx', '1')}
+        assert poller.poll() == ({}, {})
+        assert poller.poll() == ({}, {})
+        changed, _ = poller.poll()
+        assert changed[('https://xxx', '1')]['status'] == 'success'
+        assert len([r for r in m.request_history if r.path == '/pipelines/1']) == 2
+
+    def test_webhook_listener(self):
+        listener = trigger.WebhookListener('127.0.0.1:0', secret='s3cret')
+        try:
+            listener.track(1)
+            events = []
+            listener.on_change(lambda: events.append(True))
+            assert post_webhook(listener.address, 'webhook_pipeline.json', 'wrong') == 401
+            assert not listener.wait(0)
+            assert post_webhook(listener.address, 'webhook_job.json', 's3cret') == 200
+            assert listener.wait(0)
+            assert not listener.wait(0)
+            listener.pids.clear()
+            assert post_webhook(listener.address, 'webhook_pipeline.json', 's3cret') == 200
+            assert not listener.wait(0)
+            assert events == [True]
+        finally:
+            listener.close()
+
+    def test_project_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = trigger.ProjectCache(tmp, ttl=60)
+            cache.put(['https://xxx/projects/123', 'https://xxx/projects/group%2Fproj'], dict(id=123))
+            assert cache.get('https://xxx/projects/group%2Fproj') == dict(id=123)
+            assert cache.get('https://xxx/projects/456') is None
+            # a 404 below a cached project url drops all keys of its entry
+            cache.invalidate_url('https://xxx/projects/123/trigger/pipeline')
+            assert cache.get('https://xxx/projects/group%2Fproj') is None
+            assert os.listdir(tmp) == []
+
+            cache.put(['https://xxx/projects/123'], dict(id=123))
+            cache.ttl = -1
+            assert cache.get('https://xxx/projects/123') is None
+
+    @requests_mock.mock()
+    def test_get_project_id_cached(self, m):
+        m.get("https://xxx/projects/group%2Fproj", json=dict(id=123, path_with_namespace='group/proj', web_url='https://xxx/group/proj'))
+        with tempfile.TemporaryDirectory() as tmp:
+            try:
+                trigger.configure_cache(tmp)
+                assert trigger.get_project_id('https://xxx/projects', 'api_token', 'group/proj', True) == '123'
+                assert trigger.get_project_id('https://xxx/projects', 'api_token', 'group/proj', True) == '123'
+                assert trigger.get_project_info('https://xxx/projects', 'api_token', 123, True)['web_url'] == 'https://xxx/group/proj'
+                assert m.call_count == 1
+
+                m.get("https://xxx/projects/123/pipelines/1", status_code=404)
+                with pytest.raises(AssertionError):
+                    trigger.get_pipeline('https://xxx/projects/123', 'api_token', 1, True)
+                assert trigger.get_project_id('https://xxx/projects', 'api_token', 'group/proj', True) == '123'
+                assert m.call_count == 3
+            finally:
+                trigger.configure_cache(None)
+
     def test_args_verify_ssl_invalid(self):
         temp_stderr = StringIO()
         with contextlib.redirect_stderr(temp_stderr), self.assertRaises(SystemExit) as context:
@@ -244,10 +583,9 @@ class TriggerTest(unittest.TestCase):
         assert context.exception and isinstance(context.exception, SystemExit) and context.exception.code == 2
         assert 'argument -v/--verifyssl: Boolean value expected' in temp_stderr.getvalue().strip()
 
-    @mock.patch('gitlab.Gitlab')
-    def test_trigger_manual_play_no_jobs_specified(self, mock_get_gitlab):
+    def test_trigger_manual_play_no_jobs_specified(self):
         cmd_args = TriggerTest.COMMON_ARGS + " --on-manual play 123"
-        temp_stdout = self.run_trigger(cmd_args, mock_get_gitlab, some_manual_pipeline_behavior(trigger.STATUS_SUCCESS))
+        temp_stdout = self.run_trigger(cmd_args, some_manual_pipeline_behavior(trigger.STATUS_SUCCESS))
 
         expected_output = cleandoc("""
             Triggering pipeline for ref 'master' for project id 123
@@ -261,10 +599,9 @@ class TriggerTest(unittest.TestCase):
         """)
         self.assertEqual(temp_stdout.getvalue().strip(), expected_output)
 
-    @mock.patch('gitlab.Gitlab')
-    def test_trigger_manual_play_one_job_specified(self, mock_get_gitlab):
+    def test_trigger_manual_play_one_job_specified(self):
         cmd_args = TriggerTest.COMMON_ARGS + " --on-manual play --jobs manual2 123"
-        temp_stdout = self.run_trigger(cmd_args, mock_get_gitlab, some_manual_pipeline_behavior(trigger.STATUS_SUCCESS))
+        temp_stdout = self.run_trigger(cmd_args, some_manual_pipeline_behavior(trigger.STATUS_SUCCESS))
 
         expected_output = cleandoc("""
             Triggering pipeline for ref 'master' for project id 123
@@ -278,10 +615,9 @@ class TriggerTest(unittest.TestCase):
         """)
         self.assertEqual(temp_stdout.getvalue().strip(), expected_output)
 
-    @mock.patch('gitlab.Gitlab')
-    def test_trigger_manual_play_two_jobs_specified(self, mock_get_gitlab):
+    def test_trigger_manual_play_two_jobs_specified(self):
         cmd_args = TriggerTest.COMMON_ARGS + " --on-manual play --jobs manual2,manual1 123"
-        temp_stdout = self.run_trigger(cmd_args, mock_get_gitlab, some_manual_pipeline_behavior(trigger.STATUS_SUCCESS))
+        temp_stdout = self.run_trigger(cmd_args, some_manual_pipeline_behavior(trigger.STATUS_SUCCESS))
 
         expected_output = cleandoc("""
             Triggering pipeline for ref 'master' for project id 123
@@ -296,12 +632,13 @@ class TriggerTest(unittest.TestCase):
             Pipeline succeeded
         """)
         self.assertEqual(temp_stdout.getvalue().strip(), expected_output)
+        played = [r.path for r in self.request_history if r.method == 'POST' and r.path.endswith('/play')]
+        assert played == ['/api/v4/projects/123/jobs/12/play', '/api/v4/projects/123/jobs/11/play']
 
-    @mock.patch('gitlab.Gitlab')
-    def test_trigger_manual_play_no_manual_jobs_in_pipeline(self, mock_get_gitlab):
+    def test_trigger_manual_play_no_manual_jobs_in_pipeline(self):
         cmd_args = TriggerTest.COMMON_ARGS + " --on-manual play 123"
 
-        (context, temp_stdout) = self.run_trigger_with_error(cmd_args, mock_get_gitlab, some_invalid_manual_pipeline_behavior())
+        (context, temp_stdout) = self.run_trigger_with_error(cmd_args, some_invalid_manual_pipeline_behavior())
 
         self.assertTrue(context.exception and context.exception.pipeline_id == '1')
 
@@ -317,14 +654,13 @@ class TriggerTest(unittest.TestCase):
         """)
         self.assertEqual(temp_stdout.getvalue().strip(), expected_output)
 
-    @mock.patch('gitlab.Gitlab')
-    def test_trigger_with_project_name(self, mock_get_gitlab):
+    def test_trigger_with_project_name(self):
         cmd_args = TriggerTest.COMMON_ARGS + " username/project_name"
 
-        def extra_mock(gitlab, mock_request):
+        def extra_mock(mock_request):
             mock_request.get(f"https://{GITLAB_HOST}/api/v4/projects/username%2Fproject_name", text='{"id": "123"}', status_code=200)
 
-        temp_stdout = self.run_trigger(cmd_args, mock_get_gitlab, some_auto_pipeline_behavior(trigger.STATUS_SUCCESS), [extra_mock])
+        temp_stdout = self.run_trigger(cmd_args, some_auto_pipeline_behavior(trigger.STATUS_SUCCESS), [extra_mock])
 
         expected_output = cleandoc("""
             Triggering pipeline for ref 'master' for project id 123
@@ -336,8 +672,7 @@ class TriggerTest(unittest.TestCase):
         """)
         self.assertEqual(temp_stdout.getvalue().strip(), expected_output)
 
-    @mock.patch('gitlab.Gitlab')
-    def test_trigger_with_retry_failed(self, mock_get_gitlab):
+    def test_trigger_with_retry_failed(self):
         """
         Tests retrying a failed pipeline
         """
@@ -346,16 +681,19 @@ class TriggerTest(unittest.TestCase):
 
         temp_stdout = self.run_trigger(
             cmd_args,
-            mock_get_gitlab,
-            some_auto_pipeline_behavior(trigger.STATUS_SUCCESS),
+            some_auto_pipeline_behavior(trigger.STATUS_SUCCESS, initial_statuses=()),
             [
                 mock_get_last_pipeline(
                     project_id,
                     [dict(id=1, status='failed', sha='deadbeef')]
                 ),
-                mock_get_sha(project_id, dict(id='deadbeef'))
+                mock_get_sha(project_id, dict(id='deadbeef')),
+                mock_retry_pipeline(project_id, 1),
             ],
         )
+        assert [r.path for r in self.request_history if r.method == 'POST'] == ['/api/v4/projects/123/pipelines/1/retry']
+        last_pipeline = [r for r in self.request_history if r.path == '/api/v4/projects/123/pipelines']
+        assert [r.qs['per_page'] for r in last_pipeline] == [['1']]
 
         expected_output = cleandoc("""
             Looking for pipeline 'master' for project id 123 ...
@@ -368,8 +706,7 @@ class TriggerTest(unittest.TestCase):
 
         self.assertEqual(temp_stdout.getvalue().strip(), expected_output)
 
-    @mock.patch('gitlab.Gitlab')
-    def test_trigger_with_retry_outdated(self, mock_get_gitlab):
+    def test_trigger_with_retry_outdated(self):
         """
         Tests retrying an outdated pipeline - we're retrying a pipeline
         but the tip of the branch has a new revision (different from
@@ -381,7 +718,6 @@ class TriggerTest(unittest.TestCase):
 
         temp_stdout = self.run_trigger(
             cmd_args,
-            mock_get_gitlab,
             some_auto_pipeline_behavior(trigger.STATUS_SUCCESS),
             [
                 mock_get_last_pipeline(
@@ -404,8 +740,7 @@ class TriggerTest(unittest.TestCase):
 
         self.assertEqual(temp_stdout.getvalue().strip(), expected_output)
 
-    @mock.patch('gitlab.Gitlab')
-    def test_trigger_with_retry_succeeded(self, mock_get_gitlab):
+    def test_trigger_with_retry_succeeded(self):
         """
         Tests retrying a successful pipeline. We'll want to create a new
         pipeline in this case. (Otherwise, once successful, jobs configured
@@ -416,7 +751,6 @@ class TriggerTest(unittest.TestCase):
 
         temp_stdout = self.run_trigger(
             cmd_args,
-            mock_get_gitlab,
             some_auto_pipeline_behavior(trigger.STATUS_SUCCESS),
             [
                 mock_get_last_pipeline(
@@ -439,8 +773,7 @@ class TriggerTest(unittest.TestCase):
 
         self.assertEqual(temp_stdout.getvalue().strip(), expected_output)
 
-    @mock.patch('gitlab.Gitlab')
-    def test_trigger_with_retry_pid_only(self, mock_get_gitlab):
+    def test_trigger_with_retry_pid_only(self):
         """
         Tests retrying a pipeline with a give pid (implies --retry).
         """
@@ -450,19 +783,15 @@ class TriggerTest(unittest.TestCase):
 
         temp_stdout = self.run_trigger(
             cmd_args,
-            mock_get_gitlab,
-            some_auto_pipeline_behavior(trigger.STATUS_SUCCESS),
+            # the first response is the initial --pid lookup
+            some_auto_pipeline_behavior(trigger.STATUS_SUCCESS, initial_statuses=('failed',)),
             [
                 mock_get_last_pipeline(
                     proj_id,
                     [dict(id=1, status='success', sha='deadbeef')]
                 ),
                 mock_get_sha(proj_id, dict(id='deadbeef')),
-                mock_get_pipeline(
-                    proj_id,
-                    pipeline_id,
-                    dict(status='failed', sha='deadbeef')
-                )
+                mock_retry_pipeline(proj_id, pipeline_id),
             ],
         )
 
@@ -477,19 +806,19 @@ class TriggerTest(unittest.TestCase):
 
         self.assertEqual(temp_stdout.getvalue().strip(), expected_output)
 
-    @mock.patch('gitlab.Gitlab')
-    def test_trigger_auto_detached(self, mock_get_gitlab):
+    def test_trigger_auto_detached(self):
         """
         Tests retrying a failed pipeline
         """
         project_id = 123
         cmd_args = TriggerTest.COMMON_ARGS + f" --detached {project_id}"
 
-        temp_stdout = self.run_trigger(
-            cmd_args,
-            mock_get_gitlab,
-            some_auto_pipeline_behavior(trigger.STATUS_SUCCESS),
-        )
+        # detached runs do not start an event loop
+        with mock.patch.object(trigger, 'run_coroutine', side_effect=AssertionError('event loop started')):
+            temp_stdout = self.run_trigger(
+                cmd_args,
+                some_auto_pipeline_behavior(trigger.STATUS_SUCCESS),
+            )
 
         expected_output = cleandoc("""
             Triggering pipeline for ref 'master' for project id 123
@@ -499,9 +828,10 @@ class TriggerTest(unittest.TestCase):
         """)
 
         self.assertEqual(expected_output, temp_stdout.getvalue().strip())
+        # the pipeline url comes with the created pipeline, no project lookup needed
+        assert [r.path for r in self.request_history] == ['/api/v4/projects/123/trigger/pipeline']
 
-    @mock.patch('gitlab.Gitlab')
-    def test_trigger_manual_detached(self, mock_get_gitlab):
+    def test_trigger_manual_detached(self):
         """
         Tests retrying a failed pipeline
         """
@@ -510,7 +840,6 @@ class TriggerTest(unittest.TestCase):
 
         temp_stdout = self.run_trigger(
             cmd_args,
-            mock_get_gitlab,
             some_manual_pipeline_behavior(trigger.STATUS_SUCCESS),
         )
 
@@ -525,8 +854,7 @@ class TriggerTest(unittest.TestCase):
 
         self.assertEqual(expected_output, temp_stdout.getvalue().strip())
 
-    @mock.patch('gitlab.Gitlab')
-    def test_trigger_verbose(self, mock_get_gitlab):
+    def test_trigger_verbose(self):
         """
         """
         project_id = 123
@@ -534,13 +862,12 @@ class TriggerTest(unittest.TestCase):
 
         temp_stdout = self.run_trigger(
             cmd_args,
-            mock_get_gitlab,
             some_auto_pipeline_behavior(trigger.STATUS_SUCCESS),
         )
 
         expected_output = cleandoc("""
             Triggering pipeline for ref 'master' for project id 123
-            Response create_pipeline: {"id": "1"}
+            Response create_pipeline: {"id": "1", "web_url": "https://example.com/project1/pipelines/1"}
             Pipeline created (id: 1)
             See pipeline at https://example.com/project1/pipelines/1
             Waiting for pipeline 1 to finish ...
@@ -550,9 +877,618 @@ class TriggerTest(unittest.TestCase):
 
         self.assertEqual(expected_output, temp_stdout.getvalue().strip())
 
+    def test_parse_target(self):
+        target = trigger.Target.parse('456', 'master', 'ptok')
+        assert (target.project_id, target.ref, target.pipeline_token) == ('456', 'master', 'ptok')
+        target = trigger.Target.parse('group/proj:develop', 'master', 'ptok')
+        assert (target.project_id, target.ref, target.pipeline_token) == ('group/proj', 'develop', 'ptok')
+        target = trigger.Target.parse('456::other', 'master', 'ptok')
+        assert (target.project_id, target.ref, target.pipeline_token) == ('456', 'master', 'other')
+        args = trigger.parse_args((TriggerTest.COMMON_ARGS + " --pid 7 --target 456 123").split(' '))
+        with self.assertRaisesRegex(AssertionError, 'multiple targets'):
+            trigger.validate_args(args)
+
+    def test_trigger_multiple_targets(self):
+        temp_stdout = StringIO()
+        cmd_args = TriggerTest.COMMON_ARGS + " --target 456:develop:other_token 123"
+        with contextlib.redirect_stdout(temp_stdout), self.assertRaises(trigger.PipelineFailure) as context, requests_mock.Mocker() as m:
+            m.post(f"https://{GITLAB_HOST}/api/v4/projects/123/trigger/pipeline", text='{"id": "1"}', status_code=201)
+            m.post(f"https://{GITLAB_HOST}/api/v4/projects/456/trigger/pipeline", text='{"id": "2"}', status_code=201)
+            mock_pipeline_statuses(m, some_auto_pipeline_behavior(trigger.STATUS_SUCCESS))
+            m.get(
+                f"https://{GITLAB_HOST}/api/v4/projects/456/pipelines/2",
+                json=dict(id=2, status=trigger.STATUS_FAILED, web_url=f"https://{GITLAB_HOST}/project2/pipelines/2")
+            )
+            trigger.trigger(cmd_args.split(' '))
+
+        assert context.exception.return_code == 1
+        assert context.exception.pipeline_id == '2'
+        created = [r for r in m.request_history if r.method == 'POST']
+        assert sorted(r.text for r in created) == ['token=other_token&ref=develop', 'token=trigger_token&ref=master']
+        output = temp_stdout.getvalue()
+        assert 'Waiting for 2 pipelines to finish ...' in output
+        assert "Pipeline failed! Check details at 'https://example.com/project2/pipelines/2'" in output
+        table = output.strip().splitlines()[-3:]
+        assert table == [
+            'PROJECT  REF      PIPELINE  STATUS   RESULT',
+            '123      master   1         success  0',
+            '456      develop  2         failed   1',
+        ]
+
+    def test_trigger_multiple_targets_play_failure(self):
+        temp_stdout = StringIO()
+        cmd_args = TriggerTest.COMMON_ARGS + " --on-manual play --target 456 123"
+        with contextlib.redirect_stdout(temp_stdout), requests_mock.Mocker() as m:
+            mock_create_pipeline(m)
+            mock_pipeline_statuses(m, dict(statuses=[trigger.STATUS_MANUAL, trigger.STATUS_MANUAL, trigger.STATUS_SUCCESS]))
+            mock_pipeline_jobs(m, dict(jobs=some_manual_jobs()))
+            m.get(f"https://{GITLAB_HOST}/api/v4/projects/123/pipelines/1/jobs", [
+                dict(status_code=502), dict(json=some_manual_jobs())])
+            mock_create_pipeline(m, project_id=456, pipeline_id=2)
+            mock_pipeline_statuses(m, some_auto_pipeline_behavior(trigger.STATUS_SUCCESS), project_id=456, pipeline_id=2)
+            assert trigger.trigger(cmd_args.split(' ')) == ['1', '2']
+        output = temp_stdout.getvalue()
+        assert 'Refreshing pipeline 1 failed: expected status code 200, was 502' in output
+        assert output.strip().splitlines()[-2:] == [
+            '123      master  1         success  0',
+            '456      master  2         success  0',
+        ]
+
+    def test_trigger_service(self):
+        service = trigger.TriggerService(max_workers=2)
+        server = trigger.make_service_server(service, listen='127.0.0.1:0')
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        service_url = 'http://127.0.0.1:%d/triggers' % server.server_address[1]
+
+        def call(url, body=None):
+            data = json.dumps(body).encode('utf-8') if body is not None else None
+            try:
+                with urllib.request.urlopen(url, data=data) as r:
+                    return r.status, json.loads(r.read())
+            except urllib.error.HTTPError as e:
+                return e.code, json.loads(e.read())
+
+        temp_stdout = StringIO()
+        try:
+            with contextlib.redirect_stdout(temp_stdout), contextlib.redirect_stderr(StringIO()), requests_mock.Mocker() as m:
+                m.post(f"https://{GITLAB_HOST}/api/v4/projects/123/trigger/pipeline", text='{"id": "1"}', status_code=201)
+                mock_pipeline_statuses(m, some_auto_pipeline_behavior(trigger.STATUS_SUCCESS))
+
+                status, job = call(service_url, dict(args=(TriggerTest.COMMON_ARGS + " --sleep 1 123").split(' ')))
+                assert status == 202 and job['id'] == 1 and job['finished'] is False
+
+                status, job = call(f"{service_url}/1/wait?timeout=10")
+                assert status == 200
+                assert job['finished'] and job['return_code'] == 0
+                assert (job['pipeline_id'], job['status']) == ('1', trigger.STATUS_SUCCESS)
+                for timeout in ('abc', 'inf', '-1'):
+                    assert call(f"{service_url}/1/wait?timeout={timeout}") == (400, dict(error='timeout must be a number of seconds'))
+
+                status, jobs = call(service_url)
+                assert status == 200 and [j['id'] for j in jobs] == [1]
+                assert call(f"{service_url}/2")[0] == 404
+                with urllib.request.urlopen(service_url.replace('/triggers', '/metrics')) as r:
+                    assert r.headers['Content-Type'].startswith('application/openmetrics-text')
+                    assert b'trigger_results_total{return_code="0"}' in r.read()
+                assert call(service_url, dict(args=['--pid'])) == (400, dict(error='invalid trigger arguments'))
+        finally:
+            server.shutdown()
+            server.server_close()
+            service.shutdown()
+        assert 'Pipeline succeeded' in temp_stdout.getvalue()
+
+    def test_trigger_service_failures(self):
+        service = trigger.TriggerService(max_workers=2, max_finished=1)
+
+        def run(project_id, extra_args=''):
+            job = service.submit((TriggerTest.COMMON_ARGS + f" {extra_args} {project_id}").split())
+            return service.wait(job.id, timeout=10)
+
+        temp_stdout = StringIO()
+        try:
+            with contextlib.redirect_stdout(temp_stdout), requests_mock.Mocker() as m, mock.patch.object(trigger.BatchPoller, 'max_retries', 0):
+                api = f"https://{GITLAB_HOST}/api/v4/projects"
+                m.post(f"{api}/123/trigger/pipeline", status_code=500)
+                for project_id in (456, 789, 321, 654):
+                    mock_create_pipeline(m, project_id=project_id)
+                m.get(f"{api}/789/pipelines/1", status_code=500)
+                mock_pipeline_statuses(m, some_auto_pipeline_behavior(trigger.STATUS_FAILED, initial_statuses=()), project_id=321)
+                mock_pipeline_statuses(m, some_auto_pipeline_behavior(trigger.STATUS_SUCCESS, initial_statuses=()), project_id=654)
+                m.get(f"{api}/654/pipelines/1/jobs", status_code=502)
+                mock_create_pipeline(m, project_id=987)
+                mock_pipeline_statuses(m, some_auto_pipeline_behavior('running'), project_id=987)
+
+                created = run(123)
+                assert created.target.return_code == 1
+                assert created.error == 'Failed to create pipeline, api returned status code 500'
+                detached = run(456, '-d')
+                assert detached.target.return_code == 0
+                # only the latest finished request is kept
+                assert service.get(created.id) is None and service.get(detached.id) is detached
+
+                polled = run(789)
+                assert polled.target.return_code == 2 and polled.error == 'polling failed 1 consecutive times'
+                failed = run(321)
+                assert (failed.target.return_code, failed.error) == (1, None)
+                output = run(654, '-o')
+                assert output.target.return_code == 1 and 'was 502' in output.error
+
+                timed_out = run(987, '--timeout 0.5')
+                assert (timed_out.target.return_code, timed_out.error) == (3, 'timed out after 0.5 seconds')
+
+                for extra_args in ('--fail-fast', '--cancel-on-fail', '--follow', '--webhook-listen localhost:0'):
+                    with self.assertRaises(AssertionError):
+                        run(456, extra_args)
+        finally:
+            service.shutdown()
+        assert "Pipeline failed! Check details at 'https://example.com/project1'" in temp_stdout.getvalue()
+
+    def test_trigger_service_shared_pipeline(self):
+        service = trigger.TriggerService(max_workers=2)
+        started = monotonic()
+
+        def pipeline(request, context):
+            status = trigger.STATUS_SUCCESS if monotonic() - started > 2 else 'running'
+            return dict(id=1, status=status, web_url=f"https://{GITLAB_HOST}/project1")
+
+        try:
+            with contextlib.redirect_stdout(StringIO()), requests_mock.Mocker() as m:
+                mock_create_pipeline(m)
+                m.get(f"https://{GITLAB_HOST}/api/v4/projects/123/pipelines/1", json=pipeline)
+                # both requests wait on pipeline 1, the first one gives up early
+                timed_out = service.submit((TriggerTest.COMMON_ARGS + " --timeout 1 123").split())
+                waiting = service.submit((TriggerTest.COMMON_ARGS + " 123").split())
+                assert service.wait(timed_out.id, timeout=10).target.return_code == 3
+                assert service.wait(waiting.id, timeout=10).target.return_code == 0
+        finally:
+            service.shutdown()
+        assert service.waiters == {} and service.poller.groups == {}
+
+    def test_serve(self):
+        servers = []
+
+        def make_service_server(*args, **kwargs):
+            servers.append(make_server(*args, **kwargs))
+            return servers[-1]
+
+        def request(socket_path, method, path, body=b''):
+            with socket.socket(socket.AF_UNIX) as sock:
+                sock.connect(socket_path)
+                sock.sendall(f'{method} {path} HTTP/1.0\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body)
+                response = b''.join(iter(lambda: sock.recv(4096), b''))
+            head, _, data = response.partition(b'\r\n\r\n')
+            return int(head.split()[1]), json.loads(data)
+
+        make_server = trigger.make_service_server
+        temp_stdout = StringIO()
+        patch_server = mock.patch('trigger.make_service_server', make_service_server)
+        with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(temp_stdout), patch_server:
+            socket_path = os.path.join(tmp, 'trigger.sock')
+            # a stale socket file of an earlier run is replaced
+            open(socket_path, 'w').close()
+            thread = threading.Thread(target=trigger.serve, args=(['--socket', socket_path, '--max-workers', '2'],), daemon=True)
+            thread.start()
+            while not servers:
+                sleep(0.05)
+            try:
+                assert request(socket_path, 'POST', '/other') == (404, dict(error='not found'))
+                args = (TriggerTest.COMMON_ARGS + " --target 456 123").split(' ')
+                status = request(socket_path, 'POST', '/triggers', json.dumps(dict(args=args)).encode())
+                assert status == (400, dict(error='submit one request per target'))
+                assert request(socket_path, 'GET', '/triggers/1/other') == (404, dict(error='not found'))
+                assert request(socket_path, 'GET', '/triggers') == (200, [])
+            finally:
+                servers[0].shutdown()
+                thread.join(10)
+        assert not thread.is_alive()
+        assert f'Accepting trigger requests on {socket_path}' in temp_stdout.getvalue()
+
+    def test_trigger_metrics_file(self):
+        with tempfile.TemporaryDirectory() as tmp, mock.patch('trigger.metrics', trigger.Metrics()):
+            path = os.path.join(tmp, 'trigger.prom')
+            cmd_args = TriggerTest.COMMON_ARGS + f" --metrics-file {path} 123"
+            self.run_trigger(cmd_args, some_auto_pipeline_behavior(trigger.STATUS_SUCCESS))
+            with open(path) as f:
+                lines = f.read().splitlines()
+        assert 'trigger_api_requests_total{code="201",endpoint="create_pipeline"} 1' in lines
+        assert 'trigger_api_requests_total{code="200",endpoint="poll_pipeline"} 2' in lines
+        assert 'trigger_pipelines_started_total{action="create"} 1' in lines
+        assert 'trigger_pipeline_polls_count 1' in lines
+        assert 'trigger_pipeline_polls_sum 2' in lines
+        assert 'trigger_results_total{return_code="0"} 1' in lines
+        assert '# TYPE trigger_api_request_duration_seconds histogram' in lines
+        assert lines[-1] == '# EOF'
+
+    def test_pipeline_timing(self):
+        def job(id, name, stage, started, finished, **extra):
+            return dict(id=id, name=name, stage=stage, status='success',
+                        started_at=f'2019-08-01T12:00:{started:02d}Z', finished_at=f'2019-08-01T12:00:{finished:02d}Z', **extra)
+
+        pipeline = dict(id=1, status='success', created_at='2019-08-01T12:00:00Z')
+        jobs = [
+            job(3, 'test 1', 'test', 15, 40, queued_duration=5.0),
+            job(2, 'test 2', 'test', 12, 20),
+            job(1, 'build', 'build', 2, 10),
+            dict(id=4, name='deploy', stage='deploy', status='manual', started_at=None, finished_at=None),
+        ]
+        timing = trigger.pipeline_timing(pipeline, jobs)
+        assert timing['duration'] == 40
+        assert timing['critical_path'] == [1, 3]
+        assert (timing['critical_path_queued'], timing['critical_path_run']) == (7, 33)
+        assert [(j['name'], j['queued'], j['run'], j['critical']) for j in timing['jobs']] == [
+            ('build', 2, 8, True), ('test 2', None, 8, False), ('test 1', 5, 25, True)]
+        assert timing['stages'] == [
+            dict(name='build', start=2, end=10, duration=8, jobs=1),
+            dict(name='test', start=12, end=40, duration=28, jobs=2),
+        ]
+
+        temp_stdout = StringIO()
+        with contextlib.redirect_stdout(temp_stdout):
+            trigger.print_timing_report(timing)
+        self.assertEqual(temp_stdout.getvalue().strip(), cleandoc("""
+            Pipeline 1 timing (40s):
+            JOB     STAGE  QUEUED  RUN  START  END  CRITICAL
+            build   build  2s      8s   2s     10s  *
+            test 2  test   -       8s   12s    20s
+            test 1  test   5s      25s  15s    40s  *
+            Stage build: 2s - 10s (1 jobs)
+            Stage test: 12s - 40s (2 jobs)
+            Critical path: 2 jobs, 7s queued, 33s running (job execution dominates)
+        """))
+
+    def test_trigger_timing_json(self):
+        behavior = some_auto_pipeline_behavior(trigger.STATUS_SUCCESS)
+        behavior['jobs'] = [dict(id=1, name='build', stage='build', status='success',
+                                 started_at='2019-08-01T12:00:02Z', finished_at='2019-08-01T12:00:10Z')]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'timing.jsonl')
+            self.run_trigger(TriggerTest.COMMON_ARGS + f" --timing-json {path} 123", behavior)
+            with open(path) as f:
+                timing = [json.loads(line) for line in f]
+        assert [t['critical_path'] for t in timing] == [[1]]
+        assert timing[0]['jobs'][0]['run'] == 8
+
+    def test_trigger_timeout(self):
+        api = f"https://{GITLAB_HOST}/api/v4/projects/123"
+        temp_stdout = StringIO()
+        cmd_args = TriggerTest.COMMON_ARGS + " --connect-timeout 2 --read-timeout 5 --timeout 1.5 --cancel-on-timeout 123"
+        started = monotonic()
+        with contextlib.redirect_stdout(temp_stdout), self.assertRaises(trigger.PipelineFailure) as context, requests_mock.Mocker() as m:
+            mock_create_pipeline(m)
+            mock_pipeline_statuses(m, some_auto_pipeline_behavior('running'))
+            cancel = m.post(f"{api}/pipelines/1/cancel", json=dict(id=1, status='canceled'))
+            try:
+                trigger.trigger(cmd_args.split(' '))
+            finally:
+                trigger.configure_http()
+        assert context.exception.return_code == 3
+        # the last sleep was shortened to the remaining budget
+        assert 1.5 <= monotonic() - started < 2.5
+        assert 'Timed out after 1.5 seconds waiting for pipeline 1\nCancelled pipeline 1' in temp_stdout.getvalue()
+        assert cancel.call_count == 1
+        # creating and cancelling the pipeline are not limited by the budget, the polls are
+        assert all(r.timeout == (2, 5) for r in m.request_history if r.method == 'POST')
+        assert all(0 < connect <= read <= 1.5 for connect, read in (r.timeout for r in m.request_history if r.method == 'GET'))
+
+    def test_trigger_timeout_while_polling_fails(self):
+        api = f"https://{GITLAB_HOST}/api/v4/projects/123"
+        temp_stdout = StringIO()
+        started = monotonic()
+        with contextlib.redirect_stdout(temp_stdout), self.assertRaises(trigger.PipelineFailure) as context, requests_mock.Mocker() as m:
+            mock_create_pipeline(m)
+            m.get(f"{api}/pipelines/1", status_code=500)
+            cancel = m.post(f"{api}/pipelines/1/cancel", json=dict(id=1, status='canceled'))
+            trigger.trigger((TriggerTest.COMMON_ARGS + " --timeout 1.5 --cancel-on-timeout 123").split(' '))
+        assert context.exception.return_code == 3
+        # the back-off between failed polls was shortened to the remaining budget
+        assert 1.5 <= monotonic() - started < 2.5
+        assert 'Polling for status failed' in temp_stdout.getvalue()
+        assert 'Timed out after 1.5 seconds waiting for pipeline 1\nCancelled pipeline 1' in temp_stdout.getvalue()
+        assert cancel.call_count == 1
+
+    def test_trigger_multiple_targets_timeout(self):
+        temp_stdout = StringIO()
+        cmd_args = TriggerTest.COMMON_ARGS + " --timeout 1.5 --target 456 123"
+        with contextlib.redirect_stdout(temp_stdout), self.assertRaises(trigger.PipelineFailure) as context, requests_mock.Mocker() as m:
+            mock_create_pipeline(m)
+            mock_pipeline_statuses(m, some_auto_pipeline_behavior(trigger.STATUS_SUCCESS, initial_statuses=()))
+            mock_create_pipeline(m, project_id=456, pipeline_id=2)
+            mock_pipeline_statuses(m, some_auto_pipeline_behavior('running'), project_id=456, pipeline_id=2)
+            trigger.trigger(cmd_args.split(' '))
+        assert (context.exception.return_code, context.exception.pipeline_id) == (3, '2')
+        output = temp_stdout.getvalue()
+        assert 'Timed out after 1.5 seconds waiting for pipeline 2' in output
+        assert output.strip().splitlines()[-2:] == [
+            '123      master  1         success  0',
+            '456      master  2         running  3',
+        ]
+
+    def test_trigger_fail_fast(self):
+        api = f"https://{GITLAB_HOST}/api/v4/projects/123"
+        temp_stdout = StringIO()
+        with contextlib.redirect_stdout(temp_stdout), self.assertRaises(trigger.PipelineFailure), requests_mock.Mocker() as m:
+            mock_create_pipeline(m)
+            mock_pipeline_statuses(m, some_auto_pipeline_behavior(trigger.STATUS_FAILED, initial_statuses=['running'] * 3))
+            m.get(f"{api}/pipelines/1/jobs", [
+                dict(json=[dict(id=1, name='lint', status='failed', allow_failure=True), dict(id=2, name='test', status='running')]),
+                dict(json=[dict(id=1, name='lint', status='failed', allow_failure=True), dict(id=2, name='test', status='failed')]),
+            ])
+            cancel = m.post(f"{api}/pipelines/1/cancel", json=dict(id=1, status='canceled'))
+            trigger.trigger((TriggerTest.COMMON_ARGS + " --cancel-on-fail 123").split(' '))
+        assert 'Failing fast, job test failed\nCancelled pipeline 1' in temp_stdout.getvalue()
+        assert cancel.call_count == 1
+        # stopped polling well before the pipeline finished
+        assert sum(r.url == f"{api}/pipelines/1" for r in m.request_history) == 2
+
+    def test_trigger_fail_fast_jobs_failure(self):
+        api = f"https://{GITLAB_HOST}/api/v4/projects/123"
+        temp_stdout = StringIO()
+        with contextlib.redirect_stdout(temp_stdout), self.assertRaises(trigger.PipelineFailure), requests_mock.Mocker() as m:
+            mock_create_pipeline(m)
+            mock_pipeline_statuses(m, some_auto_pipeline_behavior(trigger.STATUS_FAILED, initial_statuses=['running'] * 3))
+            m.get(f"{api}/pipelines/1/jobs", [
+                dict(status_code=502),
+                dict(json=[dict(id=2, name='test', status='failed')]),
+            ])
+            trigger.trigger((TriggerTest.COMMON_ARGS + " --fail-fast 123").split(' '))
+        assert '\nChecking jobs for failures failed: ' in temp_stdout.getvalue()
+        assert 'Failing fast, job test failed' in temp_stdout.getvalue()
+        assert sum(r.url == f"{api}/pipelines/1" for r in m.request_history) == 2
+
+    def test_async_api(self):
+        requests = [
+            trigger.TriggerRequest(123, 'master', 'trigger_token', host=GITLAB_HOST, api_token='api_token', sleep=1),
+            trigger.TriggerRequest(456, 'master', 'trigger_token', host=GITLAB_HOST, api_token='api_token', sleep=1,
+                                   env=dict(FOO='bar')),
+        ]
+        assert requests[1].variables == {'variables[FOO]': 'bar'}
+
+        async def run_all():
+            results = []
+            for result in trigger.as_completed(requests):
+                try:
+                    results.append(await result)
+                except trigger.PipelineFailure as e:
+                    results.append(e.pipeline_id)
+            return results
+
+        with contextlib.redirect_stdout(StringIO()), requests_mock.Mocker() as m:
+            mock_create_pipeline(m)
+            mock_pipeline_statuses(m, some_auto_pipeline_behavior(trigger.STATUS_SUCCESS))
+            mock_create_pipeline(m, project_id=456, pipeline_id=2)
+            mock_pipeline_statuses(m, some_auto_pipeline_behavior(trigger.STATUS_FAILED, initial_statuses=()), project_id=456, pipeline_id=2)
+            results = trigger.run_coroutine(run_all())
+        # the failing pipeline finished first, without waiting for the other one
+        assert [str(pid) for pid in results] == ['2', '1']
+        assert [r.pid for r in requests] == ['1', '2']
+
+        detached = trigger.TriggerRequest(123, 'master', 'trigger_token', host=GITLAB_HOST, detached=True)
+        with contextlib.redirect_stdout(StringIO()), requests_mock.Mocker() as m:
+            mock_create_pipeline(m)
+            assert trigger.run_coroutine(trigger.run_async(detached)) == '1'
+        assert [r.method for r in m.request_history] == ['POST']
+        with pytest.raises(AssertionError):
+            trigger.TriggerRequest(123, 'master', 'trigger_token', no_such_option=True)
+        with pytest.raises(AssertionError):
+            trigger.TriggerRequest(123, 'master', 'trigger_token', target=['456'])
+
+    def test_trigger_manifest(self):
+        manifest = dict(
+            concurrency=2,
+            defaults=['-h', GITLAB_HOST, '-a', '$MANIFEST_API_TOKEN', '-p', 'trigger_token', '-t', 'master', '--sleep', '1'],
+            nodes=collections.OrderedDict([
+                ('deploy', dict(args=['789'], needs=['test'])),
+                ('build', dict(args=['123'])),
+                ('test', dict(args=['-e', 'BUILD={build.pid}@{build.sha}', '456'], needs=['build'])),
+                ('lint', dict(args=['123'])),
+            ]),
+        )
+        temp_stdout = StringIO()
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.dict(os.environ, MANIFEST_API_TOKEN='api_token'):
+            path = os.path.join(tmp, 'manifest.json')
+            with open(path, 'w') as f:
+                json.dump(manifest, f)
+            with contextlib.redirect_stdout(temp_stdout), requests_mock.Mocker() as m:
+                mock_create_pipeline(m)
+                mock_pipeline_statuses(m, some_auto_pipeline_behavior(trigger.STATUS_SUCCESS))
+                mock_create_pipeline(m, project_id=456, pipeline_id=2)
+                mock_pipeline_statuses(m, some_auto_pipeline_behavior(trigger.STATUS_FAILED), project_id=456, pipeline_id=2)
+                with self.assertRaises(trigger.PipelineFailure) as context:
+                    trigger.trigger_manifest([path])
+        assert context.exception.pipeline_id == '2'
+        creates = [r for r in m.request_history if r.method == 'POST']
+        assert creates[-1].url.endswith('/456/trigger/pipeline')
+        assert 'variables%5BBUILD%5D=1%40deadbeef' in creates[-1].text
+        assert all(r.headers.get('PRIVATE-TOKEN') == 'api_token' for r in m.request_history if r.method == 'GET')
+        assert '789' not in ''.join(r.url for r in m.request_history)
+        assert cleandoc("""
+            NODE    PROJECT  REF     PIPELINE  STATUS   RESULT
+            build   123      master  1         success  0
+            test    456      master  2         failed   1
+            deploy  -        -       -         -        skipped
+            lint    123      master  1         success  0
+            """) in temp_stdout.getvalue()
+
+        with self.assertRaisesRegex(AssertionError, 'dependency cycle'):
+            trigger.parse_manifest(dict(nodes=dict(
+                a=dict(args=['-p', 't', '-t', 'master', '1'], needs=['b']),
+                b=dict(args=['-p', 't', '-t', 'master', '2'], needs=['a']),
+            )))
+        with self.assertRaisesRegex(AssertionError, 'without needing it'):
+            trigger.parse_manifest(dict(nodes=dict(
+                a=dict(args=['-p', 't', '-t', 'master', '1']),
+                b=dict(args=['-p', 't', '-t', 'master', '-e', 'A={a.pid}', '2']),
+            )))
+        with self.assertRaisesRegex(AssertionError, 'one node per target'):
+            trigger.parse_manifest(dict(nodes=dict(a=dict(args=['-p', 't', '-t', 'master', '--target', '2', '1']))))
+
+    def test_trigger_resume(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cmd_args = TriggerTest.COMMON_ARGS + f" --resume-key 42-deploy --resume-dir {tmp} 123"
+            # the first run was interrupted while waiting
+            self.run_trigger(cmd_args.replace('--resume-key', '-d --resume-key'), some_auto_pipeline_behavior(trigger.STATUS_SUCCESS))
+            assert len(os.listdir(tmp)) == 1
+
+            temp_stdout = self.run_trigger(cmd_args, some_auto_pipeline_behavior(trigger.STATUS_SUCCESS))
+            assert "Resuming pipeline 1 with status 'running'" in temp_stdout.getvalue()
+            assert not any(r.method == 'POST' for r in self.request_history)
+            # the finished pipeline is not resumed again
+            assert os.listdir(tmp) == []
+
+            self.run_trigger(cmd_args, some_auto_pipeline_behavior(trigger.STATUS_SUCCESS))
+            assert any(r.method == 'POST' for r in self.request_history)
+
+    def test_trigger_reuse(self):
+        api = f"https://{GITLAB_HOST}/api/v4/projects/123"
+
+        def mock_reusable_pipelines(m):
+            m.get(f"{api}/pipelines?ref=master&sha=deadbeef&source=trigger", json=[
+                dict(id=5, status='running', sha='deadbeef', source='push'),
+                dict(id=4, status='failed', sha='deadbeef', source='trigger'),
+                dict(id=3, status='running', sha='deadbeef', source='trigger'),
+                dict(id=1, status='success', sha='deadbeef', source='trigger'),
+            ])
+            m.get(f"{api}/pipelines/3/variables", json=[dict(key='FOO', value='baz')])
+            m.get(f"{api}/pipelines/1/variables", json=[dict(key='FOO', value='bar')])
+
+        temp_stdout = self.run_trigger(TriggerTest.COMMON_ARGS + " --reuse -e FOO=bar 123",
+                                       some_auto_pipeline_behavior(trigger.STATUS_SUCCESS, initial_statuses=()),
+                                       [mock_get_sha(123, dict(id='deadbeef')), mock_reusable_pipelines])
+        assert 'Reusing pipeline 1 for sha deadbe with the same variables, it succeeded' in temp_stdout.getvalue()
+        assert not any(r.method == 'POST' for r in self.request_history)
+        assert not any(r.url.endswith(('/pipelines/4/variables', '/pipelines/5/variables')) for r in self.request_history)
+        # the lock of the fingerprint is dropped once released
+        assert trigger.reuse_locks == {}
+
+    def test_reuse_lock(self):
+        fingerprint = ('https://xxx', 'master', 'deadbeef', ())
+        held, release = threading.Event(), threading.Event()
+        order = []
+
+        def first():
+            with trigger.reuse_lock(fingerprint):
+                held.set()
+                release.wait(5)
+                order.append('first')
+
+        def second():
+            with trigger.reuse_lock(fingerprint):
+                order.append('second')
+
+        threads = [threading.Thread(target=first), threading.Thread(target=second)]
+        threads[0].start()
+        held.wait(5)
+        threads[1].start()
+        while trigger.reuse_locks[fingerprint][1] < 2:
+            sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        assert order == ['first', 'second']
+        assert trigger.reuse_locks == {}
+
+    def test_cancel_superseded(self):
+        api = f"https://{GITLAB_HOST}/api/v4/projects/123"
+        args = trigger.parse_args((TriggerTest.COMMON_ARGS + " --cancel-superseded 123").split(' '))
+        with contextlib.redirect_stdout(StringIO()), requests_mock.Mocker() as m:
+            m.get(f"{api}/pipelines?scope=running", json=[
+                dict(id=10, sha='new', source='trigger'),
+                dict(id=8, sha='old', source='trigger'),
+                dict(id=7, sha='new', source='trigger'),
+                dict(id=6, sha='old', source='push'),
+            ])
+            m.get(f"{api}/pipelines?scope=pending", json=[dict(id=5, sha='older')])
+            m.post(f"{api}/pipelines/8/cancel", json=dict(id=8, status='canceled'))
+            m.post(f"{api}/pipelines/5/cancel", status_code=403)
+            cancelled = trigger.cancel_superseded(args, api, 'master', 10, 'new')
+        assert cancelled == [8]
+        assert all('source=trigger' in r.url for r in m.request_history if r.method == 'GET')
+
+    def test_trigger_downstream(self):
+        def bridge(name, pid, project_id, status):
+            return dict(name=name, downstream_pipeline=dict(id=pid, project_id=project_id, status=status,
+                                                            web_url=f"https://{GITLAB_HOST}/{project_id}/pipelines/{pid}"))
+
+        def mock_downstream(m):
+            api = f"https://{GITLAB_HOST}/api/v4/projects"
+            m.get(f"{api}/123/pipelines/1/bridges", [
+                dict(json=[bridge('child', 2, 123, 'running'), bridge('deploy', 5, 456, 'running'), dict(name='later')]),
+                dict(json=[bridge('child', 2, 123, 'success'), bridge('deploy', 5, 456, 'success'), dict(name='later')]),
+            ])
+            m.get(f"{api}/123/pipelines/2/bridges", json=[])
+            m.get(f"{api}/456/pipelines/5/bridges", json=[bridge('e2e', 7, 789, 'failed')])
+            m.get(f"{api}/789/pipelines/7/bridges", json=[])
+            for project_id, pid in [(123, 2), (456, 5), (789, 7)]:
+                job_id = project_id + pid
+                m.get(f"{api}/{project_id}/pipelines/{pid}/jobs", json=[dict(id=job_id, name=f'job{pid}')])
+                m.get(f"{api}/{project_id}/jobs/{job_id}/trace", text=f'trace of job{pid}')
+
+        temp_stdout = StringIO()
+        with contextlib.redirect_stdout(temp_stdout), self.assertRaises(trigger.PipelineFailure), requests_mock.Mocker() as m:
+            mock_create_pipeline(m)
+            mock_pipeline_statuses(m, some_auto_pipeline_behavior(trigger.STATUS_SUCCESS))
+            mock_pipeline_jobs(m, dict())
+            mock_downstream(m)
+            trigger.trigger((TriggerTest.COMMON_ARGS + " --downstream -o 123").split(' '))
+        output = temp_stdout.getvalue()
+        assert f"Downstream pipeline 7 (e2e) failed: https://{GITLAB_HOST}/789/pipelines/7" in output
+        assert cleandoc("""
+            Downstream pipelines:
+            1: success
+              2 (child): success
+              5 (deploy): success
+                7 (e2e): failed
+            1 downstream pipelines failed!
+            """) in output
+        assert 'Job: job7\ntrace of job7' in output
+        # the leaves were listed once after they finished, their parents refreshed them
+        bridge_requests = [r.url for r in m.request_history if r.url.endswith('/bridges?per_page=100&page=1')]
+        assert sum('/789/pipelines/7/' in url for url in bridge_requests) == 1
+
+    def test_metrics(self):
+        m = trigger.Metrics()
+        m.pipeline_started('https://xxx', 1, 'retry')
+        m.pipeline_polled('https://xxx', 1)
+        m.pipeline_finished('https://xxx', 1, dict(finished_at='2019-08-01T12:00:00.000Z'))
+        m.inc('trigger_api_requests', endpoint='a"b', code=200)
+        lines = m.render().splitlines()
+        assert 'trigger_pipeline_detection_lag_seconds_bucket{le="300.0"} 0' in lines
+        assert 'trigger_pipeline_detection_lag_seconds_bucket{le="+Inf"} 1' in lines
+        assert 'trigger_api_requests_total{code="200",endpoint="a\\"b"} 1' in lines
+        assert trigger.parse_timestamp('2019-08-01T14:00:00.5+02:00') == 1564660800.5
+        assert trigger.parse_timestamp(None) is None
+
+    def test_trigger_webhook(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            address = '127.0.0.1:%d' % sock.getsockname()[1]
+        cmd_args = TriggerTest.COMMON_ARGS + f" --webhook-listen {address} --webhook-secret s3cret --webhook-fallback-sleep 30 123"
+
+        def post_event():
+            # the first poll reports "running", then the listener falls back to slow polling
+            sleep(0.5)
+            post_webhook(address, 'webhook_pipeline.json', 's3cret')
+
+        threading.Thread(target=post_event, daemon=True).start()
+        started = monotonic()
+        temp_stdout = self.run_trigger(cmd_args, some_auto_pipeline_behavior(trigger.STATUS_SUCCESS))
+        # the event wakes up the poller long before the fallback interval
+        assert monotonic() - started < 30
+
+        expected_output = cleandoc(f"""
+            Triggering pipeline for ref 'master' for project id 123
+            Pipeline created (id: 1)
+            See pipeline at https://example.com/project1/pipelines/1
+            Waiting for pipeline 1 to finish ...
+            Listening for pipeline events on {address}
+            ..
+            Pipeline succeeded
+        """)
+        self.assertEqual(temp_stdout.getvalue().strip(), expected_output)
+
 
 def mock_get_last_pipeline(project_id: int, response: dict, status_code: int = 200):
-    def req_mock(gitlab, mock_request):
+    def req_mock(mock_request):
         mock_request.get(
             f"https://{GITLAB_HOST}/api/v4/projects/{project_id}/pipelines?ref=master&order_by=id&sort=desc",
             text=json.dumps(response),
@@ -563,7 +1499,7 @@ def mock_get_last_pipeline(project_id: int, response: dict, status_code: int = 2
 
 
 def mock_get_sha(project_id: int, response: dict, status_code: int = 200):
-    def req_mock(gitlab, mock_request):
+    def req_mock(mock_request):
         mock_request.get(
             f"https://{GITLAB_HOST}/api/v4/projects/{project_id}/repository/commits/master",
             text=json.dumps(response),
@@ -573,12 +1509,22 @@ def mock_get_sha(project_id: int, response: dict, status_code: int = 200):
     return req_mock
 
 
-def mock_get_pipeline(project_id: int, pipeline_id: int, response: dict, status_code: int = 200):
-    def req_mock(gitlab, mock_request):
-        mock_request.get(
-            f"https://{GITLAB_HOST}/api/v4/projects/{project_id}/pipelines/{pipeline_id}",
-            text=json.dumps(response),
-            status_code=status_code
+def mock_retry_pipeline(project_id: int, pipeline_id: int):
+    def req_mock(mock_request):
+        mock_request.post(
+            f"https://{GITLAB_HOST}/api/v4/projects/{project_id}/pipelines/{pipeline_id}/retry",
+            json=dict(id=pipeline_id, status='pending'),
+            status_code=201
         )
 
     return req_mock
+
+
+def post_webhook(address: str, fixture: str, token: str) -> int:
+    with open(os.path.join(os.path.dirname(__file__), 'tests', fixture), 'rb') as f:
+        request = urllib.request.Request(f'http://{address}/', data=f.read(), headers={'X-Gitlab-Token': token})
+    try:
+        with urllib.request.urlopen(request) as r:
+            return r.status
+    except urllib.error.HTTPError as e:
+        return e.code
@@ -2,20 +2,29 @@
 # %%
 
 import argparse
+import collections
+import contextlib
+import heapq
+import itertools
+import json
+import os
+import re
 import sys
+import threading
 import urllib.parse
-from functools import lru_cache
-from time import sleep
+from functools import lru_cache, partial
+from time import monotonic, sleep, time
 from typing import Dict, List, Optional
 
-import gitlab
-import requests
+# requests is imported where it is used, so that e.g. `--help` or a missing
+# argument do not pay for importing it
 
 STATUS_FAILED = 'failed'
 STATUS_MANUAL = 'manual'
 STATUS_CANCELED = 'canceled'
 STATUS_SUCCESS = 'success'
 STATUS_SKIPPED = 'skipped'
+STATUS_RUNNING = 'running'
 
 ACTION_FAIL = 'fail'
 ACTION_PASS = 'pass'
@@ -30,6 +39,53 @@ finished_states = [
     STATUS_SKIPPED,
 ]
 
+# pipeline states in which a pipeline can not be reused, see `find_reusable_pipeline`
+unreusable_states = [
+    STATUS_FAILED,
+    STATUS_CANCELED,
+    STATUS_SKIPPED,
+]
+
+# job states after which a job's trace no longer grows
+trace_complete_states = [
+    STATUS_FAILED,
+    STATUS_CANCELED,
+    STATUS_SUCCESS,
+]
+
+TRACE_CHUNK_SIZE = 64 * 1024
+
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_RATE_LIMIT = 10.0
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_READ_TIMEOUT = 60.0
+DEFAULT_SERVICE_LISTEN = '127.0.0.1:8125'
+
+# retries of a request answered with `429 Too Many Requests`
+MAX_RATE_LIMITED_RETRIES = 5
+
+# transport settings shared by all sessions, see `configure_http`
+http_options = dict(
+    pool_size=DEFAULT_POOL_SIZE,
+    rate_limit=DEFAULT_RATE_LIMIT,
+    connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+    read_timeout=DEFAULT_READ_TIMEOUT,
+)
+
+# last (ETag, parsed body) per (api token, url), see `get_json_conditional`
+conditional_cache = {}
+
+# [lock, number of holders and waiters] per pipeline fingerprint, so that identical concurrent requests start a single pipeline
+reuse_locks = {}
+reuse_locks_lock = threading.Lock()
+
+DEFAULT_CACHE_TTL = 24 * 60 * 60
+DEFAULT_CHECKPOINT_TTL = 7 * 24 * 60 * 60
+
+# persistent project metadata cache, see `configure_cache`
+project_cache = None
+
 
 class PipelineFailure(Exception):
     def __init__(self, return_code=None, pipeline_id=None):
@@ -37,14 +93,363 @@ class PipelineFailure(Exception):
         self.pipeline_id = pipeline_id
 
 
+class ProjectCache:
+    """ File based cache of project metadata, safe to share between processes
+
+    Entries are keyed by the project's API url (by id and by path) and stored
+    as one json file per key. Files are replaced atomically, so concurrent
+    readers see either the old or the new entry, never a partial one.
+    """
+
+    def __init__(self, directory, ttl=DEFAULT_CACHE_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        import hashlib
+
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def read(self, key):
+        try:
+            with open(self.path(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def get(self, key) -> Optional[Dict]:
+        entry = self.read(key)
+        if entry is None or time() - entry.get('cached_at', 0) > self.ttl:
+            return None
+        return entry['data']
+
+    def put(self, keys, data):
+        import tempfile
+
+        entry = dict(keys=sorted(set(keys)), cached_at=time(), data=data)
+        for key in entry['keys']:
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(entry, f)
+                os.replace(tmp, self.path(key))
+            except OSError:
+                with contextlib.suppress(OSError):
+                    os.unlink(tmp)
+
+    def invalidate(self, key):
+        entry = self.read(key)
+        for k in (entry or {}).get('keys', [key]):
+            with contextlib.suppress(OSError):
+                os.unlink(self.path(k))
+
+    def invalidate_url(self, url):
+        """ Drop the entry of the project a (404) response url belongs to
+        """
+        parts = urllib.parse.urlsplit(url)
+        segments = parts.path.split('/')
+        for i in range(1, len(segments) + 1):
+            key = f"{parts.scheme}://{parts.netloc}{'/'.join(segments[:i])}"
+            if os.path.exists(self.path(key)):
+                self.invalidate(key)
+
+
+def configure_cache(directory=None, ttl=DEFAULT_CACHE_TTL):
+    """ Enable the persistent project cache in `directory` (or disable it for None)
+    """
+    global project_cache
+    project_cache = ProjectCache(directory, ttl) if directory else None
+
+
+def resume_checkpoints(args) -> Optional[ProjectCache]:
+    """ The store of the pipelines started with `--resume-key`, None when not resuming
+    """
+    if not args.resume_key:
+        return None
+    return ProjectCache(args.resume_dir or os.path.join(args.cache_dir, 'checkpoints'), DEFAULT_CHECKPOINT_TTL)
+
+
+def checkpoint_key(args, project_url, ref):
+    return json.dumps([args.resume_key, project_url, ref])
+
+
+def invalidate_on_not_found(r, *args, **kwargs):
+    if r.status_code == 404 and project_cache is not None:
+        project_cache.invalidate_url(r.url)
+
+
+def configure_http(pool_size=DEFAULT_POOL_SIZE, rate_limit=DEFAULT_RATE_LIMIT,
+                   connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT):
+    """ Update the transport settings, dropping sessions and rate limiters created with the old ones
+    """
+    http_options['connect_timeout'] = connect_timeout
+    http_options['read_timeout'] = read_timeout
+    if http_options['pool_size'] != pool_size:
+        http_options['pool_size'] = pool_size
+        get_session.cache_clear()
+    if http_options['rate_limit'] != rate_limit:
+        http_options['rate_limit'] = rate_limit
+        get_rate_limiter.cache_clear()
+
+
+class RateLimiter:
+    """ Token bucket shared by all requests to one host with one api token
+
+    The bucket refills at `rate` requests per second (no client side limit for
+    0). GitLab's `RateLimit-Remaining` and `RateLimit-Reset` headers lower the
+    rate so the remaining requests are spread until the reset, and a `429`
+    blocks all requests for its `Retry-After` (or until `RateLimit-Reset`).
+    """
+
+    def __init__(self, rate=DEFAULT_RATE_LIMIT):
+        self.max_rate = rate or float('inf')
+        self.rate = self.max_rate
+        self.tokens = max(1.0, rate)
+        self.updated = monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, deadline=None):
+        """ Block until a request may be sent, but not past a `monotonic` deadline
+        """
+        with self.lock:
+            now = monotonic()
+            wait = max(0, self.blocked_until - now)
+            if self.rate != float('inf'):
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                # reserve a token, concurrent callers queue up behind each other
+                self.tokens -= 1
+                wait = max(wait, -self.tokens / self.rate)
+        if deadline is not None:
+            wait = min(wait, remaining(deadline))
+        if wait > 0:
+            sleep(wait)
+
+    def update(self, r):
+        """ Adapt to the rate limit headers of a response
+        """
+        remaining = r.headers.get('RateLimit-Remaining')
+        reset = r.headers.get('RateLimit-Reset')
+        retry_after = r.headers.get('Retry-After')
+        with self.lock:
+            now = monotonic()
+            window = max(1.0, float(reset) - time()) if reset else None
+            if remaining is not None and window is not None:
+                # spread the remaining requests until the reset, leaving some room for other clients
+                self.rate = min(self.max_rate, max(1, int(remaining) - 1) / window)
+            if r.status_code == 429:
+                delay = parse_retry_after(retry_after) if retry_after else window
+                self.blocked_until = max(self.blocked_until, now + (delay if delay is not None else 1))
+
+
+def parse_retry_after(value) -> Optional[float]:
+    """ Parse a `Retry-After` header given in seconds or as an http date
+    """
+    import email.utils
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
 @lru_cache(maxsize=None)
-def get_gitlab(url, api_token, verifyssl):
-    return gitlab.Gitlab(url, private_token=api_token, ssl_verify=verifyssl)
+def get_rate_limiter(host, api_token):
+    return RateLimiter(http_options['rate_limit'])
 
 
 @lru_cache(maxsize=None)
-def get_project(url, api_token, proj_id, verifyssl):
-    return get_gitlab(url, api_token, verifyssl).projects.get(proj_id)
+def get_session(api_token, verifyssl):
+    """ Pooled keep-alive session used by all GitLab API calls
+    """
+    import requests
+    import requests.adapters
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=http_options['pool_size'],
+        pool_maxsize=http_options['pool_size'])
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.verify = verifyssl
+    session.headers['Accept-Encoding'] = 'gzip'
+    session.hooks['response'].append(invalidate_on_not_found)
+    if api_token is not None:
+        session.headers['PRIVATE-TOKEN'] = api_token
+    return session
+
+
+class Metrics:
+    """ Counters and histograms of the trigger and polling behavior
+
+    Rendered in the OpenMetrics text format for `--metrics-file` (e.g. for the
+    node exporter's textfile collector) and `--metrics-listen`/`trigger serve`
+    (`GET /metrics`).
+    """
+
+    # name: (type, help, histogram buckets)
+    definitions = collections.OrderedDict([
+        ('trigger_api_requests', ('counter', 'GitLab API requests by endpoint and status code', None)),
+        ('trigger_api_request_duration_seconds', ('histogram', 'GitLab API request latency by endpoint',
+                                                  (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))),
+        ('trigger_api_rate_limited', ('counter', 'GitLab API requests answered with 429 and retried', None)),
+        ('trigger_pipelines_started', ('counter', 'Pipelines created, retried or reused', None)),
+        ('trigger_poll_failures', ('counter', 'Failed pipeline status polls', None)),
+        ('trigger_pipeline_polls', ('histogram', 'Status polls per pipeline until completion was detected',
+                                    (1, 2, 5, 10, 20, 50, 100, 200, 500))),
+        ('trigger_pipeline_completion_seconds', ('histogram', 'Time from triggering a pipeline until its completion was detected',
+                                                 (10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200))),
+        ('trigger_pipeline_detection_lag_seconds', ('histogram', 'Time from the finished_at of a pipeline until its completion was detected',
+                                                    (0.5, 1, 2, 5, 10, 30, 60, 120, 300))),
+        ('trigger_results', ('counter', 'Trigger results by return code', None)),
+    ])
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = collections.defaultdict(dict)
+        self.pipelines = {}
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self.lock:
+            self.values[name][key] = self.values[name].get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        buckets = self.definitions[name][2]
+        with self.lock:
+            counts, total, count = self.values[name].get(key, ([0] * len(buckets), 0, 0))
+            counts = [c + (value <= bound) for c, bound in zip(counts, buckets)]
+            self.values[name][key] = (counts, total + value, count + 1)
+
+    def pipeline_started(self, project_url, pid, action):
+        self.inc('trigger_pipelines_started', action=action)
+        with self.lock:
+            self.pipelines[(project_url, str(pid))] = dict(started=time(), polls=0)
+
+    def pipeline_polled(self, project_url, pid):
+        with self.lock:
+            state = self.pipelines.get((project_url, str(pid)))
+            if state is not None:
+                state['polls'] += 1
+
+    def pipeline_finished(self, project_url, pid, pipeline):
+        with self.lock:
+            state = self.pipelines.pop((project_url, str(pid)), None)
+        if state is None:
+            return
+        detected = time()
+        self.observe('trigger_pipeline_polls', state['polls'])
+        self.observe('trigger_pipeline_completion_seconds', detected - state['started'])
+        finished_at = parse_timestamp((pipeline or {}).get('finished_at'))
+        if finished_at is not None:
+            self.observe('trigger_pipeline_detection_lag_seconds', max(0.0, detected - finished_at))
+
+    def forget(self, project_url, pid):
+        """ Drop the state of a pipeline that will not be waited on any more
+        """
+        with self.lock:
+            self.pipelines.pop((project_url, str(pid)), None)
+
+    def render(self) -> str:
+        def labels(key, extra=()):
+            pairs = list(key) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join('%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+        lines = []
+        with self.lock:
+            for name, (kind, description, buckets) in self.definitions.items():
+                lines.append(f'# TYPE {name} {kind}')
+                lines.append(f"# HELP {name} {description}")
+                for key, value in sorted(self.values[name].items()):
+                    if kind == 'counter':
+                        lines.append(f'{name}_total{labels(key)} {value}')
+                        continue
+                    counts, total, count = value
+                    for bound, c in zip(buckets, counts):
+                        lines.append(f'{name}_bucket{labels(key, [("le", str(float(bound)))])} {c}')
+                    lines.append(f'{name}_bucket{labels(key, [("le", "+Inf")])} {count}')
+                    lines.append(f'{name}_sum{labels(key)} {total}')
+                    lines.append(f'{name}_count{labels(key)} {count}')
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """ Atomically replace `path` with the rendered metrics
+        """
+        import tempfile
+
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.render())
+            os.replace(tmp, path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+
+# metrics of this process, see `Metrics`
+metrics = Metrics()
+
+METRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+def parse_timestamp(value) -> Optional[float]:
+    """ Parse an ISO 8601 timestamp of the GitLab API into seconds since the epoch
+    """
+    from datetime import datetime
+
+    if not value:
+        return None
+    # python 3.6 does not accept `Z` or a colon in the utc offset
+    value = re.sub(r'([+-]\d\d):(\d\d)$', r'\1\2', re.sub(r'Z$', '+0000', value))
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f%z', '%Y-%m-%dT%H:%M:%S%z'):
+        try:
+            return datetime.strptime(value, fmt).timestamp()
+        except ValueError:
+            pass
+    return None
+
+
+def open_metrics_server(listen):
+    """ Serve the metrics of this process on `HOST:PORT` in a background thread
+    """
+    from http.server import BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') != '/metrics':
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            send_metrics(self)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = make_http_server(listen, Handler)
+    threading.Thread(target=server.serve_forever, name='trigger-metrics', daemon=True).start()
+    return server
+
+
+def send_metrics(handler):
+    data = metrics.render().encode('utf-8')
+    handler.send_response(200)
+    handler.send_header('Content-Type', METRICS_CONTENT_TYPE)
+    handler.send_header('Content-Length', str(len(data)))
+    handler.end_headers()
+    handler.wfile.write(data)
 
 
 def parse_args(args: List[str]):
@@ -53,22 +458,66 @@ def parse_args(args: List[str]):
         add_help=False)
     parser.add_argument(
         '-a', '--api-token', help='personal access token (not required when running detached)')
+    parser.add_argument('--cache-dir', default=os.environ.get('TRIGGER_CACHE_DIR'),
+                        help='directory of a persistent project metadata cache shared between runs (default: $TRIGGER_CACHE_DIR)')
+    parser.add_argument('--cache-ttl', type=int, default=DEFAULT_CACHE_TTL, help='seconds cached project metadata stays valid')
+    parser.add_argument('--cancel-on-fail', action='store_true', default=False,
+                        help='cancel the rest of the pipeline when failing fast (implies --fail-fast)')
+    parser.add_argument('--cancel-on-timeout', action='store_true', default=False, help='cancel the pipeline when --timeout is exceeded')
+    parser.add_argument('--cancel-superseded', action='store_true', default=False,
+                        help='cancel older running or pending trigger pipelines for the same ref with another sha')
+    parser.add_argument('--connect-timeout', type=float, default=DEFAULT_CONNECT_TIMEOUT, help='seconds to wait for a connection to the api')
     parser.add_argument('-d', '--detached', action='store_true', default=False)
+    parser.add_argument('--downstream', action='store_true', default=False,
+                        help='also wait for the child and multi-project pipelines started by bridge jobs, recursively')
     parser.add_argument('-e', '--env', action='append')
+    parser.add_argument('--fail-fast', action='store_true', default=False,
+                        help='fail as soon as a job that is not allowed to fail has failed, instead of waiting for the pipeline to finish')
+    parser.add_argument('--follow', action='store_true', default=False, help='stream the output of running jobs while waiting for the pipeline')
     parser.add_argument('-h', '--host', default='gitlab.com')
     parser.add_argument(
         '--help', action='help', help='show this help message and exit')
-    parser.add_argument('--jobs', help='comma-separated list of manual jobs to run on `--on-manual play`')
+    parser.add_argument('--jobs', help='comma-separated list of manual jobs to run in order on `--on-manual play`, '
+                                       'join jobs with "+" to run them concurrently (e.g. migrate,deploy-eu+deploy-us)')
+    parser.add_argument('--max-workers', type=int, default=8, help='maximum number of targets triggered and polled concurrently')
+    parser.add_argument('--metrics-file', help='write OpenMetrics of the run to this file on exit (e.g. for a textfile collector)')
+    parser.add_argument('--metrics-listen', metavar='HOST:PORT', help='serve OpenMetrics of the run on GET /metrics while it runs')
     parser.add_argument('-o', '--output', action='store_true', default=False, help='Show triggered pipline job output upon completion')
+    parser.add_argument('--output-dir', help='write the job output upon completion to this directory, one file per job')
     parser.add_argument('--on-manual', default=ACTION_FAIL, choices=[ACTION_FAIL, ACTION_PASS, ACTION_PLAY], help='action if "manual" status occurs')
+    parser.add_argument('--pool-size', type=int, default=DEFAULT_POOL_SIZE, help='maximum number of pooled keep-alive connections per host')
     parser.add_argument('-p', '--pipeline-token', required=True, help='pipeline token')
     parser.add_argument('--pid', type=int, default=None, help='optional pipeline id of remote pipeline to be retried (implies -r)')
+    parser.add_argument('--rate-limit', type=float, default=DEFAULT_RATE_LIMIT,
+                        help='maximum number of api requests per second per host and api token (0 for no client side limit)')
+    parser.add_argument('--resume-dir', default=os.environ.get('TRIGGER_RESUME_DIR'),
+                        help='directory of the --resume-key checkpoints (default: $TRIGGER_RESUME_DIR or checkpoints in --cache-dir)')
+    parser.add_argument('--resume-key', help='wait on the pipeline started earlier with the same key, ref and project instead of starting '
+                                             'a new one (e.g. $CI_PIPELINE_ID-$CI_JOB_NAME)')
+    parser.add_argument('--reuse', action='store_true', default=False,
+                        help='reuse a running or successful pipeline for the same sha and variables instead of creating a new one')
+    parser.add_argument('--read-timeout', type=float, default=DEFAULT_READ_TIMEOUT,
+                        help='seconds to wait for the api to send data, per read')
     parser.add_argument('-r', '--retry', action='store_true', default=False, help='retry latest pipeline for given TARGET_REF')
     parser.add_argument('-s', '--sleep', type=int, default=5)
     parser.add_argument('-t', '--target-ref', required=True, help='target ref (branch, tag, commit)')
+    parser.add_argument('--target', action='append', metavar='PROJECT[:REF[:PIPELINE_TOKEN]]',
+                        help='additional project to trigger concurrently, REF and PIPELINE_TOKEN default to -t and -p')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='overall budget in seconds for waiting on the pipeline, exits with return code 3 when exceeded')
+    parser.add_argument('--timing-json', metavar='PATH', help='append the timing report of each finished pipeline to this file as a json line')
+    parser.add_argument('--timing-report', action='store_true', default=False,
+                        help='print the queued and run time of each job, the stages and the critical path of the finished pipeline')
+    parser.add_argument('--trace-gzip', action='store_true', default=False, help='gzip the job output files written to --output-dir')
+    parser.add_argument('--trace-max-bytes', type=int, default=None, help='only keep the first bytes of each job output written to --output-dir')
+    parser.add_argument('--trace-tail', type=int, default=None, help='only keep the last bytes of each job output written to --output-dir')
+    parser.add_argument('--trace-workers', type=int, default=4, help='number of job outputs downloaded concurrently to --output-dir')
     parser.add_argument('-u', '--url-path', default='/api/v4/projects')
     parser.add_argument('-v', '--verifyssl', type=str2bool, default=True, help='Activate the ssl verification, set false for Self-signed certificate')
     parser.add_argument('--verbose', action='store_true', default=False, help='verbose logging of responses')
+    parser.add_argument('--webhook-fallback-sleep', type=int, default=60, help='polling interval in seconds while listening for webhook events')
+    parser.add_argument('--webhook-listen', metavar='HOST:PORT', help='listen for GitLab pipeline/job webhook events to detect completion without polling delay')
+    parser.add_argument('--webhook-secret', help='expected secret token of webhook events')
     parser.add_argument('project_id')
     parsed_args = parser.parse_args(args)
     return parsed_args
@@ -93,117 +542,462 @@ def parse_env(envs: List[str]) -> List[Dict]:
     return res
 
 
-def create_pipeline(project_url, pipeline_token, ref, verifyssl, variables={}, verbose=False) -> Optional[int]:
+def api_request(method, url, api_token, verifyssl, name=None, verbose=False, expected=(200,), deadline=None, **kwargs):
+    """ Send a request to the GitLab API, all API calls of trigger go through here
+
+    Requests are paced by the `RateLimiter` of the host and token, and are
+    retried when GitLab answers `429 Too Many Requests`. Unless given, the
+    connect and read timeouts of `configure_http` apply. With a `monotonic`
+    `deadline` (see `--timeout`) the timeouts, the pacing and the retries stop
+    at the deadline. Prints the response for `verbose` and asserts its status
+    code is one of `expected` (`None` leaves checking the status code to the caller).
+    """
+    endpoint = name or 'other'
+    timeout = kwargs.pop('timeout', (http_options['connect_timeout'], http_options['read_timeout']))
+    limiter = get_rate_limiter(urllib.parse.urlsplit(url).netloc, api_token)
+    for attempt in range(MAX_RATE_LIMITED_RETRIES + 1):
+        limiter.acquire(deadline)
+        started = monotonic()
+        r = get_session(api_token, verifyssl).request(method, url, timeout=limit_timeout(timeout, deadline), **kwargs)
+        metrics.observe('trigger_api_request_duration_seconds', monotonic() - started, endpoint=endpoint)
+        metrics.inc('trigger_api_requests', endpoint=endpoint, code=r.status_code)
+        limiter.update(r)
+        if r.status_code != 429 or attempt == MAX_RATE_LIMITED_RETRIES or remaining(deadline) == 0:
+            break
+        metrics.inc('trigger_api_rate_limited', endpoint=endpoint)
+        r.close()
+    if verbose:
+        print(f'Response {name}: {r.text}')
+    if expected is not None:
+        assert r.status_code in expected, f"expected status code {' or '.join(map(str, expected))}, was {r.status_code}"
+    return r
+
+
+def limit_timeout(timeout, deadline):
+    """ The (connect, read) timeout of a request, shortened to the time left until `deadline`
+    """
+    if deadline is None:
+        return timeout
+    left = remaining(deadline)
+    assert left > 0, 'the time budget (--timeout) is used up'
+    return tuple(min(t, left) for t in (timeout if isinstance(timeout, tuple) else (timeout, timeout)))
+
+
+def create_pipeline(project_url, pipeline_token, ref, verifyssl, variables={}, verbose=False, api_token=None) -> Dict:
+    """ Create a pipeline with a pipeline token, returns the created pipeline
+    """
     data = variables.copy()
     data.update(token=pipeline_token, ref=ref)
-    r = requests.post(
-        f'{project_url}/trigger/pipeline',
-        data=data,
-        verify=verifyssl
-    )
-    if verbose:
-        print(f'Response create_pipeline: {r.text}')
+    r = api_request('POST', f'{project_url}/trigger/pipeline', api_token, verifyssl,
+                    'create_pipeline', verbose, expected=None, data=data)
     assert r.status_code == 201, f'Failed to create pipeline, api returned status code {r.status_code}'
-    pid = r.json().get('id', None)
-    print(f'Pipeline created (id: {pid})')
-    return pid
+    pipeline = r.json()
+    print(f"Pipeline created (id: {pipeline.get('id')})")
+    return pipeline
 
 
-def get_pipeline(project_url, api_token, pid, verifyssl, verbose=False):
-    r = requests.get(
-        f'{project_url}/pipelines/{pid}',
-        headers={
-            'PRIVATE-TOKEN': api_token
-        },
-        verify=verifyssl
-    )
-    if verbose:
-        print(f'Response get_pipeline: {r.text}')
+def get_pipeline(project_url, api_token, pid, verifyssl, verbose=False, deadline=None):
+    return api_request('GET', f'{project_url}/pipelines/{pid}', api_token, verifyssl, 'get_pipeline', verbose, deadline=deadline).json()
+
+
+def retry_pipeline(project_url, api_token, pid, verifyssl, verbose=False):
+    return api_request('POST', f'{project_url}/pipelines/{pid}/retry', api_token, verifyssl,
+                       'retry_pipeline', verbose, expected=(201,)).json()
+
+
+def get_pipeline_variables(project_url, api_token, pid, verifyssl, verbose=False) -> Dict:
+    r = api_request('GET', f'{project_url}/pipelines/{pid}/variables', api_token, verifyssl, 'get_pipeline_variables', verbose)
+    return {v['key']: v['value'] for v in r.json()}
+
+
+def cancel_pipeline(project_url, api_token, pid, verifyssl, verbose=False):
+    return api_request('POST', f'{project_url}/pipelines/{pid}/cancel', api_token, verifyssl,
+                       'cancel_pipeline', verbose).json()
+
+
+def get_json_conditional(url, api_token, verifyssl, name=None, **kwargs):
+    """ GET a json resource, revalidating the last seen ETag via If-None-Match
+
+    Returns the parsed body and whether it changed since the last call. On a
+    `304 Not Modified` the previously parsed body is returned as is.
+    """
+    key = (api_token, url)
+    cached = conditional_cache.get(key)
+    headers = {'If-None-Match': cached[0]} if cached is not None else {}
+    r = api_request('GET', url, api_token, verifyssl, name, expected=None, headers=headers, **kwargs)
+    if r.status_code == 304 and cached is not None:
+        return cached[1], False
     assert r.status_code == 200, f'expected status code 200, was {r.status_code}'
-    return r.json()
+    data = r.json()
+    etag = r.headers.get('ETag')
+    if etag:
+        conditional_cache[key] = (etag, data)
+    else:
+        conditional_cache.pop(key, None)
+    return data, True
+
+
+def forget_conditional(url):
+    """ Drop the revalidation state of a resource that will not be polled again
+    """
+    for key in [key for key in conditional_cache if key[1] == url]:
+        conditional_cache.pop(key, None)
+
+
+def poll_pipeline(project_url, api_token, pid, verifyssl, deadline=None):
+    """ Conditionally fetch a pipeline, returns the pipeline and whether it changed
+    """
+    return get_json_conditional(f'{project_url}/pipelines/{pid}', api_token, verifyssl, 'poll_pipeline', deadline=deadline)
 
 
 def get_last_pipeline(project_url, api_token, ref, verifyssl, verbose=False):
-    r = requests.get(
-        f'{project_url}/pipelines',
-        headers={
-            'PRIVATE-TOKEN': api_token
-        },
-        params=dict(
-            ref=ref,
-            order_by='id',
-            sort='desc'
-        ),
-        verify=verifyssl
-    )
-    if verbose:
-        print(f'Response get_last_pipeline: {r.text}')
-    assert r.status_code == 200, f'expected status code 200, was {r.status_code}'
+    r = api_request('GET', f'{project_url}/pipelines', api_token, verifyssl, 'get_last_pipeline', verbose,
+                    params=dict(
+                        ref=ref,
+                        order_by='id',
+                        sort='desc',
+                        # only the latest pipeline is of interest
+                        per_page=1
+                    ))
     res = r.json()
     assert len(res) > 0, f'expected to find at least one pipeline for ref {ref}'
     return res[0]
 
 
-def get_pipeline_jobs(project_url, api_token, pipeline, verifyssl, verbose=False):
-    r = requests.get(
-        f'{project_url}/pipelines/{pipeline}/jobs',
-        headers={
-            'PRIVATE-TOKEN': api_token
-        },
-        verify=verifyssl
-    )
-    if verbose:
-        print(f'Response get_pipeline_jobs: {r.text}')
-    assert r.status_code == 200, f'expected status code 200, was {r.status_code}'
-    res = r.json()
-    return res
+def list_pipelines(project_url, api_token, verifyssl, deadline=None, **params):
+    """ List the pipelines of a project, returns the page and the number of the next page
+    """
+    r = api_request('GET', f'{project_url}/pipelines', api_token, verifyssl, 'list_pipelines', deadline=deadline, params=params)
+    return r.json(), r.headers.get('X-Next-Page')
+
+
+def get_all_pages(url, api_token, verifyssl, name, verbose=False, deadline=None) -> List[Dict]:
+    """ Get all items of a list endpoint, following the pagination
+    """
+    items = []
+    page = '1'
+    while page:
+        r = api_request('GET', url, api_token, verifyssl, name, verbose, deadline=deadline,
+                        params=dict(
+                            per_page=100,
+                            page=page
+                        ))
+        items += r.json()
+        page = r.headers.get('X-Next-Page')
+    return items
+
+
+def get_pipeline_jobs(project_url, api_token, pipeline, verifyssl, verbose=False, deadline=None):
+    """ List all jobs of a pipeline, following the pagination
+    """
+    return get_all_pages(f'{project_url}/pipelines/{pipeline}/jobs', api_token, verifyssl, 'get_pipeline_jobs', verbose, deadline)
+
+
+def get_pipeline_bridges(project_url, api_token, pipeline, verifyssl, verbose=False, deadline=None):
+    """ List all bridge (trigger) jobs of a pipeline, following the pagination
+    """
+    return get_all_pages(f'{project_url}/pipelines/{pipeline}/bridges', api_token, verifyssl, 'get_pipeline_bridges', verbose, deadline)
+
+
+def play_job(project_url, api_token, job, verifyssl, verbose=False):
+    return api_request('POST', f'{project_url}/jobs/{job}/play', api_token, verifyssl, 'play_job', verbose).json()
 
 
 def get_job_trace(project_url, api_token, job, verifyssl, verbose=False):
-    r = requests.get(
-        f'{project_url}/jobs/{job}/trace',
-        headers={
-            'PRIVATE-TOKEN': api_token
-        },
-        verify=verifyssl
-    )
-    if verbose:
-        print(f'Response get_job_trace: {r.text}')
-    assert r.status_code == 200, f'expected status code 200, was {r.status_code}'
+    r = api_request('GET', f'{project_url}/jobs/{job}/trace', api_token, verifyssl, 'get_job_trace', verbose)
     r.encoding = 'utf-8'
     return r.text
 
 
+def open_job_trace(project_url, api_token, job, verifyssl, headers, deadline=None):
+    """ Stream the trace of a job, checking the status code is left to the caller
+    """
+    return api_request('GET', f'{project_url}/jobs/{job}/trace', api_token, verifyssl, 'open_job_trace',
+                       expected=None, deadline=deadline, headers=headers, stream=True)
+
+
+def download_job_trace(project_url, api_token, job, path, verifyssl, compress=False, max_bytes=None, tail_bytes=None) -> int:
+    """ Stream the trace of a job to `path` in chunks, returns the number of trace bytes written
+
+    `max_bytes` stops after the first bytes of the trace, `tail_bytes` only keeps
+    its last bytes. Memory use is bounded by the chunk size (plus `tail_bytes`).
+    """
+    import gzip
+
+    headers = {'Accept-Encoding': 'identity'}
+    if tail_bytes:
+        headers['Range'] = f'bytes=-{tail_bytes}'
+    r = open_job_trace(project_url, api_token, job, verifyssl, headers)
+    with contextlib.closing(r):
+        assert r.status_code in (200, 206), f'expected status code 200 or 206, was {r.status_code}'
+        chunks = r.iter_content(chunk_size=TRACE_CHUNK_SIZE)
+        if tail_bytes and r.status_code == 200:
+            # the server ignored the Range header, keep a sliding window instead
+            window = bytearray()
+            for chunk in chunks:
+                window += chunk
+                del window[:-tail_bytes]
+            chunks = [bytes(window)]
+        written = 0
+        with (gzip.open if compress else open)(path, 'wb') as f:
+            for chunk in chunks:
+                if max_bytes is not None:
+                    chunk = chunk[:max_bytes - written]
+                f.write(chunk)
+                written += len(chunk)
+                if max_bytes is not None and written >= max_bytes:
+                    break
+    return written
+
+
+def save_pipeline_traces(args, project_url, pid, jobs=None) -> List[str]:
+    """ Download the traces of all jobs of a pipeline concurrently, one file per job
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    if jobs is None:
+        jobs = get_pipeline_jobs(project_url, args.api_token, pid, args.verifyssl, args.verbose)
+    suffix = '.log.gz' if args.trace_gzip else '.log'
+
+    def download(job):
+        name = re.sub(r'[^A-Za-z0-9_.-]+', '_', job['name'])
+        path = os.path.join(args.output_dir, f"{job['id']}-{name}{suffix}")
+        try:
+            download_job_trace(project_url, args.api_token, job['id'], path, args.verifyssl,
+                               compress=args.trace_gzip, max_bytes=args.trace_max_bytes, tail_bytes=args.trace_tail)
+        except Exception as e:
+            print(f"Failed to download output of job {job['name']}: {e}")
+            return None
+        return path
+
+    with ThreadPoolExecutor(max_workers=args.trace_workers) as pool:
+        paths = [path for path in pool.map(download, jobs) if path is not None]
+    print(f'Pipeline {pid} job output written to {args.output_dir} ({len(paths)} of {len(jobs)} jobs)')
+    return paths
+
+
+class TraceTailer:
+    """ Incrementally prints the traces of a pipeline's jobs while it runs
+
+    Only the bytes past the last seen offset of each job are requested (via a
+    `Range` header) and every complete line is printed prefixed by the job name.
+    """
+
+    def __init__(self, project_url, api_token, pid, verifyssl, prefix=''):
+        self.project_url = project_url
+        self.api_token = api_token
+        self.pid = pid
+        self.verifyssl = verifyssl
+        self.prefix = prefix
+        self.offsets = {}
+        self.partial = {}
+        self.completed = set()
+
+    def poll(self, deadline=None):
+        try:
+            jobs = get_pipeline_jobs(self.project_url, self.api_token, self.pid, self.verifyssl, deadline=deadline)
+        except Exception as e:
+            # streaming output is best effort, the status poll decides the outcome
+            print(f'\nFetching jobs for output failed: {e}')
+            return
+        for job in sorted(jobs, key=lambda j: j['id']):
+            if job['id'] in self.completed:
+                continue
+            if job['status'] != STATUS_RUNNING and job['status'] not in trace_complete_states:
+                continue
+            try:
+                self.tail(job, deadline)
+            except Exception as e:
+                # picked up again from the last printed offset on the next poll
+                print(f"\nFetching output of job {job['name']} failed: {e}")
+                continue
+            if job['status'] in trace_complete_states:
+                self.flush(job)
+                self.completed.add(job['id'])
+
+    def tail(self, job, deadline=None):
+        job_id = job['id']
+        offset = self.offsets.get(job_id, 0)
+        # byte offsets only hold for the unencoded trace
+        r = open_job_trace(self.project_url, self.api_token, job_id, self.verifyssl,
+                           {'Range': f'bytes={offset}-', 'Accept-Encoding': 'identity'}, deadline)
+        with contextlib.closing(r):
+            if r.status_code == 416:
+                # nothing new since the last offset
+                return
+            assert r.status_code in (200, 206), f'expected status code 200 or 206, was {r.status_code}'
+            # servers ignoring the Range header send the whole trace again
+            skip = offset if r.status_code == 200 else 0
+            for chunk in r.iter_content(chunk_size=TRACE_CHUNK_SIZE):
+                if skip:
+                    dropped = min(skip, len(chunk))
+                    chunk = chunk[dropped:]
+                    skip -= dropped
+                if chunk:
+                    self.offsets[job_id] = self.offsets.get(job_id, 0) + len(chunk)
+                    self.emit(job, chunk)
+
+    def emit(self, job, chunk):
+        lines = (self.partial.pop(job['id'], b'') + chunk).split(b'\n')
+        if lines[-1]:
+            self.partial[job['id']] = lines[-1]
+        for line in lines[:-1]:
+            self.print_line(job, line)
+
+    def flush(self, job):
+        rest = self.partial.pop(job['id'], b'')
+        if rest:
+            self.print_line(job, rest)
+
+    def print_line(self, job, line):
+        text = line.decode('utf-8', errors='replace').rstrip('\r')
+        print(f"[{self.prefix}{job['name']}] {text}", flush=True)
+
+
+class DownstreamNode:
+    """ A pipeline in a `DownstreamTree`
+    """
+
+    def __init__(self, project_url, pid, parent=None, bridge=None, allow_failure=False):
+        self.project_url = project_url
+        self.pid = pid
+        self.parent = parent
+        self.bridge = bridge
+        self.allow_failure = allow_failure
+        self.pipeline = None
+        self.children = []
+        self.settled = False
+
+    @property
+    def status(self):
+        return self.pipeline['status'] if self.pipeline else None
+
+    @property
+    def depth(self):
+        return 0 if self.parent is None else self.parent.depth + 1
+
+
+class DownstreamTree:
+    """ Tracks the child and multi-project pipelines started by the bridge jobs of a pipeline, recursively
+
+    The bridges of a pipeline embed the current state of their downstream
+    pipelines, so one bridges request per pipeline refreshes all of its
+    children. A pipeline is settled once it and all of its children have
+    finished and its bridges were listed after it finished.
+    """
+
+    def __init__(self, args, project_url, pid):
+        self.args = args
+        self.root = DownstreamNode(project_url, pid)
+        self.nodes = [self.root]
+        self.seen = {(project_url, str(pid))}
+        self.reported = set()
+
+    @property
+    def finished(self):
+        return all(node.settled for node in self.nodes)
+
+    @property
+    def downstream(self) -> List[DownstreamNode]:
+        return self.nodes[1:]
+
+    @property
+    def failed(self) -> List[DownstreamNode]:
+        return [node for node in self.downstream if node.status in [STATUS_FAILED, STATUS_CANCELED] and not node.allow_failure]
+
+    def refresh(self, pipeline, deadline=None):
+        """ Apply the freshly polled root pipeline and refresh the rest of the tree concurrently
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.root.pipeline = pipeline
+        pending = [node for node in self.nodes if not node.settled and node.status is not None]
+        if not pending:
+            return
+        with ThreadPoolExecutor(max_workers=self.args.max_workers) as pool:
+            results = list(pool.map(partial(self.list_bridges, deadline=deadline), pending))
+        for node, (finished, bridges) in zip(pending, results):
+            if bridges is None:
+                continue
+            for bridge in bridges:
+                self.update(node, bridge)
+            node.settled = finished and all(child.status in finished_states for child in node.children)
+        for node in self.failed:
+            if node.pid not in self.reported:
+                self.reported.add(node.pid)
+                print(f"\nDownstream pipeline {node.pid} ({node.bridge}) {node.status}: {node.pipeline.get('web_url')}")
+
+    def list_bridges(self, node, deadline=None):
+        # whether the pipeline had finished must be known before listing its bridges
+        finished = node.status in finished_states
+        try:
+            return finished, get_pipeline_bridges(node.project_url, self.args.api_token, node.pid,
+                                                  self.args.verifyssl, self.args.verbose, deadline)
+        except Exception as e:
+            # retried on the next poll
+            print(f'\nListing bridges of pipeline {node.pid} failed: {e}')
+            return finished, None
+
+    def update(self, parent, bridge):
+        downstream = bridge.get('downstream_pipeline')
+        if not downstream:
+            # not triggered (yet)
+            return
+        project_url = parent.project_url
+        if downstream.get('project_id') is not None:
+            project_url = f"{parent.project_url.rsplit('/', 1)[0]}/{downstream['project_id']}"
+        key = (project_url, str(downstream['id']))
+        node = next((child for child in parent.children if (child.project_url, str(child.pid)) == key), None)
+        if node is None:
+            if key in self.seen:
+                return
+            self.seen.add(key)
+            node = DownstreamNode(project_url, downstream['id'], parent, bridge.get('name'), bridge.get('allow_failure', False))
+            parent.children.append(node)
+            self.nodes.append(node)
+        node.pipeline = downstream
+
+    def walk(self, node=None):
+        node = node or self.root
+        yield node
+        for child in node.children:
+            yield from self.walk(child)
+
+    def print_status(self):
+        print('Downstream pipelines:')
+        for node in self.walk():
+            bridge = f' ({node.bridge})' if node.bridge else ''
+            print(f"{'  ' * node.depth}{node.pid}{bridge}: {node.status or '-'}")
+
+
 def get_sha(project_url, api_token, ref, verifyssl, verbose=False) -> Optional[str]:
     """ Get the sha at the tip of ref
     """
-    r = requests.get(
-        f'{project_url}/repository/commits/{ref}',
-        headers={
-            'PRIVATE-TOKEN': api_token
-        },
-        verify=verifyssl
-    )
-    if verbose:
-        print(f'Response get_sha: {r.text}')
-    assert r.status_code == 200, f'expected status code 200, was {r.status_code}'
+    r = api_request('GET', f'{project_url}/repository/commits/{ref}', api_token, verifyssl, 'get_sha', verbose)
     return r.json().get('id')
 
 
+def get_project_info(project_url, api_token, project, verifyssl, verbose=False) -> Dict:
+    """ Get the metadata of a project by id or path, from the project cache if enabled
+    """
+    url = f"{project_url}/{urllib.parse.quote(str(project), safe='')}"
+    if project_cache is not None:
+        cached = project_cache.get(url)
+        if cached is not None:
+            return cached
+    res = api_request('GET', url, api_token, verifyssl, 'get_project_info', verbose).json()
+    if project_cache is not None:
+        keys = [url, f"{project_url}/{res['id']}"]
+        if res.get('path_with_namespace'):
+            keys.append(f"{project_url}/{urllib.parse.quote(res['path_with_namespace'], safe='')}")
+        project_cache.put(keys, {k: res.get(k) for k in ('id', 'name', 'path_with_namespace', 'web_url', 'default_branch')})
+    return res
+
+
 def get_project_id(project_url, api_token, project_name, verifyssl, verbose=False):
     assert project_name is not None, 'expected TRIGGER_PROJECT_NAME defined'
-    r = requests.get(
-        f"{project_url}/{urllib.parse.quote(project_name, safe='')}",
-        headers={
-            'PRIVATE-TOKEN': api_token
-        },
-        verify=verifyssl
-    )
-    if verbose:
-        print(f'Response get_project_id: {r.text}')
-    assert r.status_code == 200, f'expected status code 200, was {r.status_code}'
-    res = r.json()
-    return str(res['id'])
+    return str(get_project_info(project_url, api_token, project_name, verifyssl, verbose)['id'])
 
 
 def isint(x):
@@ -215,106 +1009,476 @@ def isint(x):
         return True
 
 
-def handle_manual_pipeline(args, pipeline, proj, status):
-    defined_jobs = [item for item in args.jobs.split(',')] if args.jobs else []
-    manual_jobs = []
-    for job in pipeline.jobs.list(per_page=100):
-        if job.status == STATUS_MANUAL:
-            # pick the first manual job and exit the loop
-            if len(defined_jobs) == 0:
-                manual_jobs.append(job)
-                break
-            elif job.name in defined_jobs:
-                manual_jobs.append(job)
-    if len(manual_jobs) == 0:
+class ManualJobPlayer:
+    """ Plays the manual jobs of a pipeline for `--on-manual play`
+
+    `--jobs` is a comma-separated list of steps, each step is only played once
+    all jobs of the previous step have started. Jobs of one step joined with
+    `+` (e.g. `migrate,deploy-eu+deploy-us`) are played concurrently. Without
+    `--jobs` the first manual job is played. Jobs are indexed by name across
+    polls and a job that has been played once is never played again.
+    """
+
+    # job states of jobs that have not started (yet), skipped and other finished jobs never block the next step
+    waiting_states = ['created', 'scheduled', STATUS_MANUAL]
+
+    def __init__(self, args, project_url, pid):
+        self.args = args
+        self.project_url = project_url
+        self.pid = pid
+        self.steps = [step.split('+') for step in args.jobs.split(',')] if args.jobs else []
+        self.jobs = collections.OrderedDict()
+        self.played = set()
+
+    def refresh(self):
+        jobs = collections.OrderedDict()
+        for job in get_pipeline_jobs(self.project_url, self.args.api_token, self.pid, self.args.verifyssl, self.args.verbose):
+            # retried jobs share their name, the latest one wins
+            if job['name'] not in jobs or job['id'] > jobs[job['name']]['id']:
+                jobs[job['name']] = job
+        self.jobs = jobs
+
+    def started(self, job) -> bool:
+        return job['status'] not in self.waiting_states
+
+    def due(self) -> List[Dict]:
+        """ The manual jobs that can be played now
+        """
+        playable = [job for job in self.jobs.values() if job['status'] == STATUS_MANUAL and job['id'] not in self.played]
+        if not self.steps:
+            return playable[:1]
+        for step in self.steps:
+            jobs = [self.jobs[name] for name in step if name in self.jobs]
+            due = [job for job in jobs if job['status'] == STATUS_MANUAL and job['id'] not in self.played]
+            if due or not all(self.started(job) for job in jobs):
+                return due
+        return []
+
+    def play(self) -> int:
+        """ Play all jobs that are due, returns the number of jobs played
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.refresh()
+        played = 0
+        due = self.due()
+        while due:
+            for job in due:
+                print(f"\nPlaying manual job \"{job['name']}\" from stage \"{job['stage']}\"...")
+            with ThreadPoolExecutor(max_workers=len(due)) as pool:
+                jobs = list(pool.map(
+                    lambda job: play_job(self.project_url, self.args.api_token, job['id'], self.args.verifyssl, self.args.verbose),
+                    due))
+            for job, started in zip(due, jobs):
+                self.played.add(job['id'])
+                self.jobs[job['name']] = dict(job, status=started.get('status', job['status']))
+            played += len(due)
+            # the next step may start right away if this step's jobs started
+            due = self.due() if self.steps else []
+        return played
+
+    def waiting(self) -> bool:
+        """ Whether a played job has not been reported as started yet
+        """
+        return any(job['id'] in self.played and job['status'] in self.waiting_states for job in self.jobs.values())
+
+
+def handle_manual_pipeline(args, player, status):
+    if player.play() == 0 and not player.waiting():
         print('\nNo manual jobs found!')
-    else:
-        # wipe status, because the pipeline will continue after playing the manual job
-        status = None
-        if len(defined_jobs) > 0:
-            # sort by name of --jobs argument to preserve the order of execution
-            manual_jobs.sort(key=lambda j: defined_jobs.index(j.name))
-        for manual_job in manual_jobs:
-            print(f'\nPlaying manual job "{manual_job.name}" from stage "{manual_job.stage}"...')
-            proj.jobs.get(manual_job.id, lazy=True).play()
-    return status
-
-
-def check_pipeline_status(args, pid, proj, project_url):
+        return status
+    # wipe status, because the pipeline will continue after playing the manual job
+    return None
+
+
+def time_out_pipeline(args, project_url, pid, tree=None):
+    """ Give up waiting on a pipeline after `--timeout`, cancelling it for `--cancel-on-timeout`
+
+    Always raises `PipelineFailure` with return code 3.
+    """
+    print(f'\nTimed out after {args.timeout} seconds waiting for pipeline {pid}')
+    if args.cancel_on_timeout:
+        cancel_pipelines(args, project_url, pid, tree)
+    raise PipelineFailure(return_code=3, pipeline_id=pid)
+
+
+def remaining(deadline) -> Optional[float]:
+    """ Seconds left until a `monotonic` deadline (None for no deadline), never negative
+    """
+    return None if deadline is None else max(0.0, deadline - monotonic())
+
+
+def check_pipeline_status(args, pid, project_url, player=None, deadline=None, tree=None):
     pipeline = None
     status = None
     max_retries = 5
     retries_left = max_retries
     while retries_left >= 0:
         try:
-            pipeline = proj.pipelines.get(pid)
-            status = pipeline.status
+            pipeline, _ = poll_pipeline(project_url, args.api_token, pid, args.verifyssl, deadline)
+            metrics.pipeline_polled(project_url, pid)
+            status = pipeline['status']
             if status in [STATUS_MANUAL, STATUS_SKIPPED] and args.on_manual == ACTION_PLAY:
-                status = handle_manual_pipeline(args, pipeline, proj, status)
+                player = player or ManualJobPlayer(args, project_url, pid)
+                status = handle_manual_pipeline(args, player, status)
 
             # reset retries_left if the status call succeeded (fail only on consecutive failures)
             retries_left = max_retries
             break
         except Exception as e:
             print(f'\nPolling for status failed: {e}')
+            metrics.inc('trigger_poll_failures')
             if retries_left == 0:
                 print(f'Polling failed {max_retries} consecutive times. Please verify the pipeline url:')
                 print(f'   curl -s -X GET -H "PRIVATE-TOKEN: <private token>" {project_url}/pipelines/{pid}')
                 print('check your api token, or check if there are connection issues.')
                 print()
                 raise PipelineFailure(return_code=2, pipeline_id=pid)
+            # back off instead of hammering an instance that may be overloaded
+            backoff = min(2 ** (max_retries - retries_left), 30)
+            if deadline is not None:
+                if remaining(deadline) == 0:
+                    time_out_pipeline(args, project_url, pid, tree)
+                backoff = min(backoff, remaining(deadline))
+            sleep(backoff)
             retries_left -= 1
     return pipeline, status
 
 
-def trigger(args: List[str]) -> int:
-    args = parse_args(args)
+def make_http_server(listen, handler):
+    """ Threaded HTTP server for `handler` bound to `HOST:PORT`
+    """
+    import socketserver
+    from http.server import HTTPServer
 
-    assert args.pipeline_token, 'pipeline token must be set'
-    assert args.project_id, 'project id must be set'
-    assert args.host, 'host must be set'
-    assert args.url_path, 'url path must be set'
-    assert args.target_ref, 'must provide target ref'
-    assert args.sleep > 0, 'sleep parameter must be > 0'
+    class Server(socketserver.ThreadingMixIn, HTTPServer):
+        daemon_threads = True
 
-    ref = args.target_ref
-    proj_id = args.project_id
-    pipeline_token = args.pipeline_token
-    verifyssl = args.verifyssl
-    verbose = args.verbose
+    host, _, port = listen.rpartition(':')
+    return Server((host or '127.0.0.1', int(port)), handler)
 
-    if args.host.startswith('http://') or args.host.startswith('https://'):
-        base_url = args.host
-    else:
-        base_url = f'https://{args.host}'
 
-    if not isint(proj_id):
-        assert args.api_token is not None, 'finding project id by name requires an api token (-a parameter missing)'
-        proj_id = get_project_id(f"{base_url}{args.url_path}", args.api_token, proj_id, verifyssl, verbose)
+class WebhookListener:
+    """ Receives GitLab pipeline and job webhook events for the tracked pipelines
 
-    project_url = f"{base_url}{args.url_path}/{proj_id}"
-    variables = {}
-    if args.env is not None:
-        variables = parse_env(args.env)
+    Events carrying the expected secret token (`X-Gitlab-Token`) for a tracked
+    pipeline wake up `wait`, so the poller can pick up the change right away
+    instead of at the end of its (now slow, fallback) polling interval.
+    """
 
-    if args.retry or args.pid is not None:
-        assert args.api_token is not None, 'retry checks require an api token (-a parameter missing)'
+    def __init__(self, listen, secret=None):
+        from http.server import BaseHTTPRequestHandler
 
-        if args.pid is None:
-            print(f"Looking for pipeline '{ref}' for project id {proj_id} ...")
-            pipeline = get_last_pipeline(project_url, args.api_token, ref, verifyssl, verbose)
-            pid = pipeline.get('id')
+        self.secret = secret
+        self.pids = set()
+        self.changed = threading.Event()
+        self.callbacks = []
+        listener = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                code = listener.handle(self.headers.get('X-Gitlab-Token'), body)
+                self.send_response(code)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = make_http_server(listen, Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='trigger-webhooks', daemon=True)
+        self.thread.start()
+
+    @property
+    def address(self):
+        host, port = self.server.server_address[:2]
+        return f'{host}:{port}'
+
+    def track(self, pid):
+        self.pids.add(str(pid))
+
+    def on_change(self, callback):
+        """ Also call `callback` (on the server thread) for every event that wakes up `wait`
+        """
+        self.callbacks.append(callback)
+
+    def handle(self, token, body) -> int:
+        import hmac
+
+        if self.secret is not None and not hmac.compare_digest((token or '').encode('utf-8'), self.secret.encode('utf-8')):
+            return 401
+        try:
+            event = json.loads(body)
+            if event.get('object_kind') == 'pipeline':
+                pid = event['object_attributes']['id']
+            elif event.get('object_kind') == 'build':
+                pid = event['pipeline_id']
+            else:
+                return 200
+        except (KeyError, TypeError, ValueError):
+            return 400
+        if str(pid) in self.pids:
+            self.changed.set()
+            for callback in self.callbacks:
+                callback()
+        return 200
+
+    def wait(self, timeout) -> bool:
+        """ Wait up to `timeout` seconds for an event, returns whether one arrived
+        """
+        woken = self.changed.wait(timeout)
+        self.changed.clear()
+        return woken
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def open_webhook_listener(args) -> Optional[WebhookListener]:
+    if not args.webhook_listen:
+        return None
+    listener = WebhookListener(args.webhook_listen, args.webhook_secret)
+    print(f'Listening for pipeline events on {listener.address}')
+    return listener
+
+
+def wait_for_next_poll(args, listener, deadline=None):
+    interval = args.webhook_fallback_sleep if listener is not None else args.sleep
+    if deadline is not None:
+        interval = min(interval, remaining(deadline))
+    if listener is not None:
+        listener.wait(interval)
+    else:
+        sleep(interval)
+
+
+class BatchPoller:
+    """ Refreshes many tracked pipelines with a single list request per project
+
+    Tracked pipelines are grouped by project (and api token). Each group is
+    refreshed by listing the project's pipelines updated since the latest
+    `updated_at` seen so far, so only pipelines that actually changed are
+    returned. Newly tracked pipelines are fetched individually once to seed it.
+    An update can be committed after a later stamped update of another
+    pipeline moved the cursor past it, so pipelines that were not listed for
+    `refetch_after` polls are fetched individually again.
+    """
+    max_retries = 5
+    refetch_after = 10
+
+    def __init__(self):
+        self.groups = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def group_key(project_url, api_token, verifyssl):
+        return (project_url, api_token, verifyssl)
+
+    def track(self, project_url, api_token, verifyssl, pid):
+        key = self.group_key(project_url, api_token, verifyssl)
+        with self.lock:
+            group = self.groups.setdefault(key, dict(pipelines={}, unchanged={}, since=None, failures=0))
+            group['pipelines'].setdefault(str(pid), None)
+            group['unchanged'].setdefault(str(pid), 0)
+        return key
+
+    def retry(self, project_url, api_token, verifyssl, pid):
+        """ Report a tracked pipeline as changed again on the next poll, e.g. after handling the change failed
+        """
+        with self.lock:
+            group = self.groups.get(self.group_key(project_url, api_token, verifyssl))
+            if group is not None and str(pid) in group['pipelines']:
+                group['pipelines'][str(pid)] = None
+
+    def untrack(self, project_url, api_token, verifyssl, pid):
+        key = self.group_key(project_url, api_token, verifyssl)
+        with self.lock:
+            group = self.groups.get(key)
+            if group is not None:
+                group['pipelines'].pop(str(pid), None)
+                group['unchanged'].pop(str(pid), None)
+                if not group['pipelines']:
+                    del self.groups[key]
+
+    def poll(self, keys=None, deadline=None):
+        """ Refresh the given groups (default: all), returns `(changed, failed)`
+
+        `changed` maps `(project_url, pid)` to the new pipeline of every tracked
+        pipeline that changed, `failed` maps `(project_url, pid)` to the last
+        error for groups that failed `max_retries` consecutive times.
+        """
+        changed, failed = {}, {}
+        with self.lock:
+            keys = [key for key in (keys if keys is not None else list(self.groups)) if key in self.groups]
+        for key in keys:
+            project_url = key[0]
+            try:
+                updates = self.refresh(key, deadline)
+            except Exception as e:
+                print(f'\nPolling for status failed: {e}')
+                metrics.inc('trigger_poll_failures')
+                with self.lock:
+                    group = self.groups.get(key)
+                    if group is None:
+                        continue
+                    group['failures'] += 1
+                    if group['failures'] > self.max_retries:
+                        failed.update(((project_url, pid), e) for pid in group['pipelines'])
+                continue
+            changed.update(((project_url, pid), pipeline) for pid, pipeline in updates.items())
+        return changed, failed
+
+    def refresh(self, key, deadline=None):
+        project_url, api_token, verifyssl = key
+        with self.lock:
+            group = self.groups[key]
+            known = dict(group['pipelines'])
+            unchanged = dict(group['unchanged'])
+            since = group['since']
+
+        updates = {}
+        latest = since
+        # without an `updated_at` to start from, or not listed for long, fall back to single requests
+        fetched = [pid for pid, pipeline in known.items()
+                   if pipeline is None or since is None or unchanged.get(pid, 0) >= self.refetch_after]
+        for pid in fetched:
+            updates[pid] = get_pipeline(project_url, api_token, pid, verifyssl, deadline=deadline)
+            latest = max(filter(None, [latest, updates[pid].get('updated_at')]), default=None)
+        if len(updates) < len(known):
+            page = '1'
+            while page:
+                pipelines, page = list_pipelines(project_url, api_token, verifyssl, deadline,
+                                                 updated_after=since, order_by='updated_at', sort='desc',
+                                                 per_page=100, page=page)
+                for pipeline in pipelines:
+                    pid = str(pipeline['id'])
+                    if pid in known and pid not in updates:
+                        updates[pid] = pipeline
+                    latest = max(filter(None, [latest, pipeline.get('updated_at')]), default=None)
+
+        for pid in known:
+            metrics.pipeline_polled(project_url, pid)
+        changes = {}
+        with self.lock:
+            group['failures'] = 0
+            for pid, pipeline in updates.items():
+                old = known[pid]
+                if old is None or (pipeline.get('updated_at'), pipeline['status']) != (old.get('updated_at'), old['status']):
+                    changes[pid] = pipeline
+                if pid in group['pipelines']:
+                    group['pipelines'][pid] = pipeline
+            for pid in group['unchanged']:
+                group['unchanged'][pid] = 0 if pid in changes or pid in fetched else group['unchanged'][pid] + 1
+            group['since'] = latest
+        return changes
+
+
+def refresh_target(args, target, pipeline):
+    """ Apply a freshly polled pipeline to a target, playing manual jobs if requested
+    """
+    target.pipeline = pipeline
+    target.status = pipeline['status']
+    if target.status in [STATUS_MANUAL, STATUS_SKIPPED] and args.on_manual == ACTION_PLAY:
+        if target.player is None:
+            target.player = ManualJobPlayer(args, target.project_url, target.pid)
+        target.status = handle_manual_pipeline(args, target.player, target.status)
+
+
+class Target:
+    """ A single downstream project/ref/token triple to trigger and wait on.
+    """
+
+    def __init__(self, project_id, ref, pipeline_token):
+        self.project_id = project_id
+        self.ref = ref
+        self.pipeline_token = pipeline_token
+        self.project_url = None
+        self.pid = None
+        self.pipeline = None
+        self.status = None
+        self.return_code = None
+        self.tailer = None
+        self.player = None
+        self.tree = None
+        self.failed_fast = False
+        self.failures = 0
+
+    @classmethod
+    def parse(cls, spec: str, default_ref: str, default_token: str) -> 'Target':
+        """ Parse a `PROJECT[:REF[:PIPELINE_TOKEN]]` target specification
+        """
+        parts = spec.split(':', 2)
+        project_id = parts[0]
+        ref = parts[1] if len(parts) > 1 and parts[1] else default_ref
+        pipeline_token = parts[2] if len(parts) > 2 and parts[2] else default_token
+        assert project_id, f'invalid target specification: {spec}'
+        return cls(project_id, ref, pipeline_token)
+
+    @property
+    def finished(self):
+        if self.return_code is not None or self.failed_fast:
+            return True
+        return self.status in finished_states and (self.tree is None or self.tree.finished)
+
+
+def get_base_url(host):
+    if host.startswith('http://') or host.startswith('https://'):
+        return host
+    return f'https://{host}'
+
+
+def resolve_project_url(args, base_url, proj_id):
+    if not isint(proj_id):
+        assert args.api_token is not None, 'finding project id by name requires an api token (-a parameter missing)'
+        proj_id = get_project_id(f"{base_url}{args.url_path}", args.api_token, proj_id, args.verifyssl, args.verbose)
+    return proj_id, f"{base_url}{args.url_path}/{proj_id}"
+
+
+def get_retry_inputs(args, project_url, ref):
+    """ Fetch the pipeline to retry (`--pid` or the latest for ref) and the tip of ref concurrently
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        if args.pid is None:
+            pipeline = pool.submit(get_last_pipeline, project_url, args.api_token, ref, args.verifyssl, args.verbose)
         else:
-            pid = args.pid
-            print(f"Fetching for pipeline '{pid}' for project id {proj_id} ...")
-            pipeline = get_pipeline(project_url, args.api_token, pid, verifyssl, verbose)
+            pipeline = pool.submit(get_pipeline, project_url, args.api_token, args.pid, args.verifyssl, args.verbose)
+        ref_tip_sha = pool.submit(get_sha, project_url, args.api_token, ref, args.verifyssl, args.verbose)
+        return pipeline.result(), ref_tip_sha.result()
+
+
+def start_pipeline(args, proj_id, project_url, ref, pipeline_token, variables):
+    """ Create (or retry, for `--retry`/`--pid`) the remote pipeline and return its id
+    """
+    verifyssl = args.verifyssl
+    verbose = args.verbose
+    action = 'create'
+
+    checkpoints = resume_checkpoints(args)
+    if checkpoints is not None:
+        pid = resume_pipeline(args, checkpoints, project_url, ref)
+        if pid is not None:
+            metrics.pipeline_started(project_url, pid, 'resume')
+            return pid
+
+    if args.retry or args.pid is not None:
+        assert args.api_token is not None, 'retry checks require an api token (-a parameter missing)'
+
+        if args.pid is None:
+            print(f"Looking for pipeline '{ref}' for project id {proj_id} ...")
+        else:
+            print(f"Fetching for pipeline '{args.pid}' for project id {proj_id} ...")
+        pipeline, ref_tip_sha = get_retry_inputs(args, project_url, ref)
+        pid = pipeline.get('id') if args.pid is None else args.pid
 
         status = pipeline.get('status')
         assert pid, 'refresh pipeline id must not be none'
         assert status, 'refresh pipeline status must not be none'
 
         pipeline_sha = pipeline.get('sha')
-        ref_tip_sha = get_sha(project_url, args.api_token, ref, verifyssl, verbose)
         outdated = pipeline_sha != ref_tip_sha
 
         outdated_str = 'outdated' if outdated else 'up to date'
@@ -322,61 +1486,318 @@ def trigger(args: List[str]) -> int:
 
         if outdated:
             print(f"Pipeline {pid} for {ref} outdated (sha: {pipeline_sha[:6]}, tip is {ref_tip_sha[:6]}) - re-running ...")
-            pid = create_pipeline(project_url, pipeline_token, ref, verifyssl, variables, verbose)
+            pipeline = create_pipeline(project_url, pipeline_token, ref, verifyssl, variables, verbose, args.api_token)
+            pid = pipeline.get('id')
         elif status == STATUS_SUCCESS:
             print(f"Pipeline {pid} already in state 'success' - re-running ...")
-            pid = create_pipeline(project_url, pipeline_token, ref, verifyssl, variables, verbose)
+            pipeline = create_pipeline(project_url, pipeline_token, ref, verifyssl, variables, verbose, args.api_token)
+            pid = pipeline.get('id')
         else:
             print(f"Retrying pipeline {pid} ...")
-            proj = get_project(base_url, args.api_token, proj_id, verifyssl)
-            proj.pipelines.get(pid).retry()
+            retry_pipeline(project_url, args.api_token, pid, verifyssl, verbose)
+            action = 'retry'
 
     else:
         print(f"Triggering pipeline for ref '{ref}' for project id {proj_id}")
-        pid = create_pipeline(project_url, pipeline_token, ref, verifyssl, variables, verbose)
-        try:
-            proj = get_project(base_url, args.api_token, proj_id, verifyssl)
-            print(f"See pipeline at {proj.web_url}/pipelines/{pid}")
-        except Exception:
-            # get_projects can fail if no api_token has been provided
-            # since we're only logging here we simply ignore this
-            pass
+        if args.reuse:
+            pipeline, reused = reuse_or_create_pipeline(args, project_url, ref, pipeline_token, variables)
+            if reused:
+                action = 'reuse'
+        else:
+            pipeline = create_pipeline(project_url, pipeline_token, ref, verifyssl, variables, verbose, args.api_token)
+        pid = pipeline.get('id')
+        if pipeline.get('web_url'):
+            print(f"See pipeline at {pipeline['web_url']}")
 
     assert pid is not None, 'must have a valid pipeline id'
+    metrics.pipeline_started(project_url, pid, action)
+    if checkpoints is not None:
+        checkpoints.put([checkpoint_key(args, project_url, ref)], dict(pid=pid))
+    if args.cancel_superseded:
+        cancel_superseded(args, project_url, ref, pid, pipeline.get('sha'))
+    return pid
 
-    if args.detached:
-        if args.on_manual == ACTION_PLAY:  # detached for manual pipelines
-            proj = get_project(base_url, args.api_token, proj_id, verifyssl)
-            check_pipeline_status(args, pid, proj, project_url)
-        print('Detached mode: not monitoring pipeline status - exiting now.')
-        return pid
 
-    # after this point (i.e. not running detached) we require api_token to be set
-    api_token = args.api_token
-    assert api_token is not None, 'pipeline status checks require an api token (-a parameter missing)'
+def resume_pipeline(args, checkpoints, project_url, ref) -> Optional[int]:
+    """ The id of the pipeline checkpointed for `--resume-key`, if it can still be waited on
+    """
+    entry = checkpoints.get(checkpoint_key(args, project_url, ref))
+    if entry is None:
+        return None
+    pid = entry['pid']
+    try:
+        pipeline = get_pipeline(project_url, args.api_token, pid, args.verifyssl, args.verbose)
+    except Exception as e:
+        print(f'Not resuming pipeline {pid}: {e}')
+        return None
+    if pipeline['status'] in unreusable_states:
+        print(f"Not resuming pipeline {pid} with status '{pipeline['status']}'")
+        return None
+    print(f"Resuming pipeline {pid} with status '{pipeline['status']}'")
+    if pipeline.get('web_url'):
+        print(f"See pipeline at {pipeline['web_url']}")
+    return pid
 
-    print(f"Waiting for pipeline {pid} to finish ...")
 
-    status = None
-    pipeline = None
-    proj = get_project(base_url, api_token, proj_id, verifyssl)
+def find_reusable_pipeline(args, project_url, ref, sha, variables) -> Optional[Dict]:
+    """ The newest triggered pipeline for ref and sha with the same variables that is still in flight or has succeeded
+    """
+    from concurrent.futures import ThreadPoolExecutor
 
-    while status not in finished_states:
-        pipeline, status = check_pipeline_status(args, pid, proj, project_url)
+    pipelines, _ = list_pipelines(project_url, args.api_token, args.verifyssl,
+                                  ref=ref, sha=sha, source='trigger', order_by='id', sort='desc', per_page=20)
+    # older GitLab versions ignore the source filter
+    candidates = [p for p in pipelines
+                  if p.get('status') not in unreusable_states and p.get('sha', sha) == sha and p.get('source', 'trigger') == 'trigger']
+    if not candidates:
+        return None
+    wanted = {key[len('variables['):-1]: value for key, value in variables.items()}
+    with ThreadPoolExecutor(max_workers=args.max_workers) as pool:
+        found = pool.map(lambda p: get_pipeline_variables(project_url, args.api_token, p['id'], args.verifyssl, args.verbose),
+                         candidates)
+        return next((p for p, candidate_variables in zip(candidates, found) if candidate_variables == wanted), None)
 
-        print('.', end='', flush=True)
-        sleep(args.sleep)
 
-    print()
-    if args.output:
-        jobs = get_pipeline_jobs(project_url, api_token, pid, verifyssl, verbose)
+@contextlib.contextmanager
+def reuse_lock(fingerprint):
+    """ Hold the lock of a pipeline fingerprint, it is dropped once no request holds or waits for it
+    """
+    with reuse_locks_lock:
+        entry = reuse_locks.setdefault(fingerprint, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with reuse_locks_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del reuse_locks[fingerprint]
+
+
+def reuse_or_create_pipeline(args, project_url, ref, pipeline_token, variables):
+    """ Reuse a pipeline with the same fingerprint (project, ref, tip sha, variables) or create one
+
+    Returns the pipeline and whether it was reused.
+    """
+    sha = get_sha(project_url, args.api_token, ref, args.verifyssl, args.verbose)
+    fingerprint = (project_url, ref, sha, tuple(sorted(variables.items())))
+    with reuse_lock(fingerprint):
+        pipeline = find_reusable_pipeline(args, project_url, ref, sha, variables) if sha else None
+        if pipeline is None:
+            return create_pipeline(project_url, pipeline_token, ref, args.verifyssl, variables, args.verbose, args.api_token), False
+    state = 'succeeded' if pipeline['status'] == STATUS_SUCCESS else f"is {pipeline['status']}"
+    print(f"Reusing pipeline {pipeline['id']} for sha {sha[:6]} with the same variables, it {state}")
+    return pipeline, True
+
+
+def cancel_superseded(args, project_url, ref, pid, sha) -> List[int]:
+    """ Cancel the running or pending trigger pipelines for ref that are older than pid and built another sha
+
+    Superseding is best effort: failures are printed, never raised. Returns
+    the ids of the cancelled pipelines.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def list_scope(scope):
+        pipelines, _ = list_pipelines(project_url, args.api_token, args.verifyssl,
+                                      ref=ref, scope=scope, source='trigger', order_by='id', sort='desc', per_page=100)
+        return pipelines
+
+    def cancel(pipeline):
+        try:
+            cancel_pipeline(project_url, args.api_token, pipeline['id'], args.verifyssl, args.verbose)
+        except Exception as e:
+            print(f"Cancelling superseded pipeline {pipeline['id']} failed: {e}")
+            return None
+        print(f"Cancelled superseded pipeline {pipeline['id']} (sha: {(pipeline.get('sha') or '')[:6]})")
+        return pipeline['id']
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        try:
+            candidates = [p for pipelines in pool.map(list_scope, ['running', 'pending']) for p in pipelines]
+        except Exception as e:
+            print(f'Looking for superseded pipelines failed: {e}')
+            return []
+        # older GitLab versions ignore the source filter
+        superseded = [p for p in candidates
+                      if int(p['id']) < int(pid) and p.get('source', 'trigger') == 'trigger' and (sha is None or p.get('sha') != sha)]
+        return [cancelled for cancelled in pool.map(cancel, superseded) if cancelled is not None]
+
+
+def pipeline_timing(pipeline, jobs) -> Dict:
+    """ Break down where the time of a finished pipeline went
+
+    Returns per job its queued and run time, per stage its boundaries and the
+    critical path: starting from the job that finished last, each step goes
+    back to the job that finished last before the current one was queued.
+    Times are seconds relative to the creation of the pipeline. Without the
+    `queued_duration` of a job (older GitLab versions) the time it waited
+    after its predecessor on the critical path finished is used instead.
+    """
+    created = parse_timestamp(pipeline.get('created_at'))
+    rows = []
+    for job in jobs:
+        started = parse_timestamp(job.get('started_at'))
+        finished = parse_timestamp(job.get('finished_at'))
+        if started is None or finished is None:
+            # never ran, e.g. skipped or manual jobs
+            continue
+        queued = job.get('queued_duration')
+        rows.append(dict(id=job['id'], name=job['name'], stage=job['stage'], status=job['status'],
+                         started=started, finished=finished, queued=queued, run=finished - started))
+    if created is None:
+        created = min([r['started'] - (r['queued'] or 0) for r in rows], default=0)
+
+    path = []
+    current = max(rows, key=lambda r: r['finished'], default=None)
+    while current is not None:
+        path.append(current)
+        ready = current['started'] - (current['queued'] or 0)
+        earlier = [r for r in rows if r['finished'] <= ready and r not in path]
+        previous = max(earlier, key=lambda r: r['finished'], default=None)
+        if current['queued'] is None:
+            current['queued'] = current['started'] - (previous['finished'] if previous is not None else created)
+        current = previous
+    path.reverse()
+
+    stages = collections.OrderedDict()
+    for r in sorted(rows, key=lambda r: r['started']):
+        stage = stages.setdefault(r['stage'], dict(name=r['stage'], start=r['started'], end=r['finished'], jobs=0))
+        stage['end'] = max(stage['end'], r['finished'])
+        stage['jobs'] += 1
+
+    def relative(value):
+        return round(value - created, 3)
+
+    return dict(
+        pipeline_id=pipeline.get('id'),
+        status=pipeline.get('status'),
+        duration=relative(max([r['finished'] for r in rows], default=created)),
+        jobs=[dict(id=r['id'], name=r['name'], stage=r['stage'], status=r['status'],
+                   queued=round(r['queued'], 3) if r['queued'] is not None else None, run=round(r['run'], 3),
+                   start=relative(r['started']), end=relative(r['finished']), critical=r in path)
+              for r in sorted(rows, key=lambda r: r['started'])],
+        stages=[dict(name=st['name'], start=relative(st['start']), end=relative(st['end']),
+                     duration=round(st['end'] - st['start'], 3), jobs=st['jobs'])
+                for st in stages.values()],
+        critical_path=[r['id'] for r in path],
+        critical_path_queued=round(sum(r['queued'] for r in path), 3),
+        critical_path_run=round(sum(r['run'] for r in path), 3),
+    )
+
+
+def print_timing_report(timing: Dict):
+    print(f"Pipeline {timing['pipeline_id']} timing ({timing['duration']:.0f}s):")
+    rows = [('JOB', 'STAGE', 'QUEUED', 'RUN', 'START', 'END', 'CRITICAL')]
+    for job in timing['jobs']:
+        queued = f"{job['queued']:.0f}s" if job['queued'] is not None else '-'
+        rows.append((job['name'], job['stage'], queued, f"{job['run']:.0f}s", f"{job['start']:.0f}s", f"{job['end']:.0f}s",
+                     '*' if job['critical'] else ''))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+    for stage in timing['stages']:
+        print(f"Stage {stage['name']}: {stage['start']:.0f}s - {stage['end']:.0f}s ({stage['jobs']} jobs)")
+    queued, run = timing['critical_path_queued'], timing['critical_path_run']
+    bound = 'runner queueing' if queued > run else 'job execution'
+    print(f"Critical path: {len(timing['critical_path'])} jobs, {queued:.0f}s queued, {run:.0f}s running ({bound} dominates)")
+
+
+def check_fail_fast(args, project_url, pid, status, tree=None, deadline=None) -> bool:
+    """ Whether a running pipeline already has a blocking failure, cancelling it if requested
+
+    A job blocks when it failed without `allow_failure`; with a `DownstreamTree`
+    a failed downstream pipeline blocks as well.
+    """
+    if not (args.fail_fast or args.cancel_on_fail) or status in finished_states:
+        return False
+    failures = []
+    if status == STATUS_RUNNING:
+        try:
+            jobs = get_pipeline_jobs(project_url, args.api_token, pid, args.verifyssl, args.verbose, deadline)
+        except Exception as e:
+            # checked again on the next poll, the status poll decides the outcome meanwhile
+            print(f'\nChecking jobs for failures failed: {e}')
+            jobs = []
+        failures = [f"job {job['name']}" for job in jobs if job['status'] == STATUS_FAILED and not job.get('allow_failure')]
+    if tree is not None:
+        failures += [f'downstream pipeline {node.pid}' for node in tree.failed]
+    if not failures:
+        return False
+    print(f"\nFailing fast, {', '.join(failures)} failed")
+    if args.cancel_on_fail:
+        cancel_pipelines(args, project_url, pid, tree)
+    return True
+
+
+def cancel_pipelines(args, project_url, pid, tree=None):
+    """ Cancel a pipeline and the unfinished pipelines of its `DownstreamTree`, best effort
+    """
+    pipelines = [(project_url, pid)]
+    if tree is not None:
+        # multi-project pipelines are not cancelled along with their parent
+        pipelines += [(node.project_url, node.pid) for node in tree.downstream if node.status not in finished_states]
+    for url, cancel_pid in pipelines:
+        try:
+            cancel_pipeline(url, args.api_token, cancel_pid, args.verifyssl, args.verbose)
+            print(f'Cancelled pipeline {cancel_pid}')
+        except Exception as e:
+            print(f'Cancelling pipeline {cancel_pid} failed: {e}')
+
+
+def print_pipeline_output(args, project_url, pid, jobs=None):
+    if jobs is None:
+        jobs = get_pipeline_jobs(project_url, args.api_token, pid, args.verifyssl, args.verbose)
+    if args.output_dir:
+        save_pipeline_traces(args, project_url, pid, jobs)
+    elif args.output and not args.follow:
         print(f'Pipeline {pid} job output:')
         for job in jobs:
             name = job['name']
             print(f'Job: {name}')
-            print(get_job_trace(project_url, api_token, job['id'], verifyssl, verbose))
+            print(get_job_trace(project_url, args.api_token, job['id'], args.verifyssl, args.verbose))
             print()
 
+
+def finish_pipeline(args, pid, pipeline, status, project_url, tree=None, ref=None):
+    """ Print job output if requested and map the final status to a result
+
+    With a `DownstreamTree` the output covers all downstream pipelines and a
+    failed downstream pipeline fails the result. The `--resume-key` checkpoint
+    of the pipeline for `ref` is dropped, a rerun starts a new pipeline.
+
+    Returns the pipeline id on success, raises `PipelineFailure` otherwise.
+    """
+    metrics.pipeline_finished(project_url, pid, pipeline)
+    checkpoints = resume_checkpoints(args)
+    if checkpoints is not None:
+        checkpoints.invalidate(checkpoint_key(args, project_url, ref or args.target_ref))
+    jobs = None
+    if args.output_dir or (args.output and not args.follow) or args.timing_report or args.timing_json:
+        # fetched once for the job output and the timing report
+        jobs = get_pipeline_jobs(project_url, args.api_token, pid, args.verifyssl, args.verbose)
+    if args.output_dir or (args.output and not args.follow):
+        print_pipeline_output(args, project_url, pid, jobs)
+        if tree is not None:
+            for node in tree.downstream:
+                print_pipeline_output(args, node.project_url, node.pid)
+
+    if args.timing_report or args.timing_json:
+        timing = pipeline_timing(pipeline, jobs)
+        if args.timing_report:
+            print_timing_report(timing)
+        if args.timing_json:
+            with open(args.timing_json, 'a') as f:
+                f.write(json.dumps(timing) + '\n')
+
+    if tree is not None:
+        tree.print_status()
+        failed = tree.failed
+        if failed and status in [STATUS_SUCCESS, STATUS_MANUAL]:
+            print(f'{len(failed)} downstream pipelines failed!')
+            status = STATUS_FAILED
+
     if status == STATUS_SUCCESS:
         print('Pipeline succeeded')
         return pid
@@ -384,13 +1805,904 @@ def trigger(args: List[str]) -> int:
         print('Pipeline status is "manual", action "pass"')
         return pid
     else:
-        print(f"Pipeline failed! Check details at '{pipeline.web_url}'")
+        print(f"Pipeline failed! Check details at '{pipeline['web_url']}'")
         raise PipelineFailure(return_code=1, pipeline_id=pid)
 
 
+def print_targets_table(targets: List[Target]):
+    rows = [('PROJECT', 'REF', 'PIPELINE', 'STATUS', 'RESULT')]
+    for t in targets:
+        rows.append((str(t.project_id), t.ref, str(t.pid or '-'), t.status or '-', str(t.return_code)))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+
+
+def trigger_targets(args, base_url, variables) -> List[int]:
+    """ Trigger all targets concurrently and wait on them together
+
+    Returns the list of pipeline ids if all targets succeeded, raises
+    `PipelineFailure` with the highest return code of all targets otherwise.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    targets = [Target(args.project_id, args.target_ref, args.pipeline_token)]
+    targets += [Target.parse(spec, args.target_ref, args.pipeline_token) for spec in args.target]
+
+    if not args.detached:
+        assert args.api_token is not None, 'pipeline status checks require an api token (-a parameter missing)'
+
+    def start(target):
+        try:
+            target.project_id, target.project_url = resolve_project_url(args, base_url, target.project_id)
+            target.pid = start_pipeline(args, target.project_id, target.project_url,
+                                        target.ref, target.pipeline_token, variables)
+        except Exception as e:
+            print(f'Failed to trigger pipeline for project {target.project_id}: {e}')
+            target.return_code = 1
+
+    def poll(target):
+        try:
+            target.pipeline, target.status = check_pipeline_status(args, target.pid, target.project_url)
+        except PipelineFailure as e:
+            target.return_code = e.return_code
+
+    def follow(target):
+        if target.tailer is None:
+            target.tailer = TraceTailer(target.project_url, args.api_token, target.pid, args.verifyssl,
+                                        prefix=f'{target.project_id}:')
+        target.tailer.poll(deadline)
+
+    def time_out(target):
+        try:
+            time_out_pipeline(args, target.project_url, target.pid, target.tree)
+        except PipelineFailure as e:
+            target.return_code = e.return_code
+
+    def fail_fast(target):
+        if check_fail_fast(args, target.project_url, target.pid, target.status, target.tree, deadline):
+            target.status = STATUS_FAILED
+            target.failed_fast = True
+
+    def refresh_tree(target):
+        if target.tree is None:
+            target.tree = DownstreamTree(args, target.project_url, target.pid)
+        target.tree.refresh(target.pipeline, deadline)
+
+    def refresh(target, changed, failed):
+        key = (target.project_url, str(target.pid))
+        if key in failed:
+            print(f'Polling for pipeline {target.pid} failed {BatchPoller.max_retries + 1} consecutive times.')
+            target.return_code = 2
+        elif key in changed:
+            try:
+                refresh_target(args, target, changed[key])
+                target.failures = 0
+            except Exception as e:
+                # e.g. playing manual jobs failed, handled again with the next poll
+                print(f'\nRefreshing pipeline {target.pid} failed: {e}')
+                target.status = None
+                target.failures += 1
+                if target.failures > BatchPoller.max_retries:
+                    print(f'Refreshing pipeline {target.pid} failed {target.failures} consecutive times.')
+                    target.return_code = 2
+                else:
+                    poller.retry(target.project_url, args.api_token, args.verifyssl, target.pid)
+
+    with ThreadPoolExecutor(max_workers=args.max_workers) as pool:
+        list(pool.map(start, targets))
+
+        if args.detached:
+            if args.on_manual == ACTION_PLAY:
+                list(pool.map(poll, [t for t in targets if t.return_code is None]))
+            print('Detached mode: not monitoring pipeline status - exiting now.')
+            for t in targets:
+                if t.return_code is None:
+                    t.return_code = 0
+        else:
+            pending = [t for t in targets if not t.finished]
+            print(f"Waiting for {len(pending)} pipelines to finish ...")
+            poller = BatchPoller()
+            listener = open_webhook_listener(args)
+            for t in pending:
+                poller.track(t.project_url, args.api_token, args.verifyssl, t.pid)
+                if listener is not None:
+                    listener.track(t.pid)
+            deadline = monotonic() + args.timeout if args.timeout else None
+            while pending:
+                if remaining(deadline) == 0:
+                    list(pool.map(time_out, pending))
+                    break
+                # one list request per project, refreshed concurrently
+                groups = [[key] for key in poller.groups]
+                results = list(pool.map(partial(poller.poll, deadline=deadline), groups))
+                changed = dict(item for c, _ in results for item in c.items())
+                failed = dict(item for _, f in results for item in f.items())
+                for t in pending:
+                    refresh(t, changed, failed)
+                if args.downstream:
+                    list(pool.map(refresh_tree, [t for t in pending if t.return_code is None and t.pipeline is not None]))
+                if args.fail_fast or args.cancel_on_fail:
+                    list(pool.map(fail_fast, [t for t in pending if t.return_code is None and t.pipeline is not None]))
+                if args.follow:
+                    list(pool.map(follow, pending))
+                for t in pending:
+                    if t.finished:
+                        poller.untrack(t.project_url, args.api_token, args.verifyssl, t.pid)
+                pending = [t for t in pending if not t.finished]
+
+                if not args.follow:
+                    print('.', end='', flush=True)
+                if pending:
+                    wait_for_next_poll(args, listener, deadline)
+            if listener is not None:
+                listener.close()
+            print()
+
+            for t in targets:
+                if t.return_code is not None:
+                    continue
+                print(f'Project {t.project_id} ({t.ref}), pipeline {t.pid}:')
+                try:
+                    finish_pipeline(args, t.pid, t.pipeline, t.status, t.project_url, t.tree, t.ref)
+                    t.return_code = 0
+                except PipelineFailure as e:
+                    t.return_code = e.return_code
+
+    print_targets_table(targets)
+    for t in targets:
+        metrics.inc('trigger_results', return_code=t.return_code)
+    failed = [t for t in targets if t.return_code != 0]
+    if failed:
+        worst = max(failed, key=lambda t: t.return_code)
+        raise PipelineFailure(return_code=worst.return_code, pipeline_id=worst.pid)
+    return [t.pid for t in targets]
+
+
+def validate_args(args):
+    assert args.pipeline_token, 'pipeline token must be set'
+    assert args.project_id, 'project id must be set'
+    assert args.host, 'host must be set'
+    assert args.url_path, 'url path must be set'
+    assert args.target_ref, 'must provide target ref'
+    assert args.sleep > 0, 'sleep parameter must be > 0'
+    assert args.max_workers > 0, 'max workers parameter must be > 0'
+    assert args.pool_size > 0, 'pool size parameter must be > 0'
+    assert args.rate_limit >= 0, 'rate limit parameter must be >= 0'
+    assert args.connect_timeout > 0, 'connect timeout parameter must be > 0'
+    assert args.read_timeout > 0, 'read timeout parameter must be > 0'
+    assert args.timeout is None or args.timeout > 0, 'timeout parameter must be > 0'
+    assert args.trace_workers > 0, 'trace workers parameter must be > 0'
+    assert args.webhook_fallback_sleep > 0, 'webhook fallback sleep parameter must be > 0'
+    assert args.pid is None or not args.target, 'a pipeline id (--pid) can not be retried across multiple targets'
+    assert not args.resume_key or args.resume_dir or args.cache_dir, 'resuming requires --resume-dir or --cache-dir'
+    assert not args.resume_key or args.api_token, 'resuming requires an api token (-a parameter missing)'
+    assert not args.reuse or args.api_token, 'reusing pipelines requires an api token (-a parameter missing)'
+    assert not args.cancel_superseded or args.api_token, 'cancelling superseded pipelines requires an api token (-a parameter missing)'
+
+
+def trigger(args: List[str]) -> int:
+    args = parse_args(args)
+    validate_args(args)
+
+    configure_http(pool_size=args.pool_size, rate_limit=args.rate_limit,
+                   connect_timeout=args.connect_timeout, read_timeout=args.read_timeout)
+    configure_cache(args.cache_dir, args.cache_ttl)
+
+    base_url = get_base_url(args.host)
+
+    variables = parse_env(args.env) if args.env is not None else {}
+
+    metrics_server = open_metrics_server(args.metrics_listen) if args.metrics_listen else None
+    try:
+        if args.target:
+            return trigger_targets(args, base_url, variables)
+        try:
+            pid = trigger_pipeline(args, base_url, variables)
+        except PipelineFailure as e:
+            metrics.inc('trigger_results', return_code=e.return_code)
+            raise
+        metrics.inc('trigger_results', return_code=0)
+        return pid
+    finally:
+        if metrics_server is not None:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+        if args.metrics_file:
+            metrics.write(args.metrics_file)
+
+
+def trigger_pipeline(args, base_url, variables) -> int:
+    """ Trigger a single pipeline and wait for it (unless detached), see `run_async`
+
+    Detached runs only start the pipeline, they skip the event loop (and importing asyncio) to start up fast.
+    """
+    if args.detached:
+        proj_id, project_url = resolve_project_url(args, base_url, args.project_id)
+        pid = start_pipeline(args, proj_id, project_url, args.target_ref, args.pipeline_token, variables)
+        return finish_detached(args, pid, project_url)
+    return run_coroutine(run_async(TriggerRequest.from_args(args, variables, base_url)))
+
+
+class TriggerRequest:
+    """ A single pipeline to trigger with the asyncio API
+
+    Takes the command line options as keyword arguments, e.g.
+    `TriggerRequest('group/project', 'master', token, api_token=..., env=dict(FOO='bar'), on_manual='play')`.
+    The project url and the pipeline id are set once the pipeline was started,
+    the pipeline once it has been waited on.
+    """
+
+    def __init__(self, project_id, ref, pipeline_token, env: Optional[Dict] = None, **options):
+        args = parse_args(['-p', pipeline_token, '-t', ref, str(project_id)])
+        for key, value in options.items():
+            assert hasattr(args, key), f'unknown option: {key}'
+            setattr(args, key, value)
+        assert not args.target, 'create one request per target'
+        validate_args(args)
+        self.args = args
+        self.variables = parse_env([f'{k}={v}' for k, v in (env or {}).items()])
+        self.base_url = get_base_url(args.host)
+        self.project_url = None
+        self.pid = None
+        self.pipeline = None
+
+    @classmethod
+    def from_args(cls, args, variables, base_url=None) -> 'TriggerRequest':
+        """ A request for parsed command line arguments and their `parse_env` variables
+        """
+        options = vars(args).copy()
+        del options['env']
+        request = cls(options.pop('project_id'), options.pop('target_ref'), options.pop('pipeline_token'), **options)
+        request.variables = variables
+        request.base_url = base_url or request.base_url
+        return request
+
+
+def run_coroutine(coroutine):
+    """ Run a coroutine of the asyncio API to completion on a new event loop
+    """
+    import asyncio
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def run_in_executor(executor, fn, *fn_args):
+    import asyncio
+
+    return asyncio.get_event_loop().run_in_executor(executor, partial(fn, *fn_args))
+
+
+async def trigger_async(request: TriggerRequest, executor=None) -> int:
+    """ Start (create, retry or reuse) the pipeline of a request, returns its id
+    """
+    args = request.args
+
+    def start():
+        proj_id, request.project_url = resolve_project_url(args, request.base_url, args.project_id)
+        request.pid = start_pipeline(args, proj_id, request.project_url, args.target_ref, args.pipeline_token, request.variables)
+        return request.pid
+
+    return await run_in_executor(executor, start)
+
+
+async def wait_async(request: TriggerRequest, executor=None) -> int:
+    """ Wait for the started pipeline of a request to finish
+
+    Only the api requests run on `executor` (the default executor of the loop
+    if `None`), waiting between polls does not hold a thread. Returns the
+    pipeline id on success, raises `PipelineFailure` otherwise.
+    """
+    import asyncio
+
+    args, project_url, pid = request.args, request.project_url, request.pid
+    assert pid is not None, 'the pipeline of the request must be started first'
+    # waiting requires api_token to be set
+    assert args.api_token is not None, 'pipeline status checks require an api token (-a parameter missing)'
+
+    print(f"Waiting for pipeline {pid} to finish ...")
+
+    status = None
+    pipeline = None
+    tailer = TraceTailer(project_url, args.api_token, pid, args.verifyssl) if args.follow else None
+    player = ManualJobPlayer(args, project_url, pid)
+    tree = DownstreamTree(args, project_url, pid) if args.downstream else None
+    listener = open_webhook_listener(args)
+    if listener is not None:
+        listener.track(pid)
+        # bridge the events of the listener thread to the loop, waiting for them does not hold a thread either
+        changed = asyncio.Event()
+        loop = asyncio.get_event_loop()
+        listener.on_change(lambda: loop.call_soon_threadsafe(changed.set))
+
+    deadline = monotonic() + args.timeout if args.timeout else None
+
+    def finished():
+        return status in finished_states and (tree is None or tree.finished)
+
+    try:
+        while not finished():
+            if remaining(deadline) == 0:
+                await run_in_executor(executor, time_out_pipeline, args, project_url, pid, tree)
+            pipeline, status = await run_in_executor(executor, check_pipeline_status, args, pid, project_url, player, deadline, tree)
+            if tree is not None:
+                await run_in_executor(executor, tree.refresh, pipeline, deadline)
+            if await run_in_executor(executor, check_fail_fast, args, project_url, pid, status, tree, deadline):
+                status = STATUS_FAILED
+                break
+
+            if tailer is not None:
+                await run_in_executor(executor, tailer.poll, deadline)
+            else:
+                print('.', end='', flush=True)
+            if not finished():
+                interval = args.webhook_fallback_sleep if listener is not None else args.sleep
+                if deadline is not None:
+                    interval = min(interval, remaining(deadline))
+                if listener is not None:
+                    try:
+                        await asyncio.wait_for(changed.wait(), interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    changed.clear()
+                else:
+                    await asyncio.sleep(interval)
+    finally:
+        if listener is not None:
+            listener.close()
+
+    print()
+    request.pipeline = pipeline
+    return await run_in_executor(executor, finish_pipeline, args, pid, pipeline, status, project_url, tree)
+
+
+async def run_async(request: TriggerRequest, executor=None) -> int:
+    """ Trigger the pipeline of a request and wait for it (unless detached)
+    """
+    pid = await trigger_async(request, executor)
+    if request.args.detached:
+        return await run_in_executor(executor, finish_detached, request.args, pid, request.project_url)
+    return await wait_async(request, executor)
+
+
+def finish_detached(args, pid, project_url) -> int:
+    """ Leave a started pipeline alone, after playing its manual jobs for `--on-manual play`
+    """
+    if args.on_manual == ACTION_PLAY:  # detached for manual pipelines
+        check_pipeline_status(args, pid, project_url)
+    print('Detached mode: not monitoring pipeline status - exiting now.')
+    return pid
+
+
+def as_completed(requests: List[TriggerRequest], executor=None):
+    """ Run all requests concurrently, returns an iterator of coroutines in the order the pipelines finish
+
+    Each coroutine returns a pipeline id or raises `PipelineFailure`, use the
+    `pid` of the requests to tell them apart. Must be called with a running
+    event loop, e.g. `for result in as_completed(requests): pid = await result`.
+    """
+    import asyncio
+
+    return asyncio.as_completed([run_async(request, executor) for request in requests])
+
+
+MANIFEST_REFERENCE = re.compile(r'\{([^{}]+)\.(pid|sha)\}')
+
+
+class ManifestNode:
+    """ A trigger of a `trigger manifest` and the nodes it needs
+    """
+
+    def __init__(self, name, args: List[str], needs: List[str]):
+        self.name = name
+        self.args = args
+        self.needs = needs
+        self.request = None
+        self.return_code = None
+        self.skipped = False
+
+    @property
+    def references(self):
+        return {(name, attr) for arg in self.args for name, attr in MANIFEST_REFERENCE.findall(arg)}
+
+    def substitute(self, nodes):
+        """ The arguments of the node with `{node.pid}` and `{node.sha}` replaced by the values of the needed nodes
+        """
+        def replace(m):
+            request = nodes[m.group(1)].request
+            return str(request.pid if m.group(2) == 'pid' else request.pipeline['sha'])
+
+        return [MANIFEST_REFERENCE.sub(replace, arg) for arg in self.args]
+
+
+def load_manifest(path):
+    """ Read a manifest from a json file, or a yaml file if PyYAML is installed
+    """
+    with open(path) as f:
+        if path.endswith(('.yml', '.yaml')):
+            import yaml
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def parse_manifest(manifest: Dict) -> List[ManifestNode]:
+    """ The nodes of a manifest in an order in which each node comes after the nodes it needs
+
+    Environment variables in the arguments (e.g. `$API_TOKEN`) are expanded,
+    `defaults` are prepended to the arguments of every node.
+    """
+    defaults = manifest.get('defaults', [])
+    nodes = collections.OrderedDict()
+    for name, spec in manifest['nodes'].items():
+        args = [os.path.expandvars(str(arg)) for arg in defaults + spec.get('args', [])]
+        nodes[name] = ManifestNode(name, args, list(spec.get('needs', [])))
+
+    for node in nodes.values():
+        for name in node.needs:
+            assert name in nodes, f'node {node.name} needs unknown node {name}'
+        for name, _ in node.references:
+            assert name in node.needs, f'node {node.name} references node {name} without needing it'
+        node_args = parse_args(node.args)
+        assert not node_args.target, f'node {node.name} must trigger a single project, use one node per target'
+        validate_args(node_args)
+
+    ordered = []
+    visiting = set()
+
+    def visit(node):
+        if node in ordered:
+            return
+        assert node.name not in visiting, f'dependency cycle through node {node.name}'
+        visiting.add(node.name)
+        for name in node.needs:
+            visit(nodes[name])
+        ordered.append(node)
+
+    for node in nodes.values():
+        visit(node)
+    return ordered
+
+
+async def run_manifest_async(nodes: List[ManifestNode], concurrency: int, executor=None):
+    """ Run every node as soon as the nodes it needs succeeded, at most `concurrency` at a time
+
+    Nodes needing a node that did not succeed are skipped.
+    """
+    import asyncio
+
+    semaphore = asyncio.Semaphore(concurrency)
+    by_name = {node.name: node for node in nodes}
+    shas = {name for node in nodes for name, attr in node.references if attr == 'sha'}
+    tasks = {}
+
+    async def run(node):
+        succeeded = [await tasks[name] for name in node.needs]
+        if not all(succeeded):
+            node.skipped = True
+            print(f'Skipping node {node.name}, a node it needs did not succeed')
+            return False
+        async with semaphore:
+            args = parse_args(node.substitute(by_name))
+            variables = parse_env(args.env) if args.env is not None else {}
+            node.request = TriggerRequest.from_args(args, variables)
+            print(f'Starting node {node.name}')
+            try:
+                await run_async(node.request, executor)
+                if node.name in shas and node.request.pipeline is None:
+                    # detached, the sha is only known once the pipeline is fetched
+                    node.request.pipeline = await run_in_executor(executor, get_pipeline, node.request.project_url,
+                                                                  args.api_token, node.request.pid, args.verifyssl)
+                node.return_code = 0
+            except PipelineFailure as e:
+                node.return_code = e.return_code
+            except Exception as e:
+                print(f'Node {node.name} failed: {e}')
+                node.return_code = 1
+        return node.return_code == 0
+
+    # the nodes are ordered, so every node's needs have a task before it does
+    for node in nodes:
+        tasks[node.name] = asyncio.ensure_future(run(node))
+    await asyncio.gather(*tasks.values())
+
+
+def print_manifest_table(nodes: List[ManifestNode]):
+    rows = [('NODE', 'PROJECT', 'REF', 'PIPELINE', 'STATUS', 'RESULT')]
+    for node in nodes:
+        request = node.request
+        args = request.args if request is not None else None
+        rows.append((
+            node.name,
+            str(args.project_id) if args else '-',
+            args.target_ref if args else '-',
+            str((request and request.pid) or '-'),
+            (request and request.pipeline or {}).get('status') or '-',
+            'skipped' if node.skipped else str(node.return_code),
+        ))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+
+
+def parse_manifest_args(args: List[str]):
+    parser = argparse.ArgumentParser(
+        prog='trigger manifest',
+        description='Run the triggers of a manifest, each as soon as the triggers it needs succeeded')
+    parser.add_argument('--cache-dir', default=os.environ.get('TRIGGER_CACHE_DIR'),
+                        help='directory of a persistent project metadata cache (default: $TRIGGER_CACHE_DIR)')
+    parser.add_argument('--cache-ttl', type=int, default=DEFAULT_CACHE_TTL, help='seconds cached project metadata stays valid')
+    parser.add_argument('--connect-timeout', type=float, default=DEFAULT_CONNECT_TIMEOUT, help='seconds to wait for a connection to the api')
+    parser.add_argument('--concurrency', type=int, default=None, help='maximum number of triggers running at a time (default: from the manifest or 4)')
+    parser.add_argument('--pool-size', type=int, default=DEFAULT_POOL_SIZE, help='maximum number of pooled keep-alive connections per host')
+    parser.add_argument('--rate-limit', type=float, default=DEFAULT_RATE_LIMIT,
+                        help='maximum number of api requests per second per host and api token (0 for no client side limit)')
+    parser.add_argument('--read-timeout', type=float, default=DEFAULT_READ_TIMEOUT,
+                        help='seconds to wait for the api to send data, per read')
+    parser.add_argument('manifest', help='json (or yaml) file describing the triggers and the triggers they need')
+    return parser.parse_args(args)
+
+
+def trigger_manifest(args: List[str]) -> Dict[str, int]:
+    """ Run all nodes of a manifest
+
+    Returns the pipeline id per node if all nodes succeeded, raises
+    `PipelineFailure` with the highest return code of all nodes otherwise.
+    """
+    args = parse_manifest_args(args)
+    manifest = load_manifest(args.manifest)
+    concurrency = args.concurrency or manifest.get('concurrency', 4)
+    assert concurrency > 0, 'concurrency parameter must be > 0'
+    assert args.rate_limit >= 0, 'rate limit parameter must be >= 0'
+    configure_http(pool_size=args.pool_size, rate_limit=args.rate_limit,
+                   connect_timeout=args.connect_timeout, read_timeout=args.read_timeout)
+    configure_cache(args.cache_dir, args.cache_ttl)
+
+    nodes = parse_manifest(manifest)
+    run_coroutine(run_manifest_async(nodes, concurrency))
+    print_manifest_table(nodes)
+    failed = [node for node in nodes if node.return_code]
+    if failed:
+        worst = max(failed, key=lambda node: node.return_code)
+        raise PipelineFailure(return_code=worst.return_code, pipeline_id=worst.request.pid if worst.request else None)
+    return {node.name: node.request.pid for node in nodes}
+
+
+class ServiceJob:
+    """ A trigger request submitted to the `TriggerService`
+    """
+
+    def __init__(self, job_id, args):
+        self.id = job_id
+        self.args = args
+        self.target = Target(args.project_id, args.target_ref, args.pipeline_token)
+        self.group = None
+        self.error = None
+        self.created_at = time()
+        self.deadline = monotonic() + args.timeout if args.timeout else None
+        self.finished_at = None
+        self.done = threading.Event()
+
+    def to_dict(self):
+        return dict(
+            id=self.id,
+            project_id=self.target.project_id,
+            ref=self.target.ref,
+            pipeline_id=self.target.pid,
+            status=self.target.status,
+            finished=self.done.is_set(),
+            return_code=self.target.return_code,
+            error=self.error,
+            created_at=self.created_at,
+            finished_at=self.finished_at,
+        )
+
+
+class TriggerService:
+    """ Triggers pipelines on request and waits on all of them in a single scheduler
+
+    Requests take the same arguments as the `trigger` command line. Started
+    pipelines are kept in a heap ordered by their next poll time, and a single
+    scheduler thread hands due polls to a bounded worker pool. Due pipelines of
+    the same project are refreshed together by a `BatchPoller`. Clients are
+    shared between requests through the cached `get_session`.
+    """
+
+    def __init__(self, max_workers=32, max_finished=1000):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.jobs = collections.OrderedDict()
+        self.max_finished = max_finished
+        self.poller = BatchPoller()
+        self.waiters = {}
+        self.polling = set()
+        self.schedule = []
+        self.sequence = itertools.count()
+        self.ids = itertools.count(1)
+        self.condition = threading.Condition()
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.running = True
+        self.scheduler = threading.Thread(target=self.run, name='trigger-scheduler', daemon=True)
+        self.scheduler.start()
+
+    def submit(self, argv: List[str]) -> ServiceJob:
+        args = parse_args(argv)
+        validate_args(args)
+        assert not args.target, 'submit one request per target'
+        assert not args.downstream, 'downstream pipelines are not tracked by the service'
+        assert not (args.fail_fast or args.cancel_on_fail), 'failing fast is not supported by the service'
+        assert not args.follow, 'following job output is not supported by the service'
+        assert not args.webhook_listen, 'webhooks are not supported per request by the service'
+        with self.condition:
+            job = ServiceJob(next(self.ids), args)
+            self.jobs[job.id] = job
+        self.pool.submit(self.start, job)
+        return job
+
+    def get(self, job_id) -> Optional[ServiceJob]:
+        with self.condition:
+            return self.jobs.get(job_id)
+
+    def wait(self, job_id, timeout=None) -> Optional[ServiceJob]:
+        job = self.get(job_id)
+        if job is not None:
+            job.done.wait(timeout)
+        return job
+
+    def start(self, job):
+        args, target = job.args, job.target
+        try:
+            variables = parse_env(args.env) if args.env is not None else {}
+            target.project_id, target.project_url = resolve_project_url(args, get_base_url(args.host), target.project_id)
+            target.pid = start_pipeline(args, target.project_id, target.project_url,
+                                        target.ref, target.pipeline_token, variables)
+            if args.detached:
+                if args.on_manual == ACTION_PLAY:
+                    target.pipeline, target.status = check_pipeline_status(args, target.pid, target.project_url)
+                self.complete(job, 0)
+                return
+            assert args.api_token is not None, 'pipeline status checks require an api token (-a parameter missing)'
+        except PipelineFailure as e:
+            self.complete(job, e.return_code)
+            return
+        except Exception as e:
+            job.error = str(e)
+            self.complete(job, 1)
+            return
+        with self.condition:
+            job.group = self.poller.track(target.project_url, args.api_token, args.verifyssl, target.pid)
+            self.waiters.setdefault((target.project_url, str(target.pid)), []).append(job)
+        self.reschedule(job, 0)
+
+    def poll(self, group, due):
+        """ Refresh all pipelines of a project at once and update every waiter
+        """
+        try:
+            changed, failed = self.poller.poll([group])
+            for key, pipeline in changed.items():
+                with self.condition:
+                    jobs = list(self.waiters.get(key, []))
+                for job in jobs:
+                    self.refresh(job, pipeline)
+            for key in failed:
+                with self.condition:
+                    jobs = list(self.waiters.get(key, []))
+                for job in jobs:
+                    job.error = f'polling failed {BatchPoller.max_retries + 1} consecutive times'
+                    self.complete(job, 2)
+        finally:
+            with self.condition:
+                self.polling.discard(group)
+            for job in due:
+                if job.done.is_set():
+                    continue
+                if remaining(job.deadline) == 0:
+                    self.time_out(job)
+                elif job.deadline is None:
+                    self.reschedule(job, job.args.sleep)
+                else:
+                    self.reschedule(job, min(job.args.sleep, remaining(job.deadline)))
+
+    def refresh(self, job, pipeline):
+        args, target = job.args, job.target
+        try:
+            refresh_target(args, target, pipeline)
+            if target.status not in finished_states:
+                return
+            finish_pipeline(args, target.pid, target.pipeline, target.status, target.project_url, ref=target.ref)
+            self.complete(job, 0)
+        except PipelineFailure as e:
+            self.complete(job, e.return_code)
+        except Exception as e:
+            job.error = str(e)
+            self.complete(job, 1)
+
+    def time_out(self, job):
+        try:
+            time_out_pipeline(job.args, job.target.project_url, job.target.pid)
+        except PipelineFailure as e:
+            job.error = f'timed out after {job.args.timeout} seconds'
+            self.complete(job, e.return_code)
+
+    def reschedule(self, job, delay):
+        with self.condition:
+            heapq.heappush(self.schedule, (monotonic() + delay, next(self.sequence), job))
+            self.condition.notify()
+
+    def complete(self, job, return_code):
+        target = job.target
+        with self.condition:
+            waiters = self.waiters.get((target.project_url, str(target.pid)), [])
+            if job in waiters:
+                waiters.remove(job)
+                if not waiters:
+                    del self.waiters[(target.project_url, str(target.pid))]
+            # other requests (e.g. reused pipelines) may still wait on the same pipeline
+            if job.group is not None and not any(other.group == job.group for other in waiters):
+                self.poller.untrack(target.project_url, job.args.api_token, job.args.verifyssl, target.pid)
+                forget_conditional(f'{target.project_url}/pipelines/{target.pid}')
+            target.return_code = return_code
+            job.finished_at = time()
+            metrics.inc('trigger_results', return_code=return_code)
+            metrics.forget(target.project_url, target.pid)
+            job.done.set()
+            finished = [j for j in self.jobs.values() if j.done.is_set()]
+            for old in finished[:max(0, len(finished) - self.max_finished)]:
+                del self.jobs[old.id]
+
+    def run(self):
+        with self.condition:
+            while self.running:
+                now = monotonic()
+                due = collections.defaultdict(list)
+                while self.schedule and self.schedule[0][0] <= now:
+                    _, _, job = heapq.heappop(self.schedule)
+                    if not job.done.is_set():
+                        due[job.group].append(job)
+                for group, jobs in due.items():
+                    if group in self.polling:
+                        # the project is being refreshed already, try again on the next interval
+                        for job in jobs:
+                            heapq.heappush(self.schedule, (now + job.args.sleep, next(self.sequence), job))
+                        continue
+                    self.polling.add(group)
+                    self.pool.submit(self.poll, group, jobs)
+                timeout = self.schedule[0][0] - now if self.schedule else None
+                self.condition.wait(timeout)
+
+    def shutdown(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.scheduler.join()
+        self.pool.shutdown(wait=False)
+
+
+def make_service_server(service, listen=None, socket_path=None):
+    """ Expose a `TriggerService` over HTTP on `HOST:PORT` or a unix socket
+
+    POST /triggers            {"args": [...]} submits a request
+    GET  /triggers            lists all known requests
+    GET  /triggers/ID         returns the state of a request
+    GET  /triggers/ID/wait    blocks until the request has finished (?timeout=SECONDS)
+    GET  /metrics             returns the metrics of the service in the OpenMetrics format
+    """
+    import socketserver
+    from http.server import BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            if self.path.rstrip('/') != '/triggers':
+                return self.send_json(404, dict(error='not found'))
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                job = service.submit(body['args'])
+            except SystemExit:
+                return self.send_json(400, dict(error='invalid trigger arguments'))
+            except (AssertionError, KeyError, TypeError, ValueError) as e:
+                return self.send_json(400, dict(error=str(e) or 'invalid request'))
+            self.send_json(202, job.to_dict())
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            parts = [p for p in url.path.split('/') if p]
+            if parts == ['metrics']:
+                return send_metrics(self)
+            if parts == ['triggers']:
+                with service.condition:
+                    jobs = [job.to_dict() for job in service.jobs.values()]
+                return self.send_json(200, jobs)
+            if len(parts) in (2, 3) and parts[0] == 'triggers' and isint(parts[1]):
+                if len(parts) == 3 and parts[2] == 'wait':
+                    query = urllib.parse.parse_qs(url.query)
+                    try:
+                        timeout = float(query['timeout'][0]) if 'timeout' in query else None
+                        assert timeout is None or 0 <= timeout < float('inf')
+                    except (AssertionError, ValueError):
+                        return self.send_json(400, dict(error='timeout must be a number of seconds'))
+                    job = service.wait(int(parts[1]), timeout)
+                elif len(parts) == 2:
+                    job = service.get(int(parts[1]))
+                else:
+                    job = None
+                if job is not None:
+                    return self.send_json(200, job.to_dict())
+            self.send_json(404, dict(error='not found'))
+
+        def log_message(self, format, *args):
+            pass
+
+    if socket_path is not None:
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        return Server(socket_path, Handler)
+
+    return make_http_server(listen or DEFAULT_SERVICE_LISTEN, Handler)
+
+
+def parse_serve_args(args: List[str]):
+    parser = argparse.ArgumentParser(
+        prog='trigger serve',
+        description='Run pipeline-trigger as a service accepting trigger requests')
+    location = parser.add_mutually_exclusive_group()
+    location.add_argument('--listen', default=DEFAULT_SERVICE_LISTEN, help='HOST:PORT to listen on')
+    location.add_argument('--socket', help='unix socket path to listen on instead of --listen')
+    parser.add_argument('--cache-dir', default=os.environ.get('TRIGGER_CACHE_DIR'),
+                        help='directory of a persistent project metadata cache (default: $TRIGGER_CACHE_DIR)')
+    parser.add_argument('--cache-ttl', type=int, default=DEFAULT_CACHE_TTL, help='seconds cached project metadata stays valid')
+    parser.add_argument('--connect-timeout', type=float, default=DEFAULT_CONNECT_TIMEOUT, help='seconds to wait for a connection to the api')
+    parser.add_argument('--max-workers', type=int, default=32, help='maximum number of concurrent GitLab requests')
+    parser.add_argument('--pool-size', type=int, default=DEFAULT_POOL_SIZE, help='maximum number of pooled keep-alive connections per host')
+    parser.add_argument('--rate-limit', type=float, default=DEFAULT_RATE_LIMIT,
+                        help='maximum number of api requests per second per host and api token (0 for no client side limit)')
+    parser.add_argument('--read-timeout', type=float, default=DEFAULT_READ_TIMEOUT,
+                        help='seconds to wait for the api to send data, per read')
+    return parser.parse_args(args)
+
+
+def serve(args: List[str]):
+    args = parse_serve_args(args)
+    assert args.max_workers > 0, 'max workers parameter must be > 0'
+    assert args.rate_limit >= 0, 'rate limit parameter must be >= 0'
+    configure_http(pool_size=args.pool_size, rate_limit=args.rate_limit,
+                   connect_timeout=args.connect_timeout, read_timeout=args.read_timeout)
+    configure_cache(args.cache_dir, args.cache_ttl)
+
+    service = TriggerService(max_workers=args.max_workers)
+    server = make_service_server(service, listen=args.listen, socket_path=args.socket)
+    print(f'Accepting trigger requests on {args.socket or args.listen}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:  # pragma: nocover
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+
 if __name__ == "__main__":  # pragma: nocover
+    if sys.argv[1:2] == ['serve']:
+        serve(sys.argv[2:])
+        sys.exit(0)
     try:
-        trigger(sys.argv[1:])
+        if sys.argv[1:2] == ['manifest']:
+            trigger_manifest(sys.argv[2:])
+        else:
+            trigger(sys.argv[1:])
         sys.exit(0)
     except PipelineFailure as e:
         sys.exit(e.return_code)